@@ -0,0 +1,34 @@
+"""
+Arabic Text Normalization - توحيد النص العربي قبل المقارنة والفهرسة 🔤
+"أهلاً وسهلاً!!" و "اهلا وسهلا" يصبحان نفس النص
+"""
+import re
+from typing import List, Optional
+
+# التشكيل والتطويل
+ARABIC_DIACRITICS = re.compile('[\u064B-\u0652\u0670\u0640]')
+ARABIC_LETTER_FORMS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+    # الأرقام العربية والفارسية -> لاتينية
+    **{chr(0x0660 + d): str(d) for d in range(10)},
+    **{chr(0x06F0 + d): str(d) for d in range(10)},
+})
+NON_WORD = re.compile(r'[^\w]+|_')
+# "رااااائع" -> "رائع" (3 تكرارات فأكثر فقط حتى لا تتأثر الحروف المضعفة)
+# الحروف العربية فقط: الأرقام (1000) والحروف اللاتينية (www) تبقى كما هي
+ELONGATION = re.compile('([\u0621-\u064A])\\1{2,}')
+
+
+def normalize_arabic(text: Optional[str]) -> str:
+    """نص موحد: بدون تشكيل أو علامات ترقيم، بأشكال حروف موحدة ومسافات مفردة"""
+    if not text:
+        return ''
+    text = ARABIC_DIACRITICS.sub('', text.lower()).translate(ARABIC_LETTER_FORMS)
+    text = ELONGATION.sub(r'\1', text)
+    return ' '.join(NON_WORD.sub(' ', text).split())
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """كلمات النص بعد التوحيد"""
+    return normalize_arabic(text).split()
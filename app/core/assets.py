@@ -0,0 +1,258 @@
+"""
+Static Assets - بناء الملفات الثابتة وتقديمها مضغوطة مسبقاً 📦
+وقت البناء (python -m app.core.assets):
+- استخراج CSS/JS المضمّن في القوالب إلى ملفات منفصلة تُخزّن في المتصفح
+- بصمة (hash) في اسم كل ملف حتى يمكن تخزينه لمدة سنة (immutable)
+- نسخ gzip و brotli جاهزة بجانب كل ملف
+وقت التشغيل: PrecompressedStaticFiles يختار النسخة حسب Accept-Encoding،
+و /sw.js يُقدَّم برقم إصدار النشر الحالي وقائمة ملفات الـ app shell
+"""
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+import mimetypes
+from typing import Dict, Iterable, Optional
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+
+from app.core.rendering import make_etag, is_not_modified
+
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = "static"
+TEMPLATE_DIR = "templates"
+DIST = "dist"
+# القوالب التي يُستخرج منها CSS/JS المضمّن
+ASSET_TEMPLATES = ("mobile_app.html",)
+COMPRESSIBLE = {".css", ".js", ".json", ".html", ".svg", ".txt", ".xml", ".webmanifest"}
+MIN_COMPRESS_BYTES = 512
+# عنوانه يجب أن يبقى ثابتاً (/sw.js) - لا يُضاف له بصمة
+SERVICE_WORKER = "sw.js"
+APP_SHELL = ("/mobile",)
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+FINGERPRINTED = re.compile(r"\.[0-9a-f]{10}\.\w+$")
+# فقط الوسوم بدون خصائص: <script src=...> تبقى كما هي
+INLINE_STYLE = re.compile(r"<style>(.*?)</style>", re.S)
+INLINE_SCRIPT = re.compile(r"<script>(.*?)</script>", re.S)
+JINJA_SYNTAX = re.compile(r"{{|{%|{#")
+
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+# ==================== البناء ====================
+
+def fingerprint(name: str, content: bytes) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:10]}{ext}"
+
+
+def precompress(path: str) -> Dict[str, int]:
+    """نسخ .gz و .br بجانب الملف - فقط إذا كانت أصغر فعلاً"""
+    with open(path, "rb") as f:
+        data = f.read()
+    sizes = {"raw": len(data)}
+    if os.path.splitext(path)[1] not in COMPRESSIBLE or len(data) < MIN_COMPRESS_BYTES:
+        return sizes
+
+    variants = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if HAS_BROTLI:
+        variants["br"] = brotli.compress(data, quality=11)
+    for encoding, suffix in ENCODINGS:
+        compressed = variants.get(encoding)
+        if compressed is not None and len(compressed) < len(data):
+            with open(path + suffix, "wb") as f:
+                f.write(compressed)
+            sizes[encoding] = len(compressed)
+    return sizes
+
+
+def _emit(dist_dir: str, name: str, content: bytes, manifest: Dict[str, str], sizes: Dict[str, Dict[str, int]]) -> str:
+    hashed = fingerprint(name, content)
+    path = os.path.join(dist_dir, hashed)
+    with open(path, "wb") as f:
+        f.write(content)
+    sizes[hashed] = precompress(path)
+    manifest[name] = f"/{STATIC_DIR}/{DIST}/{hashed}"
+    return manifest[name]
+
+
+def _extract_inline(html: str, stem: str, dist_dir: str, manifest: Dict[str, str],
+                    sizes: Dict[str, Dict[str, int]]) -> str:
+    counters = {"css": 0, "js": 0}
+
+    def replace(kind: str, tag: str):
+        def _replace(match: re.Match) -> str:
+            body = match.group(1)
+            # كتلة فيها Jinja تعتمد على بيانات الطلب - تبقى مضمّنة
+            if JINJA_SYNTAX.search(body):
+                return match.group(0)
+            counters[kind] += 1
+            suffix = "" if counters[kind] == 1 else f"-{counters[kind]}"
+            url = _emit(dist_dir, f"{stem}{suffix}.{kind}", body.strip().encode() + b"\n", manifest, sizes)
+            return tag.format(url=url)
+        return _replace
+
+    html = INLINE_STYLE.sub(replace("css", '<link rel="stylesheet" href="{url}">'), html)
+    return INLINE_SCRIPT.sub(replace("js", '<script src="{url}"></script>'), html)
+
+
+def build_assets(static_dir: str = STATIC_DIR, template_dir: str = TEMPLATE_DIR,
+                 templates: Iterable[str] = ASSET_TEMPLATES) -> Dict[str, Dict[str, int]]:
+    """يبني static/dist و templates/dist من جديد - يرجع الأحجام لكل ملف"""
+    dist_dir = os.path.join(static_dir, DIST)
+    template_dist = os.path.join(template_dir, DIST)
+    for directory in (dist_dir, template_dist):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    manifest: Dict[str, str] = {}
+    sizes: Dict[str, Dict[str, int]] = {}
+    for name in sorted(os.listdir(static_dir)):
+        path = os.path.join(static_dir, name)
+        if os.path.isfile(path) and name != SERVICE_WORKER and not name.endswith((".gz", ".br")):
+            with open(path, "rb") as f:
+                _emit(dist_dir, name, f.read(), manifest, sizes)
+
+    for name in templates:
+        with open(os.path.join(template_dir, name), encoding="utf-8") as f:
+            html = f.read()
+        html = _extract_inline(html, os.path.splitext(name)[0], dist_dir, manifest, sizes)
+        if "manifest.json" in manifest and 'rel="manifest"' not in html:
+            html = html.replace("</head>", f'    <link rel="manifest" href="{manifest["manifest.json"]}">\n</head>', 1)
+        with open(os.path.join(template_dist, name), "w", encoding="utf-8") as f:
+            f.write(html)
+
+    with open(os.path.join(dist_dir, "assets.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return sizes
+
+
+def built_template(name: str, template_dir: str = TEMPLATE_DIR) -> str:
+    """النسخة المبنية من القالب إن وُجدت (وإلا الأصلية كما هي)"""
+    built = f"{DIST}/{name}"
+    return built if os.path.exists(os.path.join(template_dir, built)) else name
+
+
+def asset_version(static_dir: str = STATIC_DIR) -> str:
+    """إصدار النشر: APP_VERSION أو صورة fly.io الحالية، وإلا hash للملفات المبنية"""
+    version = os.getenv("APP_VERSION") or os.getenv("FLY_IMAGE_REF")
+    if version:
+        return re.sub(r"[^\w.-]", "-", version)
+    digest = hashlib.sha256()
+    for path in (os.path.join(static_dir, DIST, "assets.json"), os.path.join(static_dir, SERVICE_WORKER)):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+_service_worker_cache: Dict[tuple, bytes] = {}
+
+
+def render_service_worker(static_dir: str = STATIC_DIR) -> bytes:
+    """sw.js مع رقم الإصدار وقائمة الـ precache (الصفحة + ملفاتها ذات البصمة)"""
+    paths = [os.path.join(static_dir, SERVICE_WORKER), os.path.join(static_dir, DIST, "assets.json")]
+    key = tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in paths)
+    if key not in _service_worker_cache:
+        with open(paths[0], encoding="utf-8") as f:
+            source = f.read()
+        precache = list(APP_SHELL)
+        if os.path.exists(paths[1]):
+            with open(paths[1]) as f:
+                precache += sorted(json.load(f).values())
+        source = source.replace("__BUILD_VERSION__", asset_version(static_dir))
+        source = source.replace("__PRECACHE_URLS__", json.dumps(precache))
+        _service_worker_cache.clear()
+        _service_worker_cache[key] = source.encode()
+    return _service_worker_cache[key]
+
+
+def service_worker_response(request: Request, static_dir: str = STATIC_DIR) -> Response:
+    """يُقدَّم من الجذر حتى يغطي نطاقه كل التطبيق، ويُتحقق منه في كل زيارة (no-cache)"""
+    body = render_service_worker(static_dir)
+    etag = make_etag(body)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Service-Worker-Allowed": "/"}
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/javascript", headers=headers)
+
+
+# ==================== التقديم ====================
+
+def accepted_encodings(header: str) -> set:
+    """Accept-Encoding -> الترميزات المقبولة (q=0 تعني مرفوض)"""
+    accepted = set()
+    for part in header.split(","):
+        token, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if token:
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles يقدّم .br/.gz المبنية مسبقاً، والملفات ذات البصمة بـ Cache-Control immutable"""
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        media_type = mimetypes.guess_type(str(full_path))[0] or "text/plain"
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+
+        content_encoding: Optional[str] = None
+        has_variants = False
+        for encoding, suffix in ENCODINGS:
+            try:
+                variant_stat = os.stat(f"{full_path}{suffix}")
+            except OSError:
+                continue
+            has_variants = True
+            if content_encoding is None and encoding in accepted:
+                content_encoding = encoding
+                variant_path, variant_result = f"{full_path}{suffix}", variant_stat
+
+        if content_encoding:
+            response = FileResponse(variant_path, status_code=status_code, stat_result=variant_result,
+                                    media_type=media_type)
+            response.headers["Content-Encoding"] = content_encoding
+        else:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result,
+                                    media_type=media_type)
+        if has_variants:
+            response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = IMMUTABLE if FINGERPRINTED.search(str(full_path)) else "no-cache"
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+if __name__ == '__main__':
+    sizes = build_assets()
+    total = {"raw": 0, "gzip": 0, "br": 0}
+    for name, size in sizes.items():
+        print(f"{name:40} raw={size['raw']:>7}  gzip={size.get('gzip', '-'):>7}  br={size.get('br', '-'):>7}")
+        for key in total:
+            total[key] += size.get(key, size["raw"])
+    print(f"{'total':40} raw={total['raw']:>7}  gzip={total['gzip']:>7}  br={total['br']:>7}"
+          + ("" if HAS_BROTLI else "  (brotli not installed)"))
@@ -0,0 +1,59 @@
+"""
+CSV Streaming - قراءة ملفات CSV المرفوعة على دفعات دون تحميلها كاملة في الذاكرة 📄
+"""
+import re
+import csv
+import codecs
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+CHUNK_SIZE = 64 * 1024
+# نهايات الأسطر في CSV فقط (str.splitlines تقطع أيضاً عند \x0b و \u2028 داخل الحقول)
+LINE = re.compile(r'[^\r\n]*(?:\r\n|\n|\r)|[^\r\n]+$')
+
+
+async def iter_csv_records(read: Callable[[int], Awaitable[bytes]],
+                           chunk_size: int = CHUNK_SIZE) -> AsyncIterator[Tuple[int, List[str]]]:
+    """(رقم السطر, الحقول) لكل سجل - read هي UploadFile.read أو ما يشبهها.
+    السجل قد يمتد على أكثر من سطر داخل حقل بين علامتي تنصيص: يُجمع حتى يتساوى عدد العلامات"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    record: List[str] = []
+    quotes = 0
+    line_no = 0
+    start_line = 1
+
+    while True:
+        chunk = await read(chunk_size)
+        text = pending + decoder.decode(chunk or b"", final=not chunk)
+        lines = LINE.findall(text)
+        # آخر سطر قد يكون ناقصاً (أو \r ينتظر \n في الدفعة التالية) - يُكمل مع الدفعة التالية
+        pending = lines.pop() if chunk and lines and not lines[-1].endswith("\n") else ""
+
+        for line in lines:
+            line_no += 1
+            if not record:
+                start_line = line_no
+            record.append(line)
+            quotes += line.count('"')
+            if quotes % 2:
+                continue
+            fields = next(csv.reader(["".join(record)]), [])
+            record, quotes = [], 0
+            if any(field.strip() for field in fields):
+                yield start_line, fields
+
+        if not chunk:
+            if record:
+                yield start_line, next(csv.reader(["".join(record)]), [])
+            return
+
+
+def map_header(header: List[str], aliases: Dict[str, Tuple[str, ...]]) -> Dict[str, int]:
+    """اسم الحقل -> رقم العمود، بمطابقة أسماء الأعمدة البديلة (بدون حساسية لحالة الأحرف)"""
+    normalized = [column.strip().lower() for column in header]
+    mapping: Dict[str, int] = {}
+    for field, names in aliases.items():
+        index: Optional[int] = next((normalized.index(name) for name in names if name in normalized), None)
+        if index is not None:
+            mapping[field] = index
+    return mapping
@@ -0,0 +1,192 @@
+"""
+Database Engine - إعداد محرك SQLAlchemy غير المتزامن 🗄️
+SQLite: وضع WAL حتى لا تحجب الكتابة (إضافة عميل) قراءات لوحة التحكم، مع busy_timeout
+و synchronous=NORMAL و cache أكبر تُطبّق على كل اتصال جديد.
+PostgreSQL: نفس DATABASE_URL بصيغة postgresql:// يتحول لـ asyncpg مع pool مقسّم على الـ workers
+"""
+import os
+import logging
+from typing import Dict, Any
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url, URL
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+try:
+    import asyncpg  # noqa: F401
+    HAS_ASYNCPG = True
+except ImportError:
+    HAS_ASYNCPG = False
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATABASE_URL = "sqlite+aiosqlite:///./brilliox.db"
+# عدد عمليات uvicorn/gunicorn - كل عملية لها pool خاص بها
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# أقصى اتصالات يسمح بها خادم PostgreSQL لهذا التطبيق (مجموع كل الـ workers)
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "20000"))
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+    # NORMAL آمن مع WAL: قد تضيع آخر معاملة عند انقطاع الكهرباء لكن القاعدة لا تتلف
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA cache_size=-{SQLITE_CACHE_KB}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+
+def normalize_database_url(url: str) -> URL:
+    """postgres:// و postgresql:// -> asyncpg، و sqlite:// -> aiosqlite"""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend == "postgres":
+        parsed = parsed.set(drivername="postgresql")
+        backend = "postgresql"
+    if backend == "postgresql" and parsed.get_driver_name() != "asyncpg":
+        parsed = parsed.set(drivername="postgresql+asyncpg")
+    elif backend == "sqlite" and parsed.get_driver_name() != "aiosqlite":
+        parsed = parsed.set(drivername="sqlite+aiosqlite")
+    return parsed
+
+
+def engine_options(url: URL) -> Dict[str, Any]:
+    """إعدادات الـ pool والـ statement cache حسب نوع القاعدة"""
+    options: Dict[str, Any] = {
+        "echo": False,
+        # cache للـ SQL المُجمّع داخل SQLAlchemy (مشترك بين الاتصالات)
+        "query_cache_size": DB_STATEMENT_CACHE_SIZE,
+    }
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            return options
+        # aiosqlite يستخدم NullPool افتراضياً (اتصال جديد + pragmas لكل طلب)
+        # كاتب واحد فقط في SQLite: الاتصالات الإضافية تفيد القراءات المتزامنة مع WAL
+        options.update(
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+            pool_timeout=DB_POOL_TIMEOUT,
+            connect_args={"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+                          "cached_statements": DB_STATEMENT_CACHE_SIZE},
+        )
+        return options
+
+    per_worker = max(2, DB_MAX_CONNECTIONS // max(WEB_CONCURRENCY, 1))
+    pool_size = int(os.getenv("DB_POOL_SIZE", str(max(1, per_worker * 3 // 4))))
+    options.update(
+        pool_size=pool_size,
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", str(max(0, per_worker - pool_size)))),
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=True,
+        # إعادة فتح الاتصالات القديمة قبل أن يغلقها الخادم أو الـ load balancer
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    )
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {"statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    return options
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def create_engine_from_url(url: str = None) -> AsyncEngine:
+    """المحرك المستخدم في main.py - DATABASE_URL من البيئة افتراضياً"""
+    parsed = normalize_database_url(url or os.getenv("DATABASE_URL", DEFAULT_DATABASE_URL))
+    if parsed.get_driver_name() == "asyncpg" and not HAS_ASYNCPG:
+        raise RuntimeError("DATABASE_URL points at PostgreSQL but asyncpg is not installed (pip install asyncpg)")
+
+    engine = create_async_engine(parsed, **engine_options(parsed))
+    if parsed.get_backend_name() == "sqlite":
+        event.listen(engine.sync_engine, "connect", _apply_sqlite_pragmas)
+    logger.info(f"Database engine: {parsed.get_backend_name()}+{parsed.get_driver_name()} "
+                f"(pool={engine.pool.__class__.__name__})")
+    return engine
+
+
+if __name__ == '__main__':
+    # p95 لاستعلام لوحة التحكم أثناء إضافة عملاء متزامنة: الإعدادات الافتراضية مقابل المضبوطة
+    import json
+    import time
+    import random
+    import asyncio
+    import tempfile
+    from datetime import datetime
+    from sqlalchemy import text
+
+    from app.core.metrics import LatencyStats
+
+    SCHEMA = ("CREATE TABLE contacts (id INTEGER PRIMARY KEY, name TEXT NOT NULL, phone TEXT, email TEXT, "
+              "status TEXT, ai_notes TEXT, created_at DATETIME)")
+    DASHBOARD = ("SELECT (SELECT count(id) FROM contacts), "
+                 "(SELECT group_concat(name) FROM (SELECT name FROM contacts ORDER BY created_at DESC LIMIT 5))")
+
+    async def scenario(engine: AsyncEngine, seconds: float = 4.0) -> Dict[str, Any]:
+        async with engine.begin() as conn:
+            await conn.execute(text(SCHEMA))
+            await conn.execute(
+                text("INSERT INTO contacts (name, phone, created_at) VALUES (:name, :phone, :created_at)"),
+                [{"name": f"seed {i}", "phone": f"+2010{i:08d}", "created_at": datetime.utcnow()} for i in range(20000)]
+            )
+
+        reads, writes = LatencyStats(window=100000), LatencyStats(window=100000)
+        errors = {"read": 0, "write": 0}
+        deadline = time.perf_counter() + seconds
+        rng = random.Random(5)
+
+        async def writer():
+            while time.perf_counter() < deadline:
+                try:
+                    with writes.measure():
+                        async with engine.begin() as conn:
+                            await conn.execute(
+                                text("INSERT INTO contacts (name, phone, email, created_at) VALUES (:n, :p, :e, :c)"),
+                                {"n": f"lead {rng.random()}", "p": "+201000000000", "e": "x@example.com",
+                                 "c": datetime.utcnow()}
+                            )
+                except Exception:
+                    errors["write"] += 1
+
+        async def reader():
+            while time.perf_counter() < deadline:
+                try:
+                    with reads.measure():
+                        async with engine.connect() as conn:
+                            await conn.execute(text(DASHBOARD))
+                except Exception:
+                    errors["read"] += 1
+
+        await asyncio.gather(*[writer() for _ in range(4)], *[reader() for _ in range(8)])
+        await engine.dispose()
+        return {"dashboard": reads.snapshot(), "insert": writes.snapshot(), "errors": errors}
+
+    async def main():
+        results = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            results["default"] = await scenario(create_async_engine(f"sqlite+aiosqlite:///{tmp}/default.db"))
+            results["tuned"] = await scenario(create_engine_from_url(f"sqlite:///{tmp}/tuned.db"))
+        print(json.dumps({
+            name: {"dashboard_p95_ms": r["dashboard"]["p95_ms"], "dashboard_reads": r["dashboard"]["count"],
+                   "insert_p95_ms": r["insert"]["p95_ms"], "inserts": r["insert"]["count"], "errors": r["errors"]}
+            for name, r in results.items()
+        }, indent=2))
+        print(normalize_database_url("postgres://u:p@db:5432/brilliox").render_as_string(hide_password=True),
+              engine_options(normalize_database_url("postgresql://db/brilliox")))
+
+        default, tuned = results["default"], results["tuned"]
+        # WAL: القراءة لا تنتظر الكتابة، و busy_timeout: الكتابات المتزامنة تنتظر دورها بدل "database is locked"
+        assert tuned["dashboard"]["p95_ms"] < default["dashboard"]["p95_ms"], (tuned["dashboard"], default["dashboard"])
+        assert tuned["errors"] == {"read": 0, "write": 0}, tuned["errors"]
+        assert tuned["insert"]["count"] > 0 and tuned["dashboard"]["count"] > 0
+
+    asyncio.run(main())
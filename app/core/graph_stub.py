@@ -0,0 +1,248 @@
+"""
+Graph API Stub - خادم HTTP محلي بسيط يحاكي Graph API لقياس الأداء 🧪
+يدعم keep-alive حتى يمكن مقارنة الاتصالات المشتركة بالاتصالات الجديدة
+"""
+import re
+import json
+import random
+import asyncio
+import itertools
+from datetime import date, timedelta
+from urllib.parse import urlsplit, parse_qs, parse_qsl
+from typing import Callable, Dict, Any, Tuple, Optional
+
+# handler(method, path, query, body) -> (status, json_body)
+Handler = Callable[[str, str, Dict[str, list], Any], Tuple[int, Dict[str, Any]]]
+
+
+_message_ids = itertools.count(1)
+
+
+def default_handler(method: str, path: str, query: Dict[str, list], body: Any) -> Tuple[int, Dict[str, Any]]:
+    """رد افتراضي يشبه رد إرسال رسالة WhatsApp"""
+    return 200, {'messaging_product': 'whatsapp', 'messages': [{'id': f'wamid.stub{next(_message_ids)}'}]}
+
+
+class FakeGraphAPI:
+    """
+    Graph API مبسط في الذاكرة: صور ومنشورات وترويج، وطلبات Batch
+    مع مراجع {result=<name>:$.<field>} بين العمليات كما في Graph الحقيقي،
+    وإحصائيات يومية (insights) للحملات مع التقسيم على الصفحات
+    """
+
+    REFERENCE = re.compile(r'\{result=(\w+):\$\.(\w+)\}')
+    EDGES = ('photos', 'feed', 'promotions', 'ads', 'adsets', 'campaigns')
+    # الكائن الأب الذي يجب أن يكون موجوداً قبل إنشاء المجموعة/الإعلان
+    PARENT_FIELDS = {'adsets': 'campaign_id', 'ads': 'adset_id'}
+
+    def __init__(self):
+        self.objects: Dict[str, Dict[str, Any]] = {}
+        self.calls = []
+        self._ids = itertools.count(1000)
+        # campaign_id -> صفوف يومية لكل مجموعة إعلانية
+        self.insights: Dict[str, list] = {}
+        # edge -> نسبة الأخطاء المؤقتة (500) لاختبار إعادة المحاولة
+        self.error_rates: Dict[str, float] = {}
+        self._rng = random.Random(0)
+
+    def add_campaign(self, account_id: str, campaign_id: str, name: str = '', adsets: int = 2,
+                     days: int = 60, today: Optional[date] = None, seed: int = 0):
+        """حملة تجريبية بإحصائيات يومية ثابتة (نفس seed = نفس الأرقام)"""
+        today = today or date.today()
+        rng = random.Random(f"{campaign_id}:{seed}")
+        self.objects[campaign_id] = {'edge': 'campaigns', 'parent': f"act_{account_id}", 'name': name or campaign_id,
+                                     'status': 'ACTIVE'}
+        rows = []
+        for a in range(adsets):
+            adset_id = f"{campaign_id}{a:02d}"
+            ctr, cvr, cpm = rng.uniform(0.008, 0.03), rng.uniform(0.02, 0.12), rng.uniform(0.8, 4.0)
+            for d in range(days):
+                impressions = rng.randint(2000, 20000)
+                clicks = int(impressions * ctr * rng.uniform(0.7, 1.3))
+                rows.append({
+                    'date_start': (today - timedelta(days=days - 1 - d)).isoformat(),
+                    'campaign_id': campaign_id,
+                    'adset_id': adset_id,
+                    'adset_name': f"{name or campaign_id} / {a + 1}",
+                    'impressions': impressions,
+                    'reach': int(impressions * rng.uniform(0.6, 0.9)),
+                    'clicks': clicks,
+                    'spend': round(impressions / 1000 * cpm, 2),
+                    'leads': int(clicks * cvr),
+                    'purchases': int(clicks * cvr * 0.3),
+                })
+        self.insights[campaign_id] = rows
+
+    def __call__(self, method: str, path: str, query: Dict[str, list], body: Any) -> Tuple[int, Dict[str, Any]]:
+        params = {k: v[0] for k, v in query.items()}
+        if isinstance(body, dict):
+            params.update(body)
+        if path.strip('/') in ('', 'v18.0') and 'batch' in params:
+            return 200, self._batch(json.loads(params['batch']))
+        return self.dispatch(method, path, params)
+
+    def dispatch(self, method: str, path: str, params: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        self.calls.append((method, path))
+        parts = path.strip('/').split('/')
+        if method == 'POST' and len(parts) == 2 and parts[1] in self.EDGES:
+            parent, edge = parts
+            if edge == 'photos' and not str(params.get('url', '')).startswith('http'):
+                return 400, {'error': {'message': '(#324) Invalid image url', 'code': 324}}
+            if edge == 'promotions' and parent not in self.objects:
+                return 400, {'error': {'message': f'Unknown post {parent}', 'code': 100}}
+            if self._rng.random() < self.error_rates.get(edge, 0.0):
+                return 500, {'error': {'message': 'An unexpected error has occurred. Please retry.', 'code': 2,
+                                       'is_transient': True}}
+            parent_field = self.PARENT_FIELDS.get(edge)
+            if parent_field and params.get(parent_field) not in self.objects:
+                return 400, {'error': {'message': f'Invalid parameter {parent_field}', 'code': 100}}
+            object_id = f"{parent}_{next(self._ids)}"
+            self.objects[object_id] = {'edge': edge, 'parent': parent, **params}
+            return 200, {'id': object_id}
+        if method == 'GET' and len(parts) == 1 and parts[0] in self.objects:
+            return 200, {'id': parts[0], **self.objects[parts[0]]}
+        if method == 'GET' and len(parts) == 2 and parts[1] == 'insights' and parts[0] in self.insights:
+            return 200, self._page(self._insights(parts[0], params), params)
+        if method == 'GET' and len(parts) == 2 and parts[1] in self.EDGES:
+            children = [{'id': object_id, **{k: v for k, v in obj.items() if k not in ('edge', 'parent')}}
+                        for object_id, obj in self.objects.items()
+                        if obj['parent'] == parts[0] and obj['edge'] == parts[1]]
+            return 200, self._page(children, params)
+        return 404, {'error': {'message': f'Unsupported request {method} {path}', 'code': 803}}
+
+    def _insights(self, campaign_id: str, params: Dict[str, Any]) -> list:
+        time_range = json.loads(params.get('time_range') or '{}')
+        since, until = time_range.get('since', '0000-00-00'), time_range.get('until', '9999-99-99')
+        rows = [r for r in self.insights[campaign_id] if since <= r['date_start'] <= until]
+        if params.get('level') == 'campaign':
+            # المستوى الأعلى = مجموع المجموعات لكل يوم
+            daily: Dict[str, dict] = {}
+            for r in rows:
+                day = daily.setdefault(r['date_start'], {'date_start': r['date_start'], 'campaign_id': campaign_id})
+                for key in ('impressions', 'reach', 'clicks', 'spend', 'leads', 'purchases'):
+                    day[key] = round(day.get(key, 0) + r[key], 2)
+            rows = list(daily.values())
+        return [self._insight_row(r) for r in sorted(rows, key=lambda r: (r['date_start'], r.get('adset_id', '')))]
+
+    @staticmethod
+    def _insight_row(r: Dict[str, Any]) -> Dict[str, Any]:
+        # Graph يرجع الأرقام كنصوص والتحويلات داخل actions
+        row = {k: str(v) for k, v in r.items() if k not in ('leads', 'purchases')}
+        row['date_stop'] = r['date_start']
+        row['actions'] = [{'action_type': 'lead', 'value': str(r['leads'])},
+                          {'action_type': 'offsite_conversion.fb_pixel_purchase', 'value': str(r['purchases'])}]
+        return row
+
+    @staticmethod
+    def _page(rows: list, params: Dict[str, Any]) -> Dict[str, Any]:
+        limit, offset = int(params.get('limit', 25)), int(params.get('after', 0))
+        page = {'data': rows[offset:offset + limit]}
+        if offset + limit < len(rows):
+            page['paging'] = {'cursors': {'after': str(offset + limit)}, 'next': f"?after={offset + limit}"}
+        return page
+
+    def _batch(self, operations: list) -> list:
+        results, named = [], {}
+
+        def resolve(text: str) -> Optional[str]:
+            missing = [m.group(1) for m in self.REFERENCE.finditer(text) if m.group(1) not in named]
+            if missing:
+                return None
+            return self.REFERENCE.sub(lambda m: str(named[m.group(1)].get(m.group(2), '')), text)
+
+        for op in operations:
+            url, body = resolve(op['relative_url']), resolve(op.get('body', ''))
+            if url is None or body is None:
+                results.append(None)
+                continue
+            path, _, query = url.partition('?')
+            params = {**dict(parse_qsl(query)), **dict(parse_qsl(body))}
+            status, payload = self.dispatch(op['method'], '/' + path, params)
+            if op.get('name') and status == 200:
+                named[op['name']] = payload
+            results.append({'code': status, 'body': json.dumps(payload)})
+        return results
+
+
+class GraphStubServer:
+    """خادم HTTP/1.1 محلي مع زمن استجابة اختياري"""
+
+    def __init__(self, handler: Optional[Handler] = None, latency_ms: float = 0.0, host: str = '127.0.0.1'):
+        self.handler = handler or default_handler
+        self.latency_ms = latency_ms
+        self.host = host
+        self.port = None
+        self.requests = 0
+        self.connections = 0
+        self._server = None
+        self._writers = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> 'GraphStubServer':
+        self._server = await asyncio.start_server(self._serve, self.host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            await asyncio.sleep(0)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                raw = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                body: Any = raw.decode() if raw else None
+                if raw and 'json' in headers.get('content-type', ''):
+                    body = json.loads(raw)
+                elif raw and 'form' in headers.get('content-type', ''):
+                    body = {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+
+                url = urlsplit(target)
+                if self.latency_ms:
+                    await asyncio.sleep(self.latency_ms / 1000)
+                result = self.handler(method, url.path, parse_qs(url.query), body)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                status, payload = result
+                self.requests += 1
+
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\nConnection: keep-alive\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
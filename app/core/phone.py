@@ -0,0 +1,56 @@
+"""
+Phone Normalization - توحيد أرقام الهواتف بصيغة E.164 📞
+نفس الصيغة تُستخدم عند حفظ العميل وعند البحث برقم WhatsApp الوارد
+"""
+import os
+from typing import Optional
+
+# كود الدولة الافتراضي للأرقام المحلية (بدون +)
+DEFAULT_COUNTRY_CODE = os.getenv('PHONE_DEFAULT_COUNTRY_CODE', '20')
+
+# طول الرقم الوطني (بدون صفر الخط المحلي) لكل دولة - لتمييز الرقم المحلي عن الدولي
+NATIONAL_NUMBER_LENGTHS = {
+    '20': 10,   # مصر
+    '966': 9,   # السعودية
+    '971': 9,   # الإمارات
+    '965': 8,   # الكويت
+    '974': 8,   # قطر
+    '973': 8,   # البحرين
+    '968': 8,   # عمان
+    '962': 9,   # الأردن
+    '961': 8,   # لبنان
+    '212': 9,   # المغرب
+}
+
+
+def to_e164(phone: Optional[str], default_country_code: Optional[str] = None) -> Optional[str]:
+    """تحويل الرقم إلى صيغة E.164 (+201001234567) - None إذا لم يكن رقماً صالحاً"""
+    if not phone:
+        return None
+    raw = str(phone).strip()
+    digits = ''.join(filter(str.isdigit, raw))
+    if not digits:
+        return None
+    country_code = default_country_code or DEFAULT_COUNTRY_CODE
+
+    if raw.startswith('+'):
+        number = digits
+    elif digits.startswith('00'):
+        number = digits[2:]
+    elif digits.startswith('0'):
+        number = country_code + digits[1:]
+    elif len(digits) == NATIONAL_NUMBER_LENGTHS.get(country_code):
+        number = country_code + digits
+    else:
+        # مثل رقم WhatsApp الوارد: دولي بدون +
+        number = digits
+
+    if not 8 <= len(number) <= 15:
+        return None
+    return '+' + number
+
+
+def normalize_phone(phone: Optional[str], default_country_code: Optional[str] = None) -> Optional[str]:
+    """الصيغة التي يطلبها WhatsApp Cloud API: E.164 بدون +"""
+    e164 = to_e164(phone, default_country_code)
+    return e164[1:] if e164 else None
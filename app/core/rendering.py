@@ -0,0 +1,164 @@
+"""
+Template Rendering - cache لصفحات Jinja2 وأجزائها 🖼️
+- bytecode cache دائم على القرص: القوالب لا يُعاد تحليلها بعد إعادة التشغيل
+- الصفحات الثابتة تُرسم مرة واحدة وتُرسل مع ETag/Last-Modified (304 إن لم تتغير)
+- الأجزاء الديناميكية (عدد العملاء، آخر العملاء) تُحفظ لفترة قصيرة وتُلغى عند الكتابة
+- زمن الرسم لكل قالب
+"""
+import os
+import time
+import hashlib
+import logging
+from collections import OrderedDict, defaultdict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import HTMLResponse, Response
+from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.types import Message, Receive, Scope, Send
+
+from app.core.metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", os.path.join(".cache", "jinja"))
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[float] = None) -> bool:
+    """If-None-Match له الأولوية على If-Modified-Since (RFC 9110)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in candidates or etag in candidates
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def conditional_response(request: Request, body: bytes, etag: Optional[str] = None,
+                         last_modified: Optional[float] = None) -> Response:
+    """HTMLResponse أو 304 - no-cache: المتصفح يحتفظ بالنسخة لكن يتحقق منها في كل مرة"""
+    etag = etag or make_etag(body)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(body, headers=headers)
+
+
+class BufferedGZipResponder(GZipResponder):
+    """يضغط الاستجابات ذات الجسم الواحد فقط - الاستجابات المتدفقة (NDJSON للتقدم مثلاً)
+    تمر كما هي، لأن GZipResponder لا يرسل شيئاً قبل نهاية التدفق"""
+
+    async def send_with_gzip(self, message: Message) -> None:
+        if message["type"] == "http.response.body" and not self.started and message.get("more_body", False):
+            self.content_encoding_set = True
+        await super().send_with_gzip(message)
+
+
+class BufferedGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware للصفحات و JSON دون التأثير على الـ streaming"""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = BufferedGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+class TemplateRenderer:
+    """Jinja2Templates مع bytecode cache وقياس زمن الرسم وcache للصفحات الثابتة"""
+
+    def __init__(self, directory: str, cache_dir: str = TEMPLATE_CACHE_DIR):
+        self.templates = Jinja2Templates(directory=directory)
+        self.env = self.templates.env
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        except OSError as e:
+            # نظام ملفات للقراءة فقط: يعمل بدون cache دائم
+            logger.warning(f"Template bytecode cache disabled: {e}")
+        self.render_time: Dict[str, LatencyStats] = defaultdict(LatencyStats)
+        # اسم القالب -> (كائن القالب, المحتوى, ETag, وقت التعديل)
+        self._pages: Dict[str, Tuple[Any, bytes, str, float]] = {}
+
+    def precompile(self) -> int:
+        """تحميل كل القوالب عند بدء التشغيل (يملأ الـ bytecode cache إن لم يكن موجوداً)"""
+        names = self.env.list_templates(extensions=["html"])
+        for name in names:
+            self.env.get_template(name)
+        return len(names)
+
+    def render(self, name: str, context: Optional[Dict[str, Any]] = None) -> str:
+        template = self.env.get_template(name)
+        with self.render_time[name].measure():
+            return template.render(context or {})
+
+    def page(self, request: Request, name: str) -> Response:
+        """صفحة لا تعتمد على بيانات الطلب: تُرسم مرة واحدة حتى يتغير ملف القالب"""
+        # auto_reload يرجع كائن قالب جديد إذا تغير الملف على القرص
+        template = self.env.get_template(name)
+        cached = self._pages.get(name)
+        if cached is None or cached[0] is not template:
+            body = self.render(name).encode()
+            modified = os.path.getmtime(template.filename) if template.filename else time.time()
+            cached = self._pages[name] = (template, body, make_etag(body), modified)
+        _, body, etag, modified = cached
+        return conditional_response(request, body, etag, modified)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {name: stats.snapshot() for name, stats in self.render_time.items()}
+
+
+class FragmentCache:
+    """قيم أو HTML مرسوم لمدة قصيرة، مع وسوم (tags) لإلغاء كل ما يعتمد على بيانات معينة"""
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Tuple[str, ...], Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_set(self, key: str, ttl: float, produce: Callable[[], Awaitable[Any]],
+                         tags: Iterable[str] = ()) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[2]
+
+        self.misses += 1
+        value = await produce()
+        self._entries[key] = (time.monotonic() + ttl, tuple(tags), value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, tag: str) -> int:
+        keys = [key for key, (_, tags, _) in self._entries.items() if tag in tags]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,254 @@
+"""
+Security - تشفير كلمات المرور والتحقق من التوكنات 🔐
+bcrypt يستهلك ~250ms من المعالج لكل عملية: تنفيذه داخل async def يجمّد كل الطلبات الأخرى.
+هنا يعمل في thread pool (مكتبة bcrypt تحرر الـ GIL) بحد أقصى للتزامن وطابور محدود،
+مع قياس زمن الانتظار والتنفيذ وترقية الـ hash تلقائياً عند تسجيل الدخول.
+التوكنات التي تم التحقق منها تُحفظ في cache محدود حتى لا يُعاد فك التوقيع في كل طلب
+"""
+import os
+import time
+import math
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple
+
+from jose import JWTError, jwt
+from passlib.context import CryptContext
+
+from app.core.metrics import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# طلبات تنتظر دورها فوق عدد الـ workers - ما زاد عنها يُرفض فوراً بدل تراكم الطابور
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "64"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+
+# min_rounds: أي hash أضعف من الإعداد الحالي (أو بمعرّف قديم مثل 2a) يحتاج ترقية
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+)
+
+
+class PasswordHasherBusy(Exception):
+    """الطابور ممتلئ - يجب على العميل إعادة المحاولة"""
+
+
+class PasswordHasher:
+    """تنفيذ bcrypt في thread pool محدود مع مقاييس الطابور"""
+
+    def __init__(self, context: CryptContext = pwd_context, workers: int = PASSWORD_HASH_WORKERS,
+                 max_queue: int = PASSWORD_HASH_QUEUE):
+        self.context = context
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._waiting = 0
+        self.rejected = 0
+        self.upgraded = 0
+        self.queue_time = LatencyStats()
+        self.run_time = LatencyStats()
+
+    async def _run(self, fn, *args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        if self._waiting >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise PasswordHasherBusy("password hashing queue is full")
+
+        self._waiting += 1
+        queued = time.perf_counter()
+        try:
+            async with self._slots:
+                started = time.perf_counter()
+                self.queue_time.record((started - queued) * 1000)
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(self._executor, fn, *args)
+                self.run_time.record((time.perf_counter() - started) * 1000)
+                return result
+        finally:
+            self._waiting -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """(صحيحة؟, hash جديد إن كانت إعدادات الـ hash القديم أضعف من الحالية)"""
+        try:
+            valid, new_hash = await self._run(self.context.verify_and_update, password, hashed)
+        except ValueError:
+            # hash تالف أو بصيغة غير معروفة
+            logger.warning("Unrecognized password hash format")
+            return False, None
+        if valid and new_hash:
+            self.upgraded += 1
+        return valid, new_hash
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'workers': self.workers,
+            'rounds': BCRYPT_ROUNDS,
+            'in_flight': self._waiting,
+            'rejected': self.rejected,
+            'upgraded': self.upgraded,
+            'queue': self.queue_time.snapshot(),
+            'run': self.run_time.snapshot(),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+password_hasher = PasswordHasher()
+
+
+class TokenVerifier:
+    """cache للتوكنات الصحيحة (مفتاحه digest التوكن) + قائمة إلغاء - الاثنان O(1)
+    قائمة الإلغاء في الذاكرة فقط: تُفقد عند إعادة التشغيل وغير مشتركة بين الـ workers"""
+
+    def __init__(self, secret_key: str, algorithm: str = "HS256", max_entries: int = TOKEN_CACHE_SIZE):
+        self.secret_key = secret_key
+        self.algorithm = algorithm
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[bytes, Tuple[Optional[str], float]]" = OrderedDict()
+        self._revoked: Dict[bytes, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.latency = LatencyStats()
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    def verify(self, token: str) -> Optional[str]:
+        """صاحب التوكن (sub) أو None إن كان غير صالح أو منتهي أو ملغى"""
+        started = time.perf_counter()
+        try:
+            return self._verify(token, time.time())
+        finally:
+            self.latency.record((time.perf_counter() - started) * 1000)
+
+    def _verify(self, token: str, now: float) -> Optional[str]:
+        key = self._digest(token)
+        if key in self._revoked:
+            return None
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            subject, expires = cached
+            if expires > now:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return subject
+            del self._cache[key]
+
+        self.misses += 1
+        try:
+            payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+        except JWTError:
+            return None
+        subject = payload.get("sub")
+        self._cache[key] = (subject, float(payload.get("exp", math.inf)))
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return subject
+
+    def revoke(self, token: str):
+        """إلغاء التوكن (عند تسجيل الخروج) حتى انتهاء صلاحيته"""
+        now = time.time()
+        # توكن مزوّر أو منتهي لا يدخل القائمة - حتى لا تنمو بلا حد من طلبات logout عشوائية
+        if self._verify(token, now) is None:
+            return
+        key = self._digest(token)
+        expires = self._cache.pop(key)[1]
+        # تنظيف الإلغاءات المنتهية - التوكن المنتهي مرفوض أصلاً
+        for revoked_key in [k for k, exp in self._revoked.items() if exp <= now]:
+            del self._revoked[revoked_key]
+        self._revoked[key] = expires
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'cached': len(self._cache),
+            'revoked': len(self._revoked),
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'latency': self.latency.snapshot(),
+        }
+
+
+if __name__ == '__main__':
+    # عاصفة دخول: 40 عملية verify متزامنة بينما endpoint آخر يُستدعى كل 10ms
+    import json
+
+    hashed = pwd_context.hash("admin123")
+    # hash قديم بـ rounds أقل يُرقّى عند أول دخول ناجح
+    legacy = pwd_context.hash("admin123", rounds=BCRYPT_ROUNDS - 2)
+
+    async def unrelated_endpoint(stats: LatencyStats, stop: asyncio.Event):
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            stats.record((time.perf_counter() - started - 0.01) * 1000)
+
+    async def storm(verify) -> Dict[str, Any]:
+        lag, stop = LatencyStats(), asyncio.Event()
+        pinger = asyncio.create_task(unrelated_endpoint(lag, stop))
+        await asyncio.sleep(0.05)
+        started = time.perf_counter()
+        await asyncio.gather(*(verify("admin123", hashed) for _ in range(40)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await pinger
+        return {'storm_s': round(elapsed, 2), 'unrelated_p99_ms': lag.snapshot()['p99_ms'],
+                'unrelated_max_ms': lag.snapshot()['max_ms']}
+
+    async def inline_verify(password, hashed_password):
+        return pwd_context.verify(password, hashed_password)
+
+    def token_benchmark() -> Dict[str, Any]:
+        verifier = TokenVerifier("bench-secret")
+        token = jwt.encode({"sub": "admin", "exp": time.time() + 3600}, "bench-secret", algorithm="HS256")
+        results = {}
+        for label, fn in (('decode_us', lambda: jwt.decode(token, "bench-secret", algorithms=["HS256"])),
+                          ('cached_us', lambda: verifier.verify(token))):
+            started = time.perf_counter()
+            for _ in range(20000):
+                fn()
+            results[label] = round((time.perf_counter() - started) * 1e6 / 20000, 2)
+        verifier.revoke(token)
+        results['revoked_rejected'] = verifier.verify(token) is None
+        return results
+
+    async def main():
+        tokens = token_benchmark()
+        hasher = PasswordHasher()
+        inline = await storm(inline_verify)
+        pooled = await storm(hasher.verify)
+        valid, upgraded = await hasher.verify("admin123", legacy)
+        legacy_upgraded = bool(valid and upgraded and pwd_context.identify(upgraded) == 'bcrypt'
+                               and not pwd_context.needs_update(upgraded))
+        wrong_rejected = not (await hasher.verify("wrong-password", hashed))[0]
+        print(json.dumps({
+            'tokens': tokens,
+            'inline': inline,
+            'pooled': pooled,
+            'legacy_upgraded': legacy_upgraded,
+            'stats': hasher.get_stats(),
+        }, indent=2))
+        hasher.shutdown()
+
+        # bcrypt في الـ event loop يجمّد الطلبات الأخرى لزمن العاصفة كله تقريباً، وفي الـ pool لا
+        assert pooled['unrelated_p99_ms'] * 5 < inline['unrelated_p99_ms'], (pooled, inline)
+        assert legacy_upgraded and pwd_context.verify("admin123", upgraded)
+        assert wrong_rejected
+        assert tokens['revoked_rejected'] and tokens['cached_us'] < tokens['decode_us'], tokens
+
+    asyncio.run(main())
@@ -164,25 +164,22 @@ class DashboardStats(BaseModel):
     leads_by_status: Dict[str, int] = {}
 
 
+# حدود تصنيف الجودة (تُستخدم أيضاً في محرك التقييم)
+HOT_SCORE_THRESHOLD = 4.0
+WARM_SCORE_THRESHOLD = 2.5
+
+
 def calculate_lead_score(lead: Lead, interactions: List[Interaction]) -> float:
-    """حساب نقاط العميل"""
-    score = 0.0
-    if lead.name and lead.phone:
-        score += 1.0
-    if lead.email:
-        score += 0.5
-    if lead.company:
-        score += 0.3
-    if interactions:
-        score += min(len(interactions) * 0.2, 1.0)
-    return min(round(score, 1), 5.0)
+    """حساب نقاط العميل (عبر محرك التقييم الموحد)"""
+    from app.services.lead_scoring import scoring_engine
+    return scoring_engine.score_one(lead.dict(), interaction_count=len(interactions or []))
 
 
 def get_lead_quality(score: float) -> LeadQuality:
     """تحديد جودة العميل"""
-    if score >= 4.0:
+    if score >= HOT_SCORE_THRESHOLD:
         return LeadQuality.HOT
-    elif score >= 2.5:
+    elif score >= WARM_SCORE_THRESHOLD:
         return LeadQuality.WARM
     else:
         return LeadQuality.COLD
@@ -0,0 +1,308 @@
+"""
+Ad Insights - سحب أداء الحملات تدريجياً وتخزينه محلياً 📊
+كل حملة لها علامة آخر يوم تم سحبه؛ كل مزامنة تسحب من تلك العلامة (مع أيام مراجعة
+لأن Facebook يعدّل أرقام الأيام الأخيرة) وتكتب صفاً واحداً لكل (حملة/مجموعة، يوم)
+"""
+import os
+import json
+import sqlite3
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+from app.services.graph_client import GraphClient, GraphAPIError
+
+logger = logging.getLogger(__name__)
+
+INSIGHT_FIELDS = 'campaign_id,adset_id,adset_name,impressions,reach,clicks,spend,actions'
+LEAD_ACTIONS = {'lead', 'onsite_conversion.lead_grouped', 'offsite_conversion.fb_pixel_lead'}
+CONVERSION_ACTIONS = {'purchase', 'omni_purchase', 'offsite_conversion.fb_pixel_purchase'}
+METRICS = ('impressions', 'reach', 'clicks', 'spend', 'leads', 'conversions')
+ROLLUP_PERIODS = {'day': '%Y-%m-%d', 'week': '%Y-W%W', 'month': '%Y-%m'}
+
+
+class AdInsightsService:
+    """مزامنة insights من Graph إلى جدول يومي محلي وقراءة الأداء منه"""
+
+    JOB_NAME = 'ad_insights'
+
+    def __init__(self, db_path: str, graph: Optional[GraphClient] = None, account_id: Optional[str] = None):
+        self.db_path = db_path
+        self.account_id = account_id or os.getenv('FACEBOOK_AD_ACCOUNT_ID')
+        access_token = os.getenv('FACEBOOK_ACCESS_TOKEN')
+        self.graph = graph or (GraphClient(access_token) if access_token else None)
+        self.backfill_days = int(os.getenv('INSIGHTS_BACKFILL_DAYS', '30'))
+        self.lookback_days = int(os.getenv('INSIGHTS_LOOKBACK_DAYS', '3'))
+        self.campaigns_per_batch = 25  # عمليتان لكل حملة = 50 (حد Graph Batch)
+        self.page_size = 500
+        self._init_tables()
+
+    def _init_tables(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS ad_campaigns (
+                id TEXT PRIMARY KEY,
+                account_id TEXT,
+                name TEXT,
+                status TEXT,
+                updated_at TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS ad_insights (
+                level TEXT NOT NULL,
+                object_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                campaign_id TEXT NOT NULL,
+                name TEXT,
+                impressions INTEGER NOT NULL DEFAULT 0,
+                reach INTEGER NOT NULL DEFAULT 0,
+                clicks INTEGER NOT NULL DEFAULT 0,
+                spend REAL NOT NULL DEFAULT 0,
+                leads INTEGER NOT NULL DEFAULT 0,
+                conversions INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (level, object_id, day)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_ad_insights_campaign_day ON ad_insights (campaign_id, level, day);
+            CREATE TABLE IF NOT EXISTS insights_watermarks (
+                campaign_id TEXT PRIMARY KEY,
+                last_day TEXT NOT NULL,
+                synced_at TIMESTAMP
+            );
+        ''')
+        conn.commit()
+        conn.close()
+
+    # ==================== المزامنة ====================
+
+    async def sync(self, today: Optional[date] = None) -> Dict[str, Any]:
+        """مزامنة تدريجية لكل حملات الحساب (مهمة دورية)"""
+        if not self.graph or not self.account_id:
+            return {'skipped': 'FACEBOOK_ACCESS_TOKEN / FACEBOOK_AD_ACCOUNT_ID not configured'}
+        today = today or date.today()
+        campaigns = await self._discover_campaigns()
+        watermarks = await asyncio.to_thread(self._get_watermarks)
+
+        totals = {'campaigns': len(campaigns), 'rows': 0, 'errors': 0}
+        for start in range(0, len(campaigns), self.campaigns_per_batch):
+            chunk = campaigns[start:start + self.campaigns_per_batch]
+            ranges = {cid: self._sync_range(watermarks.get(cid), today) for cid in chunk}
+            operations = [
+                GraphClient.batch_op('GET', f"{cid}/insights", self._insights_params(level, *ranges[cid]))
+                for cid in chunk for level in ('campaign', 'adset')
+            ]
+            results = await self.graph.batch(operations)
+
+            for i, cid in enumerate(chunk):
+                try:
+                    rows = []
+                    for level, result in zip(('campaign', 'adset'), results[2 * i:2 * i + 2]):
+                        if result['code'] != 200:
+                            raise GraphAPIError(result['code'] or 0, result['body'].get('error') or {})
+                        rows += [self._parse_row(level, r) for r in await self._all_pages(cid, level, ranges[cid], result['body'])]
+                    await asyncio.to_thread(self._write, cid, rows, ranges[cid][1])
+                    totals['rows'] += len(rows)
+                except GraphAPIError as e:
+                    totals['errors'] += 1
+                    logger.warning(f"Insights sync failed for campaign {cid}: {e}")
+        return totals
+
+    async def _discover_campaigns(self) -> List[str]:
+        campaigns, after = [], None
+        while True:
+            page = await self.graph.get(f"act_{self.account_id}/campaigns", {
+                'fields': 'id,name,status', 'limit': 200, 'after': after
+            })
+            campaigns += page.get('data', [])
+            after = (page.get('paging') or {}).get('cursors', {}).get('after') if (page.get('paging') or {}).get('next') else None
+            if not after:
+                break
+        now = datetime.now().isoformat()
+        await asyncio.to_thread(self._execute_many,
+            """INSERT INTO ad_campaigns (id, account_id, name, status, updated_at) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET name = excluded.name, status = excluded.status, updated_at = excluded.updated_at""",
+            [(c['id'], self.account_id, c.get('name'), c.get('status'), now) for c in campaigns]
+        )
+        return [c['id'] for c in campaigns]
+
+    def _sync_range(self, last_day: Optional[str], today: date) -> Tuple[str, str]:
+        if last_day:
+            since = date.fromisoformat(last_day) - timedelta(days=self.lookback_days)
+        else:
+            since = today - timedelta(days=self.backfill_days)
+        return since.isoformat(), today.isoformat()
+
+    def _insights_params(self, level: str, since: str, until: str, after: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            'level': level,
+            'fields': INSIGHT_FIELDS,
+            'time_increment': 1,
+            'time_range': {'since': since, 'until': until},
+            'limit': self.page_size,
+            'after': after,
+        }
+
+    async def _all_pages(self, campaign_id: str, level: str, time_range: Tuple[str, str], first: Dict) -> List[Dict]:
+        rows, page = list(first.get('data', [])), first
+        while (page.get('paging') or {}).get('next'):
+            after = page['paging']['cursors']['after']
+            page = await self.graph.get(f"{campaign_id}/insights", self._insights_params(level, *time_range, after=after))
+            rows += page.get('data', [])
+        return rows
+
+    @staticmethod
+    def _parse_row(level: str, row: Dict[str, Any]) -> Tuple:
+        actions = {a['action_type']: int(float(a['value'])) for a in row.get('actions', [])}
+        object_id = row['campaign_id'] if level == 'campaign' else row['adset_id']
+        return (
+            level, object_id, row['date_start'], row['campaign_id'], row.get('adset_name'),
+            int(row.get('impressions', 0)), int(row.get('reach', 0)), int(row.get('clicks', 0)),
+            float(row.get('spend', 0)),
+            sum(v for k, v in actions.items() if k in LEAD_ACTIONS),
+            sum(v for k, v in actions.items() if k in CONVERSION_ACTIONS),
+        )
+
+    def _write(self, campaign_id: str, rows: List[Tuple], until: str):
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.executemany(
+                """INSERT INTO ad_insights
+                   (level, object_id, day, campaign_id, name, impressions, reach, clicks, spend, leads, conversions)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(level, object_id, day) DO UPDATE SET
+                       name = excluded.name, impressions = excluded.impressions, reach = excluded.reach,
+                       clicks = excluded.clicks, spend = excluded.spend, leads = excluded.leads,
+                       conversions = excluded.conversions""",
+                rows
+            )
+            conn.execute(
+                """INSERT INTO insights_watermarks (campaign_id, last_day, synced_at) VALUES (?, ?, ?)
+                   ON CONFLICT(campaign_id) DO UPDATE SET last_day = excluded.last_day, synced_at = excluded.synced_at""",
+                (campaign_id, until, datetime.now().isoformat())
+            )
+        conn.close()
+
+    def _get_watermarks(self) -> Dict[str, str]:
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT campaign_id, last_day FROM insights_watermarks").fetchall()
+        conn.close()
+        return dict(rows)
+
+    def _execute_many(self, query: str, rows: List[Tuple]):
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.executemany(query, rows)
+        conn.close()
+
+    # ==================== القراءة ====================
+
+    def get_campaign_performance(self, campaign_id: str, days: Optional[int] = None) -> Dict[str, Any]:
+        """أداء الحملة من الجدول المحلي: الإجمالي + السلسلة اليومية + المجموعات الإعلانية"""
+        since = (date.today() - timedelta(days=days - 1)).isoformat() if days else '0000-00-00'
+        conn = sqlite3.connect(self.db_path)
+        sums = ', '.join(f"SUM({m})" for m in METRICS)
+        daily = conn.execute(
+            f"""SELECT day, {', '.join(METRICS)} FROM ad_insights
+                WHERE campaign_id = ? AND level = 'campaign' AND day >= ? ORDER BY day""",
+            (campaign_id, since)
+        ).fetchall()
+        adsets = conn.execute(
+            f"""SELECT object_id, MAX(name), {sums} FROM ad_insights
+                WHERE campaign_id = ? AND level = 'adset' AND day >= ? GROUP BY object_id""",
+            (campaign_id, since)
+        ).fetchall()
+        synced = conn.execute("SELECT last_day, synced_at FROM insights_watermarks WHERE campaign_id = ?",
+                              (campaign_id,)).fetchone()
+        conn.close()
+
+        totals = dict(zip(METRICS, (sum(row[i + 1] for row in daily) for i in range(len(METRICS)))))
+        return {
+            'campaign_id': campaign_id,
+            **self._with_ratios(totals),
+            'daily': [{'day': row[0], **dict(zip(METRICS, row[1:]))} for row in daily],
+            'adsets': sorted(
+                ({'adset_id': row[0], 'name': row[1], **self._with_ratios(dict(zip(METRICS, row[2:])))} for row in adsets),
+                key=lambda a: a['spend'], reverse=True
+            ),
+            'last_day': synced[0] if synced else None,
+            'synced_at': synced[1] if synced else None,
+        }
+
+    def get_rollup(self, period: str = 'week', days: int = 90, campaign_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """تجميع الأداء حسب اليوم/الأسبوع/الشهر لكل الحملات أو لحملة واحدة"""
+        if period not in ROLLUP_PERIODS:
+            raise ValueError(f"period must be one of {list(ROLLUP_PERIODS)}")
+        query = f"""SELECT strftime('{ROLLUP_PERIODS[period]}', day) AS bucket, {', '.join(f'SUM({m})' for m in METRICS)}
+                    FROM ad_insights WHERE level = 'campaign' AND day >= ?"""
+        params: List[Any] = [(date.today() - timedelta(days=days - 1)).isoformat()]
+        if campaign_id:
+            query += " AND campaign_id = ?"
+            params.append(campaign_id)
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(query + " GROUP BY bucket ORDER BY bucket", params).fetchall()
+        conn.close()
+        return [{'period': row[0], **self._with_ratios(dict(zip(METRICS, row[1:])))} for row in rows]
+
+    @staticmethod
+    def _with_ratios(m: Dict[str, Any]) -> Dict[str, Any]:
+        impressions, clicks, spend = m['impressions'] or 0, m['clicks'] or 0, round(m['spend'] or 0, 2)
+        return {
+            **m,
+            'spend': spend,
+            'ctr': round(clicks / impressions * 100, 2) if impressions else 0.0,
+            'cpc': round(spend / clicks, 2) if clicks else None,
+            'cpm': round(spend / impressions * 1000, 2) if impressions else None,
+            'cpl': round(spend / m['leads'], 2) if m['leads'] else None,
+            'cpa': round(spend / m['conversions'], 2) if m['conversions'] else None,
+        }
+
+
+def _get_db_path() -> str:
+    from app.services.crm_database import db
+    return db.db_path
+
+
+ad_insights = AdInsightsService(_get_db_path())
+
+
+if __name__ == '__main__':
+    # مزامنة كاملة ثم تدريجية أمام Graph محلي وقياس عدد الصفوف والطلبات
+    import time
+    from app.core.graph_stub import GraphStubServer, FakeGraphAPI
+    from app.services.http_client import http_client
+
+    async def bench(n_campaigns: int = 60, db_path: str = '/tmp/brilliox_insights_bench.db'):
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        fake = FakeGraphAPI()
+        for i in range(n_campaigns):
+            fake.add_campaign('123', f"c{i:04d}", f"Campaign {i}", adsets=3, days=60)
+        async with GraphStubServer(fake, latency_ms=50) as stub:
+            service = AdInsightsService(db_path, GraphClient('bench', stub.base_url), account_id='123')
+            syncs = {}
+            for label in ('initial (backfill)', 'incremental'):
+                requests_before, started = stub.requests, time.perf_counter()
+                result = syncs[label] = {**await service.sync(), 'http_requests': stub.requests - requests_before}
+                print(json.dumps({'sync': label, **result, 'seconds': round(time.perf_counter() - started, 2)}))
+            await http_client.close()
+
+        started = time.perf_counter()
+        performance = service.get_campaign_performance('c0001', days=7)
+        rollup = service.get_rollup('week', days=30)
+        print(json.dumps({'local_read_ms': round((time.perf_counter() - started) * 1000, 2),
+                          'c0001_last_7_days': {k: performance[k] for k in ('spend', 'clicks', 'leads', 'cpl', 'ctr')},
+                          'weekly_periods': [r['period'] for r in rollup]}, ensure_ascii=False))
+
+        # صف يومي لكل حملة ولكل مجموعة: 30 يوماً ثم نافذة المراجعة فقط
+        initial, incremental = syncs['initial (backfill)'], syncs['incremental']
+        assert initial['errors'] == incremental['errors'] == 0
+        assert initial['rows'] == n_campaigns * 4 * (service.backfill_days + 1), initial
+        assert incremental['rows'] == n_campaigns * 4 * (service.lookback_days + 1), incremental
+        assert incremental['http_requests'] <= initial['http_requests']
+        # القراءة المحلية تطابق بيانات Graph
+        since = (date.today() - timedelta(days=6)).isoformat()
+        expected = [row for row in fake.insights['c0001'] if row['date_start'] >= since]
+        assert performance['clicks'] == sum(row['clicks'] for row in expected), performance
+        assert performance['leads'] == sum(row['leads'] for row in expected), performance
+        assert abs(performance['spend'] - sum(row['spend'] for row in expected)) < 0.01, performance
+
+    asyncio.run(bench())
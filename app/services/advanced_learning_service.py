@@ -1,41 +1,62 @@
+import asyncio
 import logging
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
+
+from app.services.pattern_store import pattern_store
+from app.services.phrase_stats import phrase_stats
 
 logger = logging.getLogger("AdvancedLearningService")
 
 class AdvancedLearningService:
     def __init__(self):
-        self.patterns = []
+        self.patterns = pattern_store
+        self.phrases = phrase_stats
         logger.info("Advanced Learning Service initialized.")
 
     async def learn_from_conversation(self, user_message: str, ai_response: str, success: bool, user_rating: int) -> bool:
         """تعلم من محادثة ناجحة"""
         logger.info(f"Learning from conversation (Success: {success}, Rating: {user_rating})")
-        
-        # هنا يتم إضافة منطق التعلم الفعلي (تحليل النص، تخزين الأنماط)
-        # ...
-        
+
+        # كل رد مقيَّم يدخل الإحصائيات (الناجح والضعيف) - التقييم 3 محايد
+        if success and user_rating >= 4:
+            self.phrases.update(ai_response, 'high')
+        elif not success or user_rating <= 2:
+            self.phrases.update(ai_response, 'low')
+
         if success and user_rating >= 4:
-            self.patterns.append({
-                "user_message": user_message,
-                "ai_response": ai_response,
-                "rating": user_rating
-            })
-            logger.info("Pattern learned and stored.")
-            return True
+            # التضمين والبحث عن نمط مشابه وكتابة القاعدة - خارج الـ event loop
+            stored = await asyncio.to_thread(self.patterns.add, user_message, ai_response, user_rating)
+            if stored:
+                logger.info("Pattern learned and stored." if stored[1] else "Pattern merged into an existing one.")
+                return True
         return False
 
-    def get_pattern_recommendations(self) -> List[Dict[str, Any]]:
+    def find_similar_responses(self, message: str, k: int = 5) -> List[Dict[str, Any]]:
+        """أنجح الردود على رسائل مشابهة لرسالة العميل الجديدة"""
+        return self.patterns.search(message, k)
+
+    def get_pattern_recommendations(self, message: Optional[str] = None) -> List[Dict[str, Any]]:
         """الحصول على التوصيات بناءً على الأنماط الناجحة"""
-        if not self.patterns:
-            return [{"recommendation": "ابدأ بتسجيل المحادثات الناجحة لإنشاء أنماط."}]
-        
-        # هنا يتم إضافة منطق تحليل الأنماط وتقديم التوصيات
-        # ...
-        
-        return [
-            {"recommendation": "استخدم عبارة 'رائع! سأساعدك الآن' في بداية الردود الناجحة."},
-            {"recommendation": "ركز على ميزة 'المنتج الرائع' في رسائل المبيعات."}
+        if message and self.patterns.count():
+            similar = self.find_similar_responses(message, k=3)
+            if similar:
+                return [
+                    {
+                        "recommendation": f"رد ناجح على رسالة مشابهة: {pattern['ai_response']}",
+                        "similarity": pattern["similarity"],
+                        "rating": pattern["rating"],
+                    }
+                    for pattern in similar
+                ]
+
+        phrases = self.phrases.lift_scores(limit=5)
+        recommendations = [
+            {"recommendation": f"استخدم عبارة '{item['phrase']}' - تظهر في الردود الناجحة أكثر بـ {item['lift']}x.", **item}
+            for item in phrases["use"]
+        ] + [
+            {"recommendation": f"تجنب عبارة '{item['phrase']}' - ترتبط بالردود ضعيفة التقييم.", **item}
+            for item in phrases["avoid"]
         ]
+        return recommendations or [{"recommendation": "ابدأ بتسجيل المحادثات الناجحة لإنشاء أنماط."}]
 
 advanced_learning_service = AdvancedLearningService()
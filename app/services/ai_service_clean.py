@@ -3,7 +3,10 @@ AI Marketing Consultant Service - خدمة الذكاء الاصطناعي لل
 بدون أي إشارة لمصطلح "Hunter" أو "الصياد"
 """
 import os
+import json
 import time
+import asyncio
+import hashlib
 from typing import Optional, Dict, Any, List
 import logging
 
@@ -135,6 +138,23 @@ class AIMarketingService:
 - التوقيت المثالي للمتابعة
 """
 
+    # أساليب النسخ الإعلانية - كل أسلوب يُطلب كطلب مستقل
+    AD_COPY_STYLES = {
+        'aida': 'AIDA: Attention → Interest → Desire → Action',
+        'pas': 'PAS: Problem → Agitate → Solution',
+        'benefit_first': 'الفائدة أولاً: ابدأ بالفائدة، ثم الميزات',
+    }
+    
+    # الحقول المطلوبة والحد الأقصى لعدد الحروف
+    AD_COPY_LIMITS = {
+        'headline': 40,
+        'primary_text': 125,
+        'description': 30,
+        'cta': 20,
+    }
+    
+    AD_COPY_MAX_ATTEMPTS = 3
+
     def __init__(self):
         self.openai_key = os.getenv('OPENAI_API_KEY')
         self.google_key = os.getenv('GOOGLE_API_KEY')
@@ -264,6 +284,10 @@ class AIMarketingService:
         """
         إنشاء محتوى إعلاني احترافي
         
+        كل نسخة (AIDA / PAS / الفائدة أولاً) لكل منصة تُطلب بشكل متوازٍ
+        كطلب صغير مستقل بصيغة JSON صارمة، ثم يتم التحقق منها وإصلاحها أو
+        إعادة طلبها بشكل منفصل. النتيجة تُحفظ في الـ Cache حسب بصمة product_info.
+        
         Args:
             product_info: {
                 'product_name': 'اسم المنتج',
@@ -271,48 +295,185 @@ class AIMarketingService:
                 'target_audience': 'الجمهور المستهدف',
                 'unique_selling_point': 'ميزة تنافسية',
                 'call_to_action': 'اطلب الآن',
-                'platform': 'facebook'  # facebook, instagram, google
+                'platform': 'facebook',  # facebook, instagram, google
+                'platforms': ['facebook', 'instagram']  # اختياري - عدة منصات
             }
         
         Returns:
             {
-                'headline': 'العنوان',
-                'primary_text': 'النص الأساسي',
-                'description': 'الوصف',
-                'cta': 'Call-to-Action',
-                'variations': [...]  # 3 نسخ بديلة
+                'success': True,
+                'platforms': {
+                    'facebook': [
+                        {
+                            'style': 'aida',
+                            'headline': 'العنوان',
+                            'primary_text': 'النص الأساسي',
+                            'description': 'الوصف',
+                            'cta': 'Call-to-Action',
+                            'latency_ms': 850.2,
+                            'attempts': 1
+                        },
+                        ...  # 3 نسخ لكل منصة
+                    ]
+                },
+                'failed_variants': 0,
+                'latency_ms': 910.4,
+                'cached': False,
+                'provider': 'openai'
             }
         """
-        prompt = f"""
-أنشئ محتوى إعلاني احترافي لـ:
+        if not self.provider:
+            return {
+                'success': False,
+                'error': 'خدمة الذكاء الاصطناعي غير متاحة حالياً. يرجى إضافة OPENAI_API_KEY أو GOOGLE_API_KEY.'
+            }
+        
+        # فحص الـ Cache حسب بصمة بيانات المنتج
+        cache_key = self._get_product_cache_key(product_info)
+        cached = self._cache.get(cache_key)
+        if cached and time.time() - cached['timestamp'] < self._cache_ttl:
+            return {**cached['data'], 'cached': True}
+        
+        platforms = product_info.get('platforms') or [product_info.get('platform', 'facebook')]
+        
+        started = time.perf_counter()
+        variants = await asyncio.gather(*[
+            self._generate_ad_variant(product_info, platform, style)
+            for platform in platforms
+            for style in self.AD_COPY_STYLES
+        ])
+        
+        by_platform: Dict[str, List[Dict]] = {platform: [] for platform in platforms}
+        failed = 0
+        for variant in variants:
+            if variant.pop('ok'):
+                by_platform[variant.pop('platform')].append(variant)
+            else:
+                failed += 1
+                logger.warning(f"Ad copy variant failed: {variant['platform']}/{variant['style']}: {variant.get('errors')}")
+        
+        result = {
+            'success': failed < len(variants),
+            'platforms': by_platform,
+            'failed_variants': failed,
+            'latency_ms': round((time.perf_counter() - started) * 1000, 1),
+            'cached': False,
+            'provider': self.provider
+        }
+        
+        # لا نحفظ في الـ Cache إلا النتائج الكاملة
+        if failed == 0:
+            self._cache[cache_key] = {
+                'timestamp': time.time(),
+                'data': result
+            }
+        
+        return result
+    
+    async def _generate_ad_variant(self, product_info: Dict, platform: str, style: str) -> Dict[str, Any]:
+        """توليد نسخة إعلانية واحدة مع التحقق والإصلاح وإعادة المحاولة"""
+        started = time.perf_counter()
+        prompt = self._build_ad_variant_prompt(product_info, platform, style)
+        variant, errors = None, []
+        attempts = 0
+        
+        while attempts < self.AD_COPY_MAX_ATTEMPTS:
+            attempts += 1
+            try:
+                raw = await self._complete_json(self.AD_GENERATION_PROMPT, prompt)
+                variant, errors = self._parse_ad_variant(raw)
+            except Exception as e:
+                variant, errors = None, [str(e)]
+            if not errors:
+                break
+            # إعادة الطلب مع توضيح الأخطاء للنموذج
+            prompt = f"{prompt}\n\nالرد السابق غير صالح: {'; '.join(errors)}\nأعد الرد بصيغة JSON صحيحة فقط."
+        
+        result = {
+            'ok': not errors,
+            'platform': platform,
+            'style': style,
+            'attempts': attempts,
+            'latency_ms': round((time.perf_counter() - started) * 1000, 1)
+        }
+        if errors:
+            result['errors'] = errors
+        else:
+            result.update(variant)
+        return result
+    
+    def _build_ad_variant_prompt(self, product_info: Dict, platform: str, style: str) -> str:
+        """بناء Prompt مختصر لنسخة إعلانية واحدة"""
+        schema = json.dumps(
+            {field: f"نص - {limit} حرف كحد أقصى" for field, limit in self.AD_COPY_LIMITS.items()},
+            ensure_ascii=False
+        )
+        return f"""
+أنشئ نسخة إعلانية واحدة لـ:
 
 **المنتج/الخدمة:** {product_info.get('product_name')}
 **الوصف:** {product_info.get('description')}
 **الجمهور المستهدف:** {product_info.get('target_audience')}
 **الميزة التنافسية:** {product_info.get('unique_selling_point')}
-**المنصة:** {product_info.get('platform', 'facebook')}
+**Call-to-Action المقترح:** {product_info.get('call_to_action', 'اطلب الآن')}
+**المنصة:** {platform}
+**الأسلوب:** {self.AD_COPY_STYLES[style]}
 
-**المطلوب:**
-1. عنوان جذاب (Headline) - 40 حرف كحد أقصى
-2. نص أساسي (Primary Text) - 125 حرف
-3. وصف (Description) - 30 حرف
-4. Call-to-Action مناسب
-
-**أنشئ 3 نسخ مختلفة** باستخدام:
-- النسخة 1: أسلوب AIDA
-- النسخة 2: أسلوب PAS
-- النسخة 3: التركيز على الفائدة
-
-صيغة الرد: JSON
+أرجع JSON فقط بهذه الحقول بالضبط:
+{schema}
 """
+    
+    async def _complete_json(self, system_prompt: str, prompt: str) -> str:
+        """طلب رد JSON من مزود الذكاء الاصطناعي بدون حجب الـ event loop"""
+        if self.provider == 'openai':
+            response = await asyncio.to_thread(
+                openai.ChatCompletion.create,
+                model=self.model,
+                messages=[
+                    {'role': 'system', 'content': system_prompt},
+                    {'role': 'user', 'content': prompt}
+                ],
+                temperature=0.7,
+                max_tokens=400,
+                response_format={"type": "json_object"}
+            )
+            return response.choices[0].message.content
         
-        result = await self.chat(prompt)
+        model = genai.GenerativeModel(self.model)
+        response = await asyncio.to_thread(
+            model.generate_content,
+            f"{system_prompt}\n\n{prompt}\n\nأرجع رد JSON فقط."
+        )
+        return response.text
+    
+    def _parse_ad_variant(self, text: str):
+        """تحليل رد النموذج والتحقق منه وإصلاح الأخطاء البسيطة"""
+        text = (text or '').strip()
+        if '```' in text:
+            text = text.split('```json')[-1] if '```json' in text else text.split('```')[1]
+            text = text.split('```')[0]
+        start, end = text.find('{'), text.rfind('}')
+        if start == -1 or end <= start:
+            return None, ['no JSON object in response']
+        try:
+            data = json.loads(text[start:end + 1])
+        except json.JSONDecodeError as e:
+            return None, [f'invalid JSON: {e}']
+        if not isinstance(data, dict):
+            return None, ['response is not a JSON object']
         
-        # TODO: تحليل الرد وإرجاع JSON منظم
-        return {
-            'raw_response': result.get('response'),
-            'provider': result.get('provider')
-        }
+        variant, errors = {}, []
+        for field, limit in self.AD_COPY_LIMITS.items():
+            value = data.get(field)
+            if not isinstance(value, str) or not value.strip():
+                errors.append(f'missing field: {field}')
+                continue
+            value = ' '.join(value.split())
+            if len(value) > limit:
+                # إصلاح: قص النص عند آخر كلمة كاملة
+                value = value[:limit].rsplit(' ', 1)[0] or value[:limit]
+            variant[field] = value
+        return variant, errors
     
     async def analyze_lead_quality(self, lead_data: Dict) -> Dict[str, Any]:
         """
@@ -337,28 +498,13 @@ class AIMarketingService:
                 'best_contact_time': '10:00 AM - 12:00 PM'
             }
         """
-        # حساب النقاط
-        score = 0
+        # حساب النقاط عبر محرك التقييم الموحد
+        from app.services.lead_scoring import scoring_engine
         max_score = 5
-        
-        # 1. اكتمال البيانات (2 نقطة)
-        if lead_data.get('name') and lead_data.get('phone'):
-            score += 1
-        if lead_data.get('email'):
-            score += 1
-        
-        # 2. مصدر العميل (2 نقطة)
-        source = lead_data.get('source', '').lower()
-        if 'paid' in source or 'ad' in source:
-            score += 2
-        elif 'organic' in source or 'search' in source:
-            score += 1.5
-        elif 'social' in source:
-            score += 1
-        
-        # 3. التفاعل (1 نقطة)
-        if lead_data.get('interaction_history'):
-            score += min(len(lead_data['interaction_history']) * 0.3, 1)
+        score = scoring_engine.score_one(
+            lead_data,
+            interaction_count=len(lead_data.get('interaction_history') or [])
+        )
         
         # تصنيف
         if score >= 4:
@@ -398,13 +544,19 @@ class AIMarketingService:
     
     def _get_cache_key(self, message: str, context: Optional[Dict]) -> str:
         """إنشاء مفتاح الـ Cache"""
-        import hashlib
-        
         key_data = message
         if context:
             key_data += str(context.get('user_id', ''))
         
         return hashlib.md5(key_data.encode()).hexdigest()
+    
+    def _get_product_cache_key(self, product_info: Dict) -> str:
+        """مفتاح الـ Cache للمحتوى الإعلاني حسب بصمة بيانات المنتج"""
+        key_data = json.dumps(product_info, sort_keys=True, ensure_ascii=False, default=str)
+        return 'ad_copy:' + hashlib.sha256(key_data.encode()).hexdigest()
+
+
+ai_marketing_service = AIMarketingService()
 
 
 # مثال استخدام
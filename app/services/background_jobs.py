@@ -0,0 +1,119 @@
+"""
+Background Jobs - مهام دورية تعمل داخل التطبيق ⏱️
+كل مهمة تعمل في حلقة مستقلة على الـ event loop ولا تحجب معالجة الطلبات
+"""
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Any, Callable, Awaitable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicJob:
+    """مهمة دورية واحدة مع إحصائيات آخر تشغيل"""
+
+    def __init__(self, name: str, func: Callable[[], Awaitable[Dict]], interval_seconds: Optional[float], run_on_start: bool = False):
+        self.name = name
+        self.func = func
+        self.interval_seconds = interval_seconds
+        self.run_on_start = run_on_start
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            'runs': 0,
+            'failures': 0,
+            'last_started_at': None,
+            'last_duration_ms': None,
+            'last_result': None,
+            'last_error': None,
+        }
+
+    def trigger(self):
+        """تشغيل المهمة الآن بدلاً من انتظار الموعد التالي"""
+        self._wakeup.set()
+
+    async def _loop(self):
+        if not self.run_on_start:
+            await self._sleep()
+        while True:
+            await self.run_once()
+            await self._sleep()
+
+    async def _sleep(self):
+        # interval_seconds=None: مهمة يدوية تعمل فقط عند trigger
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval_seconds)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def run_once(self) -> Optional[Dict]:
+        started = time.perf_counter()
+        self.stats['last_started_at'] = datetime.now().isoformat()
+        try:
+            result = await self.func()
+            self.stats['last_result'] = result
+            self.stats['last_error'] = None
+            return result
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats['failures'] += 1
+            self.stats['last_error'] = str(e)
+            logger.error(f"Background job '{self.name}' failed: {e}")
+            return None
+        finally:
+            self.stats['runs'] += 1
+            self.stats['last_duration_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+
+class BackgroundScheduler:
+    """مجدول المهام الدورية - يبدأ مع التطبيق ويتوقف عند الإغلاق"""
+
+    def __init__(self):
+        self.jobs: Dict[str, PeriodicJob] = {}
+        self.running = False
+
+    def register(self, name: str, func: Callable[[], Awaitable[Dict]], interval_seconds: Optional[float], run_on_start: bool = False) -> PeriodicJob:
+        job = PeriodicJob(name, func, interval_seconds, run_on_start)
+        self.jobs[name] = job
+        if self.running:
+            job._task = asyncio.create_task(job._loop(), name=f"job:{name}")
+        return job
+
+    def trigger(self, name: str):
+        job = self.jobs.get(name)
+        if job:
+            job.trigger()
+
+    async def start(self):
+        if self.running:
+            return
+        self.running = True
+        for job in self.jobs.values():
+            job._task = asyncio.create_task(job._loop(), name=f"job:{job.name}")
+        logger.info(f"✅ Background scheduler started ({len(self.jobs)} jobs)")
+
+    async def stop(self):
+        self.running = False
+        tasks = [job._task for job in self.jobs.values() if job._task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for job in self.jobs.values():
+            job._task = None
+        logger.info("Background scheduler stopped")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'running': self.running,
+            'jobs': {
+                name: {'interval_seconds': job.interval_seconds, **job.stats}
+                for name, job in self.jobs.items()
+            }
+        }
+
+
+scheduler = BackgroundScheduler()
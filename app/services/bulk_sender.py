@@ -0,0 +1,433 @@
+"""
+Bulk WhatsApp Sender - إرسال جماعي عالي السرعة مع التحكم في المعدل 📣
+- توازي محدود عبر العميل المشترك
+- Token Bucket حسب حد الرسائل في الثانية لـ WhatsApp Cloud API
+- حالة كل مستلم محفوظة في قاعدة البيانات للاستئناف بعد التوقف بدون إرسال مكرر
+- الحملة تعمل كمهمة خلفية (scheduler) - بث التقدم يقرأ من قاعدة البيانات فقط
+- الأخطاء المؤقتة (429، 5xx، الشبكة) تعود pending مع تأخير أُسّي
+"""
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, AsyncIterator
+
+from app.services.crm_database import db
+from app.services.whatsapp_service import WhatsAppService
+from app.services.message_status import MessageStatusTracker
+from app.services.outbox_dispatcher import OutboxDispatcher
+from app.services.background_jobs import scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """محدد معدل: rate طلب في الثانية، يبدأ فارغاً مع دفعة قصوى بحجم capacity
+    (في أي فترة T لا يتجاوز عدد الطلبات rate*T + capacity)"""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BulkSender:
+    """محرك الحملات الجماعية"""
+
+    JOB_NAME = 'bulk_campaigns'
+
+    def __init__(self, db_path: str, whatsapp: WhatsAppService):
+        self.db_path = db_path
+        self.whatsapp = whatsapp
+        self.messages_per_second = float(os.getenv('WHATSAPP_MESSAGES_PER_SECOND', '80'))
+        self.concurrency = int(os.getenv('WHATSAPP_BULK_CONCURRENCY', '16'))
+        self.max_attempts = int(os.getenv('WHATSAPP_BULK_MAX_ATTEMPTS', '5'))
+        self.base_delay = float(os.getenv('WHATSAPP_BULK_RETRY_BASE_SECONDS', '2'))
+        self.max_delay = float(os.getenv('WHATSAPP_BULK_RETRY_MAX_SECONDS', '300'))
+        self.progress_interval = 1.0
+        self._init_tables()
+        self.receipts = MessageStatusTracker(db_path)
+        # الحملات التي تعمل الآن في هذه العملية -> وقت البدء وعدد المُرسل في هذا التشغيل
+        self._live: Dict[int, Dict[str, float]] = {}
+
+    @property
+    def claim_size(self) -> int:
+        # دفعة صغيرة = عدد أقل من الرسائل "غير المؤكدة" عند التوقف المفاجئ
+        return self.concurrency * 2
+
+    def _init_tables(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS bulk_campaigns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                total INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS bulk_recipients (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                campaign_id INTEGER NOT NULL,
+                phone TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                provider_message_id TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP,
+                updated_at TIMESTAMP,
+                UNIQUE (campaign_id, phone),
+                FOREIGN KEY (campaign_id) REFERENCES bulk_campaigns(id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_bulk_recipients_status ON bulk_recipients (campaign_id, status);
+        ''')
+        # جداول أُنشئت قبل إضافة إعادة المحاولة
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(bulk_recipients)")}
+        for column, definition in (('attempts', 'INTEGER NOT NULL DEFAULT 0'), ('next_attempt_at', 'TIMESTAMP')):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE bulk_recipients ADD COLUMN {column} {definition}")
+        conn.commit()
+        conn.close()
+
+    # ==================== الحملات ====================
+
+    def create_campaign(self, name: str, messages: List[Dict[str, str]]) -> int:
+        """إنشاء حملة - المستلم المكرر داخل نفس الحملة يُتجاهل"""
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            cursor = conn.execute("INSERT INTO bulk_campaigns (name, created_at) VALUES (?, ?)",
+                                  (name, datetime.now().isoformat()))
+            campaign_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT OR IGNORE INTO bulk_recipients (campaign_id, phone, body) VALUES (?, ?, ?)",
+                ((campaign_id, m['phone'], m['message']) for m in messages)
+            )
+            total = conn.execute("SELECT COUNT(*) FROM bulk_recipients WHERE campaign_id = ?",
+                                 (campaign_id,)).fetchone()[0]
+            conn.execute("UPDATE bulk_campaigns SET total = ? WHERE id = ?", (total, campaign_id))
+        conn.close()
+        return campaign_id
+
+    def get_progress(self, campaign_id: int) -> Dict[str, Any]:
+        conn = sqlite3.connect(self.db_path)
+        campaign = conn.execute("SELECT name, status, total FROM bulk_campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        counts = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM bulk_recipients WHERE campaign_id = ? GROUP BY status", (campaign_id,)
+        ).fetchall())
+        conn.close()
+        if not campaign:
+            return {'success': False, 'error': 'Campaign not found'}
+        progress = {
+            'success': True,
+            'campaign_id': campaign_id,
+            'name': campaign[0],
+            'status': campaign[1],
+            'total': campaign[2],
+            **{status: counts.get(status, 0) for status in ('pending', 'sending', 'sent', 'failed', 'unknown')},
+            'receipts': self.receipts.get_stats('campaign', campaign_id),
+        }
+        live = self._live.get(campaign_id)
+        if live:
+            elapsed = time.perf_counter() - live['started']
+            progress.update({
+                'elapsed_s': round(elapsed, 2),
+                'rate_per_sec': round(live['sent'] / elapsed, 1) if elapsed else 0.0,
+            })
+        return progress
+
+    def start(self, campaign_id: int, retry_unknown: bool = False) -> bool:
+        """
+        وضع حملة في طابور التشغيل الخلفي - False إذا كانت تعمل الآن
+
+        المستلمون الذين كانوا قيد الإرسال عند توقف سابق يُعلَّمون unknown
+        ولا يُعاد إرسالهم إلا بطلب صريح (retry_unknown=True).
+        """
+        if campaign_id in self._live:
+            return False
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            if retry_unknown:
+                conn.execute("UPDATE bulk_recipients SET status = 'pending' WHERE campaign_id = ? AND status = 'unknown'",
+                             (campaign_id,))
+            conn.execute("UPDATE bulk_campaigns SET status = 'queued' WHERE id = ?", (campaign_id,))
+        conn.close()
+        scheduler.trigger(self.JOB_NAME)
+        return True
+
+    async def process_queue(self) -> Dict[str, Any]:
+        """تشغيل الحملات المنتظرة واحدة تلو الأخرى (مهمة دورية)"""
+        completed = []
+        while (campaign_id := await asyncio.to_thread(self._next_queued)) is not None:
+            progress = await self.run(campaign_id)
+            completed.append({'campaign_id': campaign_id, 'sent': progress.get('sent'), 'failed': progress.get('failed')})
+        return {'campaigns': completed}
+
+    async def watch(self, campaign_id: int) -> AsyncIterator[Dict[str, Any]]:
+        """بث التقدم من قاعدة البيانات فقط - انقطاع المتصفح لا يوقف الحملة"""
+        while True:
+            progress = await asyncio.to_thread(self.get_progress, campaign_id)
+            if not progress.get('success'):
+                yield progress
+                return
+            if progress['status'] == 'completed':
+                yield {**progress, 'done': True}
+                return
+            yield progress
+            await asyncio.sleep(self.progress_interval)
+
+    async def run(self, campaign_id: int) -> Dict[str, Any]:
+        """تشغيل أو استئناف حملة حتى النهاية - يرجع التقدم النهائي"""
+        await asyncio.to_thread(self._recover, campaign_id)
+        bucket = TokenBucket(self.messages_per_second)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+        results: List[tuple] = []
+        # محجوزة ولم يبدأ إرسالها بعد - تعود pending إذا توقف التشغيل
+        claimed = set()
+        # محجوزة ولم تُسجَّل نتيجتها بعد - قد تعود pending لإعادة المحاولة
+        in_flight = 0
+        live = self._live[campaign_id] = {'started': time.perf_counter(), 'sent': 0}
+
+        async def produce():
+            nonlocal in_flight
+            while True:
+                rows = await asyncio.to_thread(self._claim, campaign_id, self.claim_size)
+                if rows:
+                    claimed.update(row[0] for row in rows)
+                    in_flight += len(rows)
+                    for row in rows:
+                        await queue.put(row)
+                    continue
+                if in_flight:
+                    await asyncio.sleep(0.05)
+                    continue
+                await asyncio.to_thread(self._write_results, campaign_id, results)
+                wait = await asyncio.to_thread(self._next_retry_in, campaign_id)
+                if wait is None:
+                    break
+                await asyncio.sleep(min(max(wait, 0.05), self.progress_interval))
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def consume():
+            nonlocal in_flight
+            while (row := await queue.get()) is not None:
+                await bucket.acquire()
+                claimed.discard(row[0])
+                result = await self.whatsapp.send_message(row[1], row[2])
+                results.append(self._outcome(row, result))
+                in_flight -= 1
+                if result.get('success'):
+                    live['sent'] += 1
+
+        workers = asyncio.gather(produce(), *[consume() for _ in range(self.concurrency)])
+        try:
+            while not workers.done():
+                await asyncio.wait({workers}, timeout=self.progress_interval)
+                await asyncio.to_thread(self._write_results, campaign_id, results)
+            workers.result()
+            await asyncio.to_thread(self._write_results, campaign_id, results)
+            await asyncio.to_thread(self._finish, campaign_id)
+            progress = await asyncio.to_thread(self.get_progress, campaign_id)
+            logger.info(f"Bulk campaign {campaign_id}: {progress.get('sent')}/{progress.get('total')} sent")
+            return progress
+        finally:
+            if not workers.done():
+                workers.cancel()
+                try:
+                    await workers
+                except asyncio.CancelledError:
+                    pass
+            # حفظ نتائج ما أُرسل بالفعل، وإعادة ما لم يبدأ إرساله إلى pending
+            await asyncio.to_thread(self._write_results, campaign_id, results)
+            await asyncio.to_thread(self._release, campaign_id, claimed)
+            del self._live[campaign_id]
+
+    async def send_all(self, name: str, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        """إنشاء حملة وتشغيلها حتى النهاية"""
+        campaign_id = await asyncio.to_thread(self.create_campaign, name, messages)
+        return await self.run(campaign_id)
+
+    def _outcome(self, row: tuple, result: Dict[str, Any]) -> tuple:
+        """(الحالة, معرف المزود, الخطأ, موعد المحاولة التالية, رقم الصف) - نفس قاعدة الـ outbox للأخطاء"""
+        if result.get('success'):
+            provider_id = ((result.get('data') or {}).get('messages') or [{}])[0].get('id')
+            return 'sent', provider_id, None, None, row[0]
+        error = str(result.get('error') or result.get('data'))[:500]
+        attempts = row[3] + 1
+        if OutboxDispatcher._is_permanent(result) or attempts >= self.max_attempts:
+            return 'failed', None, error, None, row[0]
+        delay = min(self.base_delay * (2 ** (attempts - 1)), self.max_delay) * random.uniform(0.8, 1.2)
+        return 'pending', None, error, (datetime.now() + timedelta(seconds=delay)).isoformat(), row[0]
+
+    # ==================== قاعدة البيانات ====================
+
+    def _recover(self, campaign_id: int):
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.execute("UPDATE bulk_recipients SET status = 'unknown' WHERE campaign_id = ? AND status = 'sending'",
+                         (campaign_id,))
+            conn.execute("UPDATE bulk_campaigns SET status = 'running' WHERE id = ?", (campaign_id,))
+        conn.close()
+
+    def _next_queued(self) -> Optional[int]:
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            row = conn.execute(
+                """UPDATE bulk_campaigns SET status = 'running'
+                   WHERE id = (SELECT id FROM bulk_campaigns WHERE status = 'queued' ORDER BY id LIMIT 1)
+                   RETURNING id"""
+            ).fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def _claim(self, campaign_id: int, limit: int) -> List[tuple]:
+        now = datetime.now().isoformat()
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            rows = conn.execute(
+                """UPDATE bulk_recipients SET status = 'sending', updated_at = ?
+                   WHERE id IN (SELECT id FROM bulk_recipients WHERE campaign_id = ? AND status = 'pending'
+                                AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+                                ORDER BY id LIMIT ?)
+                   RETURNING id, phone, body, attempts""",
+                (now, campaign_id, now, limit)
+            ).fetchall()
+        conn.close()
+        return sorted(rows)
+
+    def _next_retry_in(self, campaign_id: int) -> Optional[float]:
+        """ثوانٍ حتى أقرب إعادة محاولة مؤجلة - None إذا لم يبقَ مستلمون pending"""
+        conn = sqlite3.connect(self.db_path)
+        count, next_attempt_at = conn.execute(
+            "SELECT COUNT(*), MIN(next_attempt_at) FROM bulk_recipients WHERE campaign_id = ? AND status = 'pending'",
+            (campaign_id,)
+        ).fetchone()
+        conn.close()
+        if not count:
+            return None
+        if next_attempt_at is None:
+            return 0.0
+        return (datetime.fromisoformat(next_attempt_at) - datetime.now()).total_seconds()
+
+    def _write_results(self, campaign_id: int, results: List[tuple]) -> int:
+        batch = results[:]
+        del results[:len(batch)]
+        if not batch:
+            return 0
+        now = datetime.now().isoformat()
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.executemany(
+                """UPDATE bulk_recipients SET status = ?, provider_message_id = ?, error = ?, next_attempt_at = ?,
+                   attempts = attempts + 1, updated_at = ? WHERE id = ?""",
+                ((status, provider_id, error, next_attempt_at, now, row_id)
+                 for status, provider_id, error, next_attempt_at, row_id in batch)
+            )
+        conn.close()
+        self.receipts.register_sent((provider_id, None, campaign_id) for status, provider_id, _, _, _ in batch
+                                    if status == 'sent')
+        return sum(1 for r in batch if r[0] == 'sent')
+
+    def _release(self, campaign_id: int, row_ids):
+        """بعد توقف قبل النهاية: ما لم يبدأ إرساله يعود pending، والحملة تعود للطابور"""
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.executemany("UPDATE bulk_recipients SET status = 'pending' WHERE id = ? AND status = 'sending'",
+                             ((row_id,) for row_id in row_ids))
+            conn.execute("UPDATE bulk_campaigns SET status = 'queued' WHERE id = ? AND status = 'running'",
+                         (campaign_id,))
+        conn.close()
+
+    def _finish(self, campaign_id: int):
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.execute("UPDATE bulk_campaigns SET status = 'completed', finished_at = ? WHERE id = ?",
+                         (datetime.now().isoformat(), campaign_id))
+        conn.close()
+
+
+bulk_sender = BulkSender(db.db_path, WhatsAppService())
+
+
+if __name__ == '__main__':
+    # قياس معدل الإرسال الفعلي أمام خادم Graph محلي، مع أخطاء مؤقتة ودائمة
+    import json
+    import argparse
+    from collections import Counter
+    from app.core.graph_stub import GraphStubServer, default_handler
+    from app.services.http_client import http_client
+
+    parser = argparse.ArgumentParser(description="Bulk sender throughput benchmark")
+    parser.add_argument('--recipients', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=250)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency-ms', type=float, default=40)
+    parser.add_argument('--db', default='/tmp/brilliox_bulk_bench.db')
+    args = parser.parse_args()
+
+    delivered = Counter()
+    attempts = Counter()
+
+    def handler(method, path, query, body):
+        # كل 10 أرقام: 429 في أول محاولة، وكل 50: رقم مرفوض (400)
+        phone = body['to']
+        attempts[phone] += 1
+        index = int(phone[-7:])
+        if index % 50 == 7:
+            return 400, {'error': {'message': 'Recipient not allowed'}}
+        if index % 10 == 3 and attempts[phone] == 1:
+            return 429, {'error': {'message': 'Rate limit hit'}}
+        delivered[phone] += 1
+        return default_handler(method, path, query, body)
+
+    async def bench():
+        if os.path.exists(args.db):
+            os.remove(args.db)
+        async with GraphStubServer(handler, latency_ms=args.latency_ms) as stub:
+            os.environ['WHATSAPP_API_KEY'] = 'bench'
+            whatsapp = WhatsAppService()
+            whatsapp.api_base = stub.base_url
+            sender = BulkSender(args.db, whatsapp)
+            sender.messages_per_second = args.rate
+            sender.concurrency = args.concurrency
+            sender.progress_interval = 0.5
+            sender.base_delay = 0.2
+            campaign_id = sender.create_campaign('bench', [
+                {'phone': f'0100{i:07d}', 'message': 'عرض خاص 🎁'} for i in range(args.recipients)
+            ])
+
+            task = asyncio.create_task(sender.run(campaign_id))
+            async for progress in sender.watch(campaign_id):
+                print(json.dumps(progress, ensure_ascii=False))
+            final = await task
+            print(json.dumps({'send_latency': whatsapp.send_latency.snapshot(), 'connections': stub.connections}))
+            await http_client.close()
+
+        rejected = sum(1 for i in range(args.recipients) if i % 50 == 7)
+        throttled = sum(1 for i in range(args.recipients) if i % 10 == 3 and i % 50 != 7)
+        assert final['failed'] == rejected, final
+        assert final['sent'] == args.recipients - rejected, final
+        assert max(delivered.values()) == 1, "recipient received a duplicate message"
+        assert sum(attempts.values()) == args.recipients + throttled
+        # الدلو يبدأ فارغاً: لا دفعة أولية فوق المعدل
+        requests_per_sec = sum(attempts.values()) / final['elapsed_s']
+        assert requests_per_sec <= args.rate * 1.05, requests_per_sec
+
+    asyncio.run(bench())
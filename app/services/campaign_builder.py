@@ -0,0 +1,456 @@
+"""
+Campaign Builder - بناء الحملة (حملة -> مجموعات -> إعلانات) بالتوازي 🏗️
+كل عنصر محفوظ بحالته في قاعدة البيانات قبل وبعد طلبه، فالإعادة تشمل الفاشل فقط
+والبناء المنقطع يُستأنف من حيث توقف. الطلبات المتزامنة محدودة لكل حساب إعلاني
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+from app.services.graph_client import GraphClient, GraphAPIError
+
+logger = logging.getLogger(__name__)
+
+# هدف الحملة -> هدف تحسين المجموعة الإعلانية
+OPTIMIZATION_GOALS = {
+    'CONVERSIONS': 'OFFSITE_CONVERSIONS',
+    'LEAD_GENERATION': 'LEAD_GENERATION',
+    'TRAFFIC': 'LINK_CLICKS',
+}
+# أكواد Graph للأخطاء المؤقتة (ضغط/حد معدل/خطأ داخلي)
+TRANSIENT_ERROR_CODES = {1, 2, 4, 17, 32, 341, 613}
+# أنواع العناصر وحقل الأب الذي يربطها
+EDGES = {'campaign': 'campaigns', 'adset': 'adsets', 'ad': 'ads'}
+
+
+class CampaignBuilder:
+    """بناء الحملات على Facebook Marketing API مع حفظ حالة كل عنصر"""
+
+    JOB_NAME = 'campaign_builds'
+
+    def __init__(self, db_path: str, graph: Optional[GraphClient] = None):
+        self.db_path = db_path
+        access_token = os.getenv('FACEBOOK_ACCESS_TOKEN')
+        self.graph = graph or (GraphClient(access_token) if access_token else None)
+        self.account_concurrency = int(os.getenv('ADS_ACCOUNT_CONCURRENCY', '5'))
+        self.max_attempts = int(os.getenv('ADS_BUILD_MAX_ATTEMPTS', '3'))
+        # بناء pending/running لم يتحدث خلال هذه المدة = توقف (العملية التي كانت تنفذه انتهت)
+        self.lease_seconds = int(os.getenv('ADS_BUILD_LEASE_SECONDS', '300'))
+        self.retry_base_delay = 0.5
+        self._limits: Dict[str, asyncio.Semaphore] = {}
+        self._active = set()
+        self._init_tables()
+
+    def _init_tables(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS campaign_builds (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                account_id TEXT NOT NULL,
+                name TEXT,
+                spec TEXT,
+                status TEXT DEFAULT 'pending',
+                campaign_id TEXT,
+                created_at TIMESTAMP,
+                updated_at TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS campaign_build_items (
+                build_id INTEGER NOT NULL,
+                item_key TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                parent_key TEXT,
+                strategy TEXT,
+                product_index INTEGER,
+                status TEXT DEFAULT 'pending',
+                remote_id TEXT,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                updated_at TIMESTAMP,
+                PRIMARY KEY (build_id, item_key)
+            );
+            CREATE INDEX IF NOT EXISTS idx_campaign_builds_status ON campaign_builds (status);
+        ''')
+        conn.commit()
+        conn.close()
+
+    @property
+    def enabled(self) -> bool:
+        return self.graph is not None
+
+    # ==================== إنشاء البناء ====================
+
+    def create_build(self, account_id: str, name: str, objective: str, daily_budget: float,
+                     strategies: Optional[List[str]] = None, products: Optional[List[Dict[str, str]]] = None,
+                     countries: Optional[List[str]] = None, page_id: Optional[str] = None) -> int:
+        """حفظ خطة البناء: حملة + مجموعة لكل استراتيجية + إعلان لكل (استراتيجية، منتج)"""
+        strategies, products = list(strategies or []), list(products or [])
+        spec = {
+            'objective': objective,
+            'daily_budget': daily_budget,
+            'countries': countries or ['EG'],
+            'page_id': page_id or os.getenv('FACEBOOK_PAGE_ID'),
+            'products': products,
+        }
+        now = datetime.now().isoformat()
+        items = [('campaign', 'campaign', None, None, None)]
+        for strategy in strategies:
+            items.append((strategy, 'adset', 'campaign', strategy, None))
+            items += [(f"{strategy}/{i}", 'ad', strategy, strategy, i) for i in range(len(products))]
+
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            build_id = conn.execute(
+                """INSERT INTO campaign_builds (account_id, name, spec, status, created_at, updated_at)
+                   VALUES (?, ?, ?, 'pending', ?, ?)""",
+                (account_id, name, json.dumps(spec, ensure_ascii=False), now, now)
+            ).lastrowid
+            conn.executemany(
+                """INSERT INTO campaign_build_items
+                   (build_id, item_key, kind, parent_key, strategy, product_index, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                [(build_id, *item, now) for item in items]
+            )
+        conn.close()
+        return build_id
+
+    async def build(self, account_id: str, name: str, objective: str, daily_budget: float,
+                    strategies: Optional[List[str]] = None, products: Optional[List[Dict[str, str]]] = None,
+                    countries: Optional[List[str]] = None, page_id: Optional[str] = None) -> Dict[str, Any]:
+        """إنشاء خطة البناء وتنفيذها"""
+        build_id = await asyncio.to_thread(
+            self.create_build, account_id, name, objective, daily_budget, strategies, products, countries, page_id
+        )
+        return await self.run(build_id)
+
+    # ==================== التنفيذ ====================
+
+    async def run(self, build_id: int) -> Dict[str, Any]:
+        """تنفيذ العناصر غير المكتملة: الحملة أولاً ثم كل مجموعة وإعلاناتها بالتوازي
+
+        يرجع {'skipped': ...} إذا كان البناء يعمل الآن (هنا أو في عملية أخرى) أو {'error': ...} إذا لم يوجد"""
+        if build_id in self._active:
+            return {'build_id': build_id, 'skipped': 'Build is already running'}
+        self._active.add(build_id)
+        started = time.perf_counter()
+        try:
+            build = await asyncio.to_thread(self._load_build, build_id)
+            if not build:
+                return {'build_id': build_id, 'error': 'Build not found'}
+            if not await asyncio.to_thread(self._claim_build, build_id):
+                return {'build_id': build_id, 'skipped': 'Build is already running'}
+            items = build['items']
+            await self._recover_in_flight(build, items)
+
+            campaign = items['campaign']
+            if campaign['status'] != 'done':
+                await self._create_item(build, campaign, items)
+            if campaign['status'] == 'done':
+                adsets = [item for item in items.values() if item['kind'] == 'adset']
+                await asyncio.gather(*(self._build_adset(build, adset, items) for adset in adsets))
+
+            counts: Dict[str, int] = {}
+            for item in items.values():
+                counts[item['status']] = counts.get(item['status'], 0) + 1
+            status = 'completed' if counts.get('done', 0) == len(items) else \
+                'failed' if campaign['status'] != 'done' else 'partial'
+            await asyncio.to_thread(self._set_build, build_id, status, campaign['remote_id'])
+        finally:
+            self._active.discard(build_id)
+
+        return {
+            'build_id': build_id,
+            'status': status,
+            'campaign_id': campaign['remote_id'],
+            'items': counts,
+            'adsets': {i['strategy']: i['remote_id'] for i in items.values() if i['kind'] == 'adset' and i['remote_id']},
+            'failed': [{'item': i['item_key'], 'error': i['error']} for i in items.values() if i['status'] == 'failed'],
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+        }
+
+    async def retry_failed(self, build_id: int) -> Dict[str, Any]:
+        """إعادة العناصر الفاشلة فقط (والإعلانات التي تعطلت بسبب فشل مجموعتها)"""
+        if build_id in self._active or await asyncio.to_thread(self._is_leased, build_id):
+            return {'build_id': build_id, 'skipped': 'Build is already running'}
+        await asyncio.to_thread(self._execute,
+            "UPDATE campaign_build_items SET status = 'pending', error = NULL WHERE build_id = ? AND status = 'failed'",
+            (build_id,)
+        )
+        return await self.run(build_id)
+
+    async def resume_incomplete(self) -> Dict[str, Any]:
+        """استئناف البناءات التي انقطعت (إعادة تشغيل الخادم أثناء التنفيذ) - مهمة دورية"""
+        if not self.enabled:
+            return {'skipped': 'FACEBOOK_ACCESS_TOKEN not configured'}
+        conn = sqlite3.connect(self.db_path)
+        # البناء الجديد (pending) أو الذي ينفذه worker آخر يتحدث باستمرار - لا يُلمس
+        build_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM campaign_builds WHERE status IN ('pending', 'running') AND updated_at < ? ORDER BY id",
+            (self._lease_cutoff(),)
+        )]
+        conn.close()
+        results = [await self.run(build_id) for build_id in build_ids if build_id not in self._active]
+        return {
+            'resumed': sum(1 for r in results if 'status' in r),
+            'completed': sum(1 for r in results if r.get('status') == 'completed'),
+            'skipped': sum(1 for r in results if 'skipped' in r),
+        }
+
+    async def _build_adset(self, build: Dict, adset: Dict, items: Dict[str, Dict]):
+        if adset['status'] != 'done':
+            await self._create_item(build, adset, items)
+        ads = [item for item in items.values() if item['parent_key'] == adset['item_key']]
+        if adset['status'] != 'done':
+            # الإعلانات تبقى معلقة حتى تنجح مجموعتها في إعادة لاحقة
+            for ad in ads:
+                if ad['status'] != 'done':
+                    await asyncio.to_thread(self._set_item, build['id'], ad, 'failed', error='Ad set was not created')
+            return
+        await asyncio.gather(*(self._create_item(build, ad, items) for ad in ads if ad['status'] != 'done'))
+
+    async def _create_item(self, build: Dict, item: Dict, items: Dict[str, Dict]):
+        params = self._params(build, item, items)
+        edge = f"act_{build['account_id']}/{EDGES[item['kind']]}"
+        limit = self._limits.setdefault(build['account_id'], asyncio.Semaphore(self.account_concurrency))
+
+        for attempt in range(1, self.max_attempts + 1):
+            # 'running' يُحفظ قبل الطلب: لو انقطع التنفيذ هنا يُبحث عن العنصر بالاسم عند الاستئناف
+            await asyncio.to_thread(self._set_item, build['id'], item, 'running', attempts=item['attempts'] + 1)
+            try:
+                async with limit:
+                    result = await self.graph.post(edge, params)
+                await asyncio.to_thread(self._set_item, build['id'], item, 'done', remote_id=result['id'])
+                return
+            except GraphAPIError as e:
+                transient = self._is_transient(e)
+                if not transient or attempt == self.max_attempts:
+                    await asyncio.to_thread(self._set_item, build['id'], item, 'failed', error=str(e))
+                    return
+                await asyncio.sleep(self.retry_base_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    async def _recover_in_flight(self, build: Dict, items: Dict[str, Dict]):
+        """عناصر بحالة 'running' من تشغيل سابق: هل أُنشئت فعلاً على Facebook؟"""
+        in_flight = [item for item in items.values() if item['status'] == 'running']
+        if not in_flight:
+            return
+        for kind in {item['kind'] for item in in_flight}:
+            try:
+                existing = await self._list_names(f"act_{build['account_id']}/{EDGES[kind]}")
+            except GraphAPIError as e:
+                logger.warning(f"Could not list {kind}s for build {build['id']}: {e}")
+                existing = {}
+            for item in in_flight:
+                if item['kind'] != kind:
+                    continue
+                remote_id = existing.get(self._name(build, item))
+                await asyncio.to_thread(self._set_item, build['id'], item,
+                                        'done' if remote_id else 'pending', remote_id=remote_id)
+
+    async def _list_names(self, path: str) -> Dict[str, str]:
+        names, after = {}, None
+        while True:
+            page = await self.graph.get(path, {'fields': 'id,name', 'limit': 500, 'after': after})
+            names.update({obj.get('name'): obj['id'] for obj in page.get('data', [])})
+            paging = page.get('paging') or {}
+            after = paging.get('cursors', {}).get('after') if paging.get('next') else None
+            if not after:
+                return names
+
+    @staticmethod
+    def _is_transient(error: GraphAPIError) -> bool:
+        return (
+            error.status_code == 0 or error.status_code == 429 or error.status_code >= 500
+            or error.error.get('is_transient') is True or error.error.get('code') in TRANSIENT_ERROR_CODES
+        )
+
+    # ==================== المعاملات ====================
+
+    def _params(self, build: Dict, item: Dict, items: Dict[str, Dict]) -> Dict[str, Any]:
+        spec = build['spec']
+        params: Dict[str, Any] = {'name': self._name(build, item), 'status': 'PAUSED'}
+        if item['kind'] == 'campaign':
+            params.update(objective=spec['objective'], special_ad_categories=[])
+        elif item['kind'] == 'adset':
+            adsets = sum(1 for i in items.values() if i['kind'] == 'adset')
+            params.update(
+                campaign_id=items['campaign']['remote_id'],
+                daily_budget=int(spec['daily_budget'] / adsets * 100),  # بالسنت
+                billing_event='IMPRESSIONS',
+                optimization_goal=OPTIMIZATION_GOALS.get(spec['objective'], 'REACH'),
+                targeting={'geo_locations': {'countries': spec['countries']}},
+            )
+        else:
+            product = spec['products'][item['product_index']]
+            params.update(
+                adset_id=items[item['parent_key']]['remote_id'],
+                creative={'object_story_spec': {
+                    'page_id': spec['page_id'],
+                    'link_data': {
+                        'name': product.get('name', ''),
+                        'message': product.get('description', ''),
+                        'link': product.get('url') or product.get('link', ''),
+                    },
+                }},
+            )
+        return params
+
+    @staticmethod
+    def _name(build: Dict, item: Dict) -> str:
+        # العلامة [b<id>:<key>] تجعل الاسم فريداً للبحث عنه عند الاستئناف
+        return f"{build['name']} | {item['item_key']} [b{build['id']}:{item['item_key']}]"
+
+    # ==================== قاعدة البيانات ====================
+
+    def _load_build(self, build_id: int) -> Optional[Dict[str, Any]]:
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM campaign_builds WHERE id = ?", (build_id,)).fetchone()
+        if not row:
+            conn.close()
+            return None
+        build = dict(row)
+        build['spec'] = json.loads(build['spec'])
+        build['items'] = {
+            r['item_key']: dict(r)
+            for r in conn.execute("SELECT * FROM campaign_build_items WHERE build_id = ? ORDER BY rowid", (build_id,))
+        }
+        conn.close()
+        return build
+
+    def _set_item(self, build_id: int, item: Dict, status: str, remote_id: Optional[str] = None,
+                  attempts: Optional[int] = None, error: Optional[str] = None):
+        item['status'] = status
+        item['remote_id'] = remote_id or item['remote_id']
+        item['attempts'] = attempts if attempts is not None else item['attempts']
+        item['error'] = error
+        now = datetime.now().isoformat()
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.execute(
+                """UPDATE campaign_build_items SET status = ?, remote_id = ?, attempts = ?, error = ?, updated_at = ?
+                   WHERE build_id = ? AND item_key = ?""",
+                (status, item['remote_id'], item['attempts'], error, now, build_id, item['item_key'])
+            )
+            # تجديد الـ lease مع كل عنصر
+            conn.execute("UPDATE campaign_builds SET updated_at = ? WHERE id = ?", (now, build_id))
+        conn.close()
+
+    def _lease_cutoff(self) -> str:
+        return (datetime.now() - timedelta(seconds=self.lease_seconds)).isoformat()
+
+    def _claim_build(self, build_id: int) -> bool:
+        """حجز البناء للتنفيذ - يفشل إذا كان running وما زال يتحدث (عملية أخرى تنفذه)"""
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            claimed = conn.execute(
+                """UPDATE campaign_builds SET status = 'running', updated_at = ?
+                   WHERE id = ? AND NOT (status = 'running' AND updated_at >= ?)""",
+                (datetime.now().isoformat(), build_id, self._lease_cutoff())
+            ).rowcount
+        conn.close()
+        return claimed == 1
+
+    def _is_leased(self, build_id: int) -> bool:
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute("SELECT 1 FROM campaign_builds WHERE id = ? AND status = 'running' AND updated_at >= ?",
+                           (build_id, self._lease_cutoff())).fetchone()
+        conn.close()
+        return row is not None
+
+    def _set_build(self, build_id: int, status: str, campaign_id: Optional[str] = None):
+        self._execute(
+            "UPDATE campaign_builds SET status = ?, campaign_id = COALESCE(?, campaign_id), updated_at = ? WHERE id = ?",
+            (status, campaign_id, datetime.now().isoformat(), build_id)
+        )
+
+    def _execute(self, query: str, params: tuple):
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.execute(query, params)
+        conn.close()
+
+    def get_build(self, build_id: int) -> Optional[Dict[str, Any]]:
+        """حالة البناء وكل عناصره"""
+        build = self._load_build(build_id)
+        if build:
+            build['items'] = list(build['items'].values())
+        return build
+
+
+def _get_db_path() -> str:
+    from app.services.crm_database import db
+    return db.db_path
+
+
+campaign_builder = CampaignBuilder(_get_db_path())
+
+
+if __name__ == '__main__':
+    # 8 استراتيجيات × 12 منتج = 104 عنصر أمام Graph محلي بزمن 50ms وأخطاء مؤقتة 10%
+    from app.core.graph_stub import GraphStubServer, FakeGraphAPI
+    from app.services.http_client import http_client
+
+    async def bench(db_path: str = '/tmp/brilliox_builder_bench.db'):
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        strategies = [f"S{i}" for i in range(8)]
+        products = [{'name': f"P{i}", 'description': 'عرض', 'url': 'https://example.com'} for i in range(12)]
+        fake = FakeGraphAPI()
+        async with GraphStubServer(fake, latency_ms=50) as stub:
+            builder = CampaignBuilder(db_path, GraphClient('bench', stub.base_url))
+            builder.retry_base_delay = 0.05
+            report = {}
+            for cap in (1, 5, 20):
+                builder.account_concurrency = cap
+                result = await builder.build(f"acct{cap}", 'Bench', 'LEAD_GENERATION', 100, strategies, products)
+                report[f"cap_{cap}_ms"] = result['elapsed_ms']
+
+            # المجموعات تفشل في كل المحاولات فتتعطل إعلاناتها، ثم إعادة الفاشل فقط
+            builder.account_concurrency = 10
+            fake.error_rates = {'adsets': 1.0}
+            first = await builder.build('acct-retry', 'Retry', 'LEAD_GENERATION', 100, strategies[:3], products[:4])
+            fake.error_rates = {'ads': 0.1}
+            requests_before = stub.requests
+            retried = await builder.retry_failed(first['build_id'])
+            report['partial_then_retry'] = {'first': first['items'], 'retry': retried['items'],
+                                            'retry_requests': stub.requests - requests_before}
+
+            # انقطاع: عنصر بحالة running أُنشئ فعلاً على Facebook لا يُنشأ مرة ثانية
+            fake.error_rates = {}
+            build_id = builder.create_build('acct-resume', 'Resume', 'TRAFFIC', 50, strategies[:2], products[:2])
+            done = await builder.run(build_id)
+            builder._execute("UPDATE campaign_build_items SET status = 'running' WHERE build_id = ? AND kind = 'ad'",
+                             (build_id,))
+            builder._execute("UPDATE campaign_builds SET status = 'running' WHERE id = ?", (build_id,))
+            # ما زال يتحدث: عملية أخرى تنفذه، والبناء الجديد (pending) لم يبدأ بعد - لا يُستأنف أي منهما
+            fresh_id = builder.create_build('acct-fresh', 'Fresh', 'TRAFFIC', 50, strategies[:1], products[:1])
+            report['leased'] = await builder.resume_incomplete()
+            # انتهت مدة الـ lease: العملية التي كانت تنفذه توقفت
+            builder._execute("UPDATE campaign_builds SET updated_at = '2000-01-01T00:00:00' WHERE id = ?", (build_id,))
+            ads_before = sum(1 for o in fake.objects.values() if o['edge'] == 'ads')
+            resumed = await builder.resume_incomplete()
+            report['resume'] = {**resumed, 'duplicate_ads': sum(1 for o in fake.objects.values() if o['edge'] == 'ads') - ads_before,
+                                'status': builder.get_build(build_id)['status'], 'first_status': done['status'],
+                                'fresh_status': builder.get_build(fresh_id)['status']}
+            await http_client.close()
+        print(json.dumps(report, indent=2))
+
+        # حد التوازي لكل حساب هو ما يحدد الزمن
+        assert report['cap_1_ms'] > report['cap_5_ms'] > report['cap_20_ms'], report
+        # المحاولة الأولى: الحملة فقط، والإعادة تطلب الفاشل فقط (3 مجموعات + 12 إعلان + إعادات مؤقتة قليلة)
+        retry = report['partial_then_retry']
+        assert retry['first'] == {'done': 1, 'failed': 15}, retry
+        assert retry['retry'] == {'done': 16}, retry
+        assert 15 <= retry['retry_requests'] <= 15 * builder.max_attempts, retry
+        assert report['leased'] == {'resumed': 0, 'completed': 0, 'skipped': 0}, report['leased']
+        resume = report['resume']
+        assert resume['resumed'] == 1 and resume['status'] == 'completed', resume
+        assert resume['duplicate_ads'] == 0, resume
+        assert resume['fresh_status'] == 'pending', resume
+
+    asyncio.run(bench())
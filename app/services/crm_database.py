@@ -2,12 +2,27 @@
 import sqlite3
 import json
 import logging
-from typing import Optional, List, Dict, Any
-from datetime import datetime
+from typing import Optional, List, Dict, Any, Tuple
+from datetime import datetime, timedelta
 from pathlib import Path
 
+from app.core.phone import to_e164
+
 logger = logging.getLogger(__name__)
 
+# PRAGMA user_version بعد حساب phone_e164 / email_normalized للعملاء القدامى
+UNIQUE_KEYS_SCHEMA_VERSION = 1
+
+# الحقول التي تُملأ من الطلب المكرر إذا كانت فارغة عند العميل الموجود
+MERGE_FILL_COLUMNS = ('email', 'email_normalized', 'phone', 'phone_e164', 'company', 'notes')
+
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    """توحيد البريد الإلكتروني للمقارنة"""
+    email = (email or '').strip().lower()
+    return email or None
+
+
 class CRMDatabase:
     def __init__(self, db_path: str = "brilliox_crm.db"):
         self.db_path = db_path
@@ -66,23 +81,157 @@ class CRMDatabase:
             )
         ''')
         
+        # صندوق الرسائل الصادرة (Outbox) - يُرسل في الخلفية مع إعادة المحاولة
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                lead_id INTEGER,
+                channel TEXT NOT NULL DEFAULT 'whatsapp',
+                recipient TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP,
+                locked_until TIMESTAMP,
+                last_error TEXT,
+                provider_message_id TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP,
+                FOREIGN KEY (lead_id) REFERENCES leads(id)
+            )
+        ''')
+        
+        # Webhooks الواردة من WhatsApp - تُحفظ كما هي وتُعالج في الخلفية
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_inbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                locked_until TIMESTAMP,
+                error TEXT,
+                received_at TIMESTAMP NOT NULL,
+                processed_at TIMESTAMP
+            )
+        ''')
+        
+        # رسائل WhatsApp الواردة التي تمت معالجتها (منع التكرار حسب message id)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS inbound_messages (
+                wa_message_id TEXT PRIMARY KEY,
+                lead_id INTEGER,
+                received_at TIMESTAMP,
+                processed_at TIMESTAMP
+            )
+        ''')
+        
+        # أعمدة أضيفت بعد الإصدار الأول
+        self._ensure_column(cursor, 'leads', 'score_decayed_at', 'TIMESTAMP')
+        self._ensure_column(cursor, 'leads', 'phone_e164', 'TEXT')
+        self._ensure_column(cursor, 'leads', 'email_normalized', 'TEXT')
+        self._ensure_column(cursor, 'leads', 'merge_count', 'INTEGER DEFAULT 0')
+        self._ensure_column(cursor, 'leads', 'score_adjustment', 'REAL DEFAULT 0')
+        self._ensure_column(cursor, 'outbox', 'send_started_at', 'TIMESTAMP')
+        # ترحيل لمرة واحدة: مسح كل العملاء عند كل تشغيل مكلف، والعملاء الجدد يُحفظون بالمفتاح أصلاً
+        cursor.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] < UNIQUE_KEYS_SCHEMA_VERSION:
+            self._backfill_unique_key(cursor, 'phone_e164', 'phone', to_e164)
+            self._backfill_unique_key(cursor, 'email_normalized', 'email', normalize_email)
+            cursor.execute(f"PRAGMA user_version = {UNIQUE_KEYS_SCHEMA_VERSION}")
+        
+        # فهارس
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_interactions_lead_id ON interactions (lead_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_lead_id ON tasks (lead_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)')
+        cursor.execute('DROP INDEX IF EXISTS idx_leads_phone_normalized')  # حل محله phone_e164
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_leads_phone_e164 ON leads (phone_e164)')
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_leads_email_normalized ON leads (email_normalized)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_webhook_inbox_status ON webhook_inbox (status, id)')
+        
         conn.commit()
         conn.close()
         logger.info(f"✅ Database initialized: {self.db_path}")
     
+    @staticmethod
+    def _ensure_column(cursor, table: str, column: str, definition: str):
+        """إضافة عمود لجدول موجود إذا لم يكن موجوداً (ترحيل بسيط)"""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    
+    @staticmethod
+    def _backfill_unique_key(cursor, column: str, source_column: str, normalize):
+        """حساب مفتاح فريد للعملاء القدامى - القيمة المكررة تبقى للعميل الأقدم فقط"""
+        cursor.execute(f"SELECT id, {source_column} FROM leads WHERE {column} IS NULL AND {source_column} IS NOT NULL ORDER BY id")
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        cursor.execute(f"SELECT {column} FROM leads WHERE {column} IS NOT NULL")
+        taken = {row[0] for row in cursor.fetchall()}
+        updates, duplicates = [], 0
+        for lead_id, value in rows:
+            key = normalize(value)
+            if not key:
+                continue
+            if key in taken:
+                duplicates += 1
+                continue
+            taken.add(key)
+            updates.append((key, lead_id))
+        if updates:
+            cursor.executemany(f"UPDATE leads SET {column} = ? WHERE id = ?", updates)
+            logger.info(f"Backfilled {column} for {len(updates)} leads")
+        if duplicates:
+            logger.warning(f"{duplicates} leads share a {source_column} with an older lead and were left without {column}")
+    
     def create_lead(self, lead_data: Dict) -> int:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        return self.upsert_lead(lead_data)[0]
+    
+    def upsert_lead(self, lead_data: Dict) -> Tuple[int, bool]:
+        """
+        إضافة عميل أو دمجه مع عميل موجود بنفس الهاتف/البريد في عبارة واحدة
+        يرجع (lead_id, created) - الدمج يملأ الحقول الفارغة فقط ولا يغير بيانات العميل الأصلية
+        """
+        lead_data = dict(lead_data)
+        if lead_data.get('phone'):
+            lead_data['phone_e164'] = to_e164(lead_data['phone'])
+        if lead_data.get('email'):
+            lead_data['email_normalized'] = normalize_email(lead_data['email'])
         if 'tags' in lead_data and isinstance(lead_data['tags'], list):
             lead_data['tags'] = json.dumps(lead_data['tags'])
+        lead_data.setdefault('updated_at', lead_data.get('created_at') or datetime.now().isoformat())
+        
+        conn = sqlite3.connect(self.db_path)
+        try:
+            try:
+                row = conn.execute(self._upsert_query(lead_data), list(lead_data.values())).fetchone()
+            except sqlite3.IntegrityError:
+                # الهاتف يخص عميلاً والبريد يخص عميلاً آخر: الدمج حسب الهاتف ويبقى البريد لصاحبه
+                conn.rollback()
+                if not lead_data.pop('email_normalized', None):
+                    raise
+                lead_data.pop('email', None)
+                row = conn.execute(self._upsert_query(lead_data), list(lead_data.values())).fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+        lead_id, merge_count = row
+        return lead_id, merge_count == 0
+    
+    @staticmethod
+    def _upsert_query(lead_data: Dict) -> str:
         columns = ', '.join(lead_data.keys())
         placeholders = ', '.join(['?' for _ in lead_data])
-        query = f"INSERT INTO leads ({columns}) VALUES ({placeholders})"
-        cursor.execute(query, list(lead_data.values()))
-        lead_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return lead_id
+        fill = ', '.join(
+            f"{column} = COALESCE(NULLIF(leads.{column}, ''), excluded.{column})"
+            for column in MERGE_FILL_COLUMNS if column in lead_data
+        )
+        merge = f"{fill + ', ' if fill else ''}merge_count = leads.merge_count + 1, updated_at = excluded.updated_at"
+        return f"""INSERT INTO leads ({columns}) VALUES ({placeholders})
+                   ON CONFLICT(phone_e164) DO UPDATE SET {merge}
+                   ON CONFLICT(email_normalized) DO UPDATE SET {merge}
+                   RETURNING id, merge_count"""
     
     def get_lead(self, lead_id: int) -> Optional[Dict]:
         conn = sqlite3.connect(self.db_path)
@@ -103,8 +252,15 @@ class CRMDatabase:
     
     def update_lead(self, lead_id: int, updates: Dict) -> bool:
         updates['updated_at'] = datetime.now().isoformat()
+        if 'score' in updates:
+            # نقاط جديدة = يبدأ التناقص الزمني من الآن
+            updates['score_decayed_at'] = updates['updated_at']
         if 'tags' in updates and isinstance(updates['tags'], list):
             updates['tags'] = json.dumps(updates['tags'])
+        if updates.get('phone'):
+            updates['phone_e164'] = to_e164(updates['phone'])
+        if 'email' in updates:
+            updates['email_normalized'] = normalize_email(updates['email'])
         set_clause = ', '.join([f"{k} = ?" for k in updates.keys()])
         values = list(updates.values()) + [lead_id]
         conn = sqlite3.connect(self.db_path)
@@ -116,6 +272,17 @@ class CRMDatabase:
         conn.close()
         return success
     
+    def get_lead_by_phone(self, phone: str) -> Optional[Dict]:
+        """البحث عن عميل برقم الهاتف بأي صيغة عبر الفهرس الفريد (بدلاً من LIKE)"""
+        e164 = to_e164(phone)
+        if not e164:
+            return None
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM leads WHERE phone_e164 = ?", (e164,)).fetchone()
+        conn.close()
+        return dict(row) if row else None
+    
     def search_leads(self, filters: Dict = None, limit: int = 50, offset: int = 0) -> List[Dict]:
         conn = sqlite3.connect(self.db_path)
         conn.row_factory = sqlite3.Row
@@ -149,7 +316,15 @@ class CRMDatabase:
         conn.close()
         return [dict(row) for row in rows]
     
-    def create_interaction(self, interaction_data: Dict) -> int:
+    def create_interaction(self, interaction_data: Dict, outbox_message: Optional[Dict] = None,
+                           inbound_message_id: Optional[str] = None) -> int:
+        """
+        حفظ تفاعل - ومعه رسالة صادرة في الـ Outbox ضمن نفس المعاملة (اختياري)
+        
+        outbox_message['idempotency_key'] يُشتق من الحدث نفسه (welcome:<lead_id> / reply:<wa_id>)
+        حتى لا تُضاف الرسالة مرتين عند إعادة معالجته - interaction:<id> فقط للرسائل بدون حدث.
+        inbound_message_id: الرسالة الواردة التي هذا ردها تُعلَّم منتهية في نفس المعاملة
+        """
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         columns = ', '.join(interaction_data.keys())
@@ -159,10 +334,145 @@ class CRMDatabase:
         interaction_id = cursor.lastrowid
         cursor.execute("UPDATE leads SET last_contact_at = ? WHERE id = ?", 
                       (datetime.now().isoformat(), interaction_data['lead_id']))
+        if outbox_message:
+            self._enqueue_outbox(cursor, {
+                'lead_id': interaction_data['lead_id'],
+                **outbox_message,
+                'idempotency_key': outbox_message.get('idempotency_key') or f"interaction:{interaction_id}",
+            })
+        if inbound_message_id:
+            cursor.execute("UPDATE inbound_messages SET lead_id = ?, processed_at = ? WHERE wa_message_id = ?",
+                           (interaction_data['lead_id'], datetime.now().isoformat(), inbound_message_id))
         conn.commit()
         conn.close()
         return interaction_id
     
+    # ==================== Outbox ====================
+    
+    def _enqueue_outbox(self, cursor, message: Dict):
+        now = datetime.now().isoformat()
+        cursor.execute(
+            """INSERT INTO outbox (idempotency_key, lead_id, channel, recipient, body, status, next_attempt_at, created_at)
+               VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)
+               ON CONFLICT(idempotency_key) DO NOTHING""",
+            (message['idempotency_key'], message.get('lead_id'), message.get('channel', 'whatsapp'),
+             message['recipient'], message['body'], now, now)
+        )
+    
+    def claim_outbox(self, limit: int = 50, lease_seconds: int = 60) -> List[Dict]:
+        """
+        حجز دفعة من الرسائل المستحقة للإرسال (ومنها المحجوزة التي انتهت مهلتها)
+        
+        حجز انتهى بعد بدء الطلب لمزود الخدمة (send_started_at) قد يكون أُرسل فعلاً:
+        يُعلَّم unknown ولا يُعاد إرساله تلقائياً
+        """
+        now = datetime.now()
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE outbox SET status = 'unknown', locked_until = NULL,
+                      last_error = 'Lease expired after the send started'
+               WHERE status = 'sending' AND locked_until < ? AND send_started_at IS NOT NULL""",
+            (now.isoformat(),)
+        )
+        cursor.execute(
+            """UPDATE outbox SET status = 'sending', attempts = attempts + 1, locked_until = ?
+               WHERE id IN (
+                   SELECT id FROM outbox
+                   WHERE (status = 'pending' AND next_attempt_at <= ?)
+                      OR (status = 'sending' AND locked_until < ?)
+                   ORDER BY id LIMIT ?
+               )
+               RETURNING *""",
+            ((now + timedelta(seconds=lease_seconds)).isoformat(), now.isoformat(), now.isoformat(), limit)
+        )
+        rows = [dict(row) for row in cursor.fetchall()]
+        conn.commit()
+        conn.close()
+        return rows
+    
+    def start_outbox_send(self, outbox_id: int, locked_until: str) -> bool:
+        """علامة بدء الإرسال - False إذا انتهى الحجز وأخذ الرسالة مُرسل آخر"""
+        conn = sqlite3.connect(self.db_path)
+        started = conn.execute(
+            """UPDATE outbox SET send_started_at = ?
+               WHERE id = ? AND status = 'sending' AND locked_until = ?""",
+            (datetime.now().isoformat(), outbox_id, locked_until)
+        ).rowcount
+        conn.commit()
+        conn.close()
+        return bool(started)
+    
+    def complete_outbox(self, outbox_id: int, status: str, provider_message_id: Optional[str] = None,
+                        error: Optional[str] = None, next_attempt_at: Optional[str] = None):
+        """تحديث حالة رسالة بعد محاولة الإرسال (sent / pending لإعادة المحاولة / failed)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            """UPDATE outbox SET status = ?, provider_message_id = COALESCE(?, provider_message_id),
+                      last_error = ?, next_attempt_at = COALESCE(?, next_attempt_at), locked_until = NULL,
+                      send_started_at = NULL,
+                      sent_at = CASE WHEN ? = 'sent' THEN ? ELSE sent_at END
+               WHERE id = ?""",
+            (status, provider_message_id, error, next_attempt_at, status, datetime.now().isoformat(), outbox_id)
+        )
+        conn.commit()
+        conn.close()
+    
+    # ==================== Webhook Inbox ====================
+    
+    def enqueue_webhook(self, payload: str) -> int:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.execute("INSERT INTO webhook_inbox (payload, received_at) VALUES (?, ?)",
+                              (payload, datetime.now().isoformat()))
+        inbox_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return inbox_id
+    
+    def claim_webhooks(self, limit: int = 20, lease_seconds: int = 300) -> List[Dict]:
+        now = datetime.now()
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.execute(
+            """UPDATE webhook_inbox SET status = 'processing', attempts = attempts + 1, locked_until = ?
+               WHERE id IN (
+                   SELECT id FROM webhook_inbox
+                   WHERE status = 'pending' OR (status = 'processing' AND locked_until < ?)
+                   ORDER BY id LIMIT ?
+               )
+               RETURNING id, payload, attempts, received_at""",
+            ((now + timedelta(seconds=lease_seconds)).isoformat(), now.isoformat(), limit)
+        )
+        rows = sorted((dict(row) for row in cursor.fetchall()), key=lambda r: r['id'])
+        conn.commit()
+        conn.close()
+        return rows
+    
+    def complete_webhook(self, inbox_id: int, status: str = 'done', error: Optional[str] = None):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("UPDATE webhook_inbox SET status = ?, error = ?, locked_until = NULL, processed_at = ? WHERE id = ?",
+                     (status, error, datetime.now().isoformat(), inbox_id))
+        conn.commit()
+        conn.close()
+    
+    def begin_inbound_message(self, wa_message_id: str, received_at: str) -> bool:
+        """تسجيل رسالة واردة - False إذا تمت معالجتها من قبل (تكرار من Meta)"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT OR IGNORE INTO inbound_messages (wa_message_id, received_at) VALUES (?, ?)",
+                     (wa_message_id, received_at))
+        processed = conn.execute("SELECT processed_at FROM inbound_messages WHERE wa_message_id = ?",
+                                 (wa_message_id,)).fetchone()[0]
+        conn.commit()
+        conn.close()
+        return processed is None
+    
+    def get_outbox_stats(self) -> Dict[str, int]:
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        conn.close()
+        return {status: count for status, count in rows}
+    
     def create_task(self, task_data: Dict) -> int:
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
@@ -205,6 +515,8 @@ class CRMDatabase:
         leads_by_source = {row[0]: row[1] for row in cursor.fetchall()}
         cursor.execute("SELECT status, COUNT(*) as count FROM leads GROUP BY status")
         leads_by_status = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.execute("SELECT COALESCE(SUM(merge_count), 0) FROM leads")
+        merged_submissions = cursor.fetchone()[0]
         conn.close()
         avg_conversion_rate = (total_conversions / total_leads * 100) if total_leads > 0 else 0
         return {
@@ -215,7 +527,10 @@ class CRMDatabase:
             'avg_conversion_rate': round(avg_conversion_rate, 2),
             'pending_tasks': pending_tasks,
             'leads_by_source': leads_by_source,
-            'leads_by_status': leads_by_status
+            'leads_by_status': leads_by_status,
+            'merged_submissions': merged_submissions,
+            # نسبة الطلبات المكررة التي دُمجت في عميل موجود من إجمالي الطلبات الواردة
+            'dedup_rate': round(merged_submissions / (total_leads + merged_submissions), 4) if total_leads else 0.0
         }
 
 db = CRMDatabase()
@@ -2,13 +2,18 @@
 CRM Service - الدماغ المركزي للنظام 🧠
 يدمج: Database + المحاور الذكي + WhatsApp
 """
+import asyncio
 import logging
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
 
 from app.services.crm_database import db
 from app.services.smart_conversational_ai import SmartConversationalAI
 from app.services.whatsapp_service import WhatsAppService
+from app.services.lead_scoring import scoring_engine
+from app.services.outbox_dispatcher import OutboxDispatcher
+from app.services.message_status import MessageStatusTracker
+from app.services.lead_dedup import LeadDeduplicator
 from app.models.crm_models import LeadCreate, LeadUpdate, get_lead_quality
 
 logger = logging.getLogger(__name__)
@@ -20,15 +25,21 @@ class CRMService:
         self.db = db
         self.ai_agent = SmartConversationalAI()
         self.whatsapp = WhatsAppService()
+        self.receipts = MessageStatusTracker(self.db.db_path)
+        self.outbox = OutboxDispatcher(self.db, self.whatsapp, self.receipts)
         self.auto_respond = True
         self.auto_score = True
     
-    async def create_lead(self, lead_data: LeadCreate) -> Dict:
+    async def create_lead(self, lead_data: LeadCreate, send_welcome: bool = True) -> Dict:
         """إنشاء عميل مع معالجة ذكية"""
         try:
             lead_dict = lead_data.dict()
             lead_dict['created_at'] = datetime.now().isoformat()
-            lead_id = self.db.create_lead(lead_dict)
+            lead_id, created = self.db.upsert_lead(lead_dict)
+            
+            # نفس الشخص من مصدر آخر: تم الدمج في العميل الموجود بدون ترحيب أو مهمة جديدة
+            if not created:
+                return {'success': True, 'action': 'merged', 'lead_id': lead_id, 'lead': self.db.get_lead(lead_id)}
             
             # حساب النقاط الأولية
             if self.auto_score:
@@ -39,15 +50,20 @@ class CRMService:
             # إنشاء مهمة متابعة
             self._create_follow_up_task(lead_id, lead_dict)
             
-            # إرسال رسالة ترحيب واتساب
-            if lead_dict.get('phone'):
-                await self.whatsapp.send_message(
-                    lead_dict['phone'],
-                    f"مرحباً {lead_dict['name']}! شكراً لتواصلك مع Brilliox 🚀\nنحن هنا لمساعدتك في تحقيق أهدافك التسويقية."
-                )
+            # رسالة ترحيب واتساب (تُحفظ في الـ Outbox وتُرسل في الخلفية)
+            if send_welcome and lead_dict.get('phone'):
+                welcome = f"مرحباً {lead_dict['name']}! شكراً لتواصلك مع Brilliox 🚀\nنحن هنا لمساعدتك في تحقيق أهدافك التسويقية."
+                self.db.create_interaction({
+                    'lead_id': lead_id,
+                    'type': 'whatsapp',
+                    'direction': 'outbound',
+                    'description': welcome,
+                    'created_at': datetime.now().isoformat()
+                }, outbox_message={'idempotency_key': f"welcome:{lead_id}", 'recipient': lead_dict['phone'], 'body': welcome})
+                self.outbox.wake()
             
             lead = self.db.get_lead(lead_id)
-            return {'success': True, 'lead_id': lead_id, 'lead': lead}
+            return {'success': True, 'action': 'created', 'lead_id': lead_id, 'lead': lead}
         except Exception as e:
             logger.error(f"Create lead error: {e}")
             return {'success': False, 'error': str(e)}
@@ -59,7 +75,15 @@ class CRMService:
             return {'success': False, 'error': 'Lead not found'}
         interactions = self.db.get_lead_interactions(lead_id)
         trend = await self.ai_agent.analyze_conversation_trend(lead_id)
-        return {'success': True, 'lead': lead, 'interactions': interactions, 'conversation_trend': trend}
+        messaging = self.receipts.get_stats('lead', lead_id)
+        return {'success': True, 'lead': lead, 'interactions': interactions, 'conversation_trend': trend, 'messaging': messaging}
+    
+    async def get_lead_by_phone(self, phone: str) -> Dict:
+        """البحث عن عميل برقم الهاتف (أي صيغة: محلي أو دولي)"""
+        lead = self.db.get_lead_by_phone(phone)
+        if not lead:
+            return {'success': False, 'error': 'Lead not found'}
+        return {'success': True, 'lead': lead}
     
     async def update_lead(self, lead_id: int, updates: LeadUpdate) -> Dict:
         """تحديث بيانات عميل"""
@@ -83,8 +107,14 @@ class CRMService:
         except Exception as e:
             return {'success': False, 'error': str(e)}
     
-    async def handle_incoming_message(self, lead_id: int, message: str, channel: str = 'whatsapp') -> Dict:
-        """معالجة رسالة واردة بذكاء خارق 🚀"""
+    async def handle_incoming_message(self, lead_id: int, message: str, channel: str = 'whatsapp',
+                                      inbound_message_id: Optional[str] = None) -> Dict:
+        """
+        معالجة رسالة واردة بذكاء خارق 🚀
+        
+        inbound_message_id (wa_id من الـ webhook) يصبح مفتاح الرد في الـ Outbox، وتُعلَّم الرسالة
+        الواردة منتهية مع الرد في نفس المعاملة: إعادة معالجتها لا تضيف رداً ثانياً
+        """
         try:
             lead = self.db.get_lead(lead_id)
             if not lead:
@@ -108,28 +138,33 @@ class CRMService:
                 'created_at': datetime.now().isoformat()
             })
             
-            # حفظ رد النظام
+            # حفظ رد النظام - ورد واتساب في الـ Outbox ضمن نفس المعاملة
+            send_reply = channel == 'whatsapp' and self.auto_respond
             self.db.create_interaction({
                 'lead_id': lead_id,
                 'type': 'whatsapp' if channel == 'whatsapp' else 'note',
                 'direction': 'outbound',
                 'description': ai_result['response'],
                 'created_at': datetime.now().isoformat()
-            })
+            }, outbox_message={
+                'idempotency_key': f"reply:{inbound_message_id}" if inbound_message_id else None,
+                'recipient': lead['phone'], 'body': ai_result['response']
+            } if send_reply else None, inbound_message_id=inbound_message_id)
+            if send_reply:
+                self.outbox.wake()
             
-            # تحديث نقاط العميل
-            new_score = min(lead['score'] + ai_result.get('lead_score_change', 0), 5.0)
+            # تحديث نقاط العميل - التعديل يُحفظ أيضاً حتى تحتفظ به إعادة التقييم الشاملة
+            score_change = ai_result.get('lead_score_change', 0)
+            limit = scoring_engine.weights['max_adjustment']
+            new_score = max(0.0, min(lead['score'] + score_change, 5.0))
             new_quality = get_lead_quality(new_score)
             self.db.update_lead(lead_id, {
                 'score': new_score,
+                'score_adjustment': max(-limit, min((lead.get('score_adjustment') or 0.0) + score_change, limit)),
                 'quality': new_quality.value,
                 'last_contact_at': datetime.now().isoformat()
             })
             
-            # إرسال الرد على واتساب
-            if channel == 'whatsapp' and self.auto_respond:
-                await self.whatsapp.send_message(lead['phone'], ai_result['response'])
-            
             # إنشاء مهمة عاجلة إذا لزم الأمر
             if ai_result.get('should_alert_team'):
                 self._create_urgent_task(lead_id, ai_result.get('recommended_action'), 
@@ -144,7 +179,8 @@ class CRMService:
                 'opportunity_score': ai_result.get('opportunity_score'),
                 'lead_score': new_score,
                 'lead_quality': new_quality.value,
-                'should_alert_team': ai_result.get('should_alert_team')
+                'should_alert_team': ai_result.get('should_alert_team'),
+                'reply_queued': send_reply
             }
         except Exception as e:
             logger.error(f"Handle message error: {e}")
@@ -179,7 +215,10 @@ class CRMService:
         try:
             stats = self.db.get_dashboard_stats()
             ai_stats = self.ai_agent.get_stats()
-            return {'success': True, 'stats': stats, 'ai_performance': ai_stats, 'timestamp': datetime.now().isoformat()}
+            outbox_stats = self.db.get_outbox_stats()
+            messaging = {**self.receipts.get_stats(), 'campaigns': self.receipts.get_top_campaigns()}
+            return {'success': True, 'stats': stats, 'ai_performance': ai_stats, 'outbox': outbox_stats,
+                    'messaging': messaging, 'timestamp': datetime.now().isoformat()}
         except Exception as e:
             return {'success': False, 'error': str(e)}
     
@@ -188,20 +227,48 @@ class CRMService:
         pending = self.db.get_pending_tasks(user_id)
         return {'success': True, 'pending_tasks': pending, 'total_pending': len(pending)}
     
+    async def rescore_leads(self) -> Dict:
+        """إعادة تقييم كل العملاء بجدول الأوزان الحالي"""
+        try:
+            return await asyncio.to_thread(scoring_engine.rescore_database, self.db.db_path)
+        except Exception as e:
+            logger.error(f"Rescore error: {e}")
+            return {'success': False, 'error': str(e)}
+    
+    async def dedup_leads(self, dry_run: bool = True) -> Dict:
+        """البحث عن العملاء المكررين ودمجهم (تقرير فقط افتراضياً)"""
+        try:
+            report = await asyncio.to_thread(LeadDeduplicator(self.db.db_path).run, dry_run)
+            return {'success': True, **report}
+        except Exception as e:
+            logger.error(f"Dedup error: {e}")
+            return {'success': False, 'error': str(e)}
+    
+    async def merge_duplicates(self) -> Dict:
+        """دمج العملاء المكررين فعلياً (مهمة خلفية)"""
+        return await asyncio.to_thread(LeadDeduplicator(self.db.db_path).run, False)
+    
+    async def decay_scores(self, batch_size: int = 2000) -> Dict:
+        """تطبيق التناقص الزمني على نقاط العملاء (مهمة دورية)"""
+        scanned, touched, quality_changed = 0, 0, 0
+        last_id = 0
+        now = scoring_engine._epoch_now()
+        while True:
+            batch = await asyncio.to_thread(scoring_engine.decay_batch, self.db.db_path, last_id, batch_size, now)
+            scanned += batch['scanned']
+            touched += batch['touched']
+            quality_changed += batch.get('quality_changed', 0)
+            if batch['scanned'] < batch_size:
+                break
+            last_id = batch['last_id']
+            # إفساح المجال لمعالجة الطلبات بين الدفعات
+            await asyncio.sleep(0)
+        if touched:
+            logger.info(f"Score decay: {touched} leads updated ({quality_changed} changed quality)")
+        return {'rows_scanned': scanned, 'rows_touched': touched, 'quality_changed': quality_changed}
+    
     def _calculate_initial_score(self, lead_data: Dict) -> float:
-        score = 0.0
-        if lead_data.get('name') and lead_data.get('phone'):
-            score += 1.0
-        if lead_data.get('email'):
-            score += 0.5
-        if lead_data.get('company'):
-            score += 0.3
-        high_quality_sources = ['facebook_ad', 'google_ad', 'linkedin_ad', 'referral']
-        if lead_data.get('source') in high_quality_sources:
-            score += 2.0
-        else:
-            score += 1.0
-        return min(round(score, 1), 5.0)
+        return scoring_engine.score_one(lead_data)
     
     def _create_follow_up_task(self, lead_id: int, lead_data: Dict):
         due_date = datetime.now() + timedelta(hours=24)
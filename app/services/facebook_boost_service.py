@@ -2,19 +2,29 @@
 Facebook Boosted Posts Service - الحل الذكي للإعلانات الممولة بدون سجل تجاري
 يستخدم Facebook Graph API مع طريقة Boosted Posts
 """
+import asyncio
 import requests
 from typing import Dict, Any, List, Optional
 import logging
 
+from app.services.graph_client import GraphClient, GraphAPIError, GRAPH_API_BASE
+from app.services.reach_simulator import reach_simulator, ReachSimulator
+
 logger = logging.getLogger(__name__)
 
+# (مهلة الاتصال، مهلة القراءة) للطلبات المتزامنة
+REQUEST_TIMEOUT = (5, 30)
+
 
 class FacebookBoostService:
     """خدمة إنشاء إعلانات ممولة على Facebook بدون Business Manager"""
     
-    def __init__(self, access_token: Optional[str] = None):
+    def __init__(self, access_token: Optional[str] = None, graph: Optional[GraphClient] = None):
         self.access_token = access_token
-        self.base_url = "https://graph.facebook.com/v18.0"
+        self.base_url = GRAPH_API_BASE
+        # جلسة requests للسكربتات المتزامنة، و GraphClient غير المتزامن داخل التطبيق
+        self.session = requests.Session()
+        self.graph = graph or GraphClient(access_token, self.base_url)
         
     def create_post_and_boost(self, page_id: str, post_data: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -40,6 +50,11 @@ class FacebookBoostService:
         Returns:
             معلومات الإعلان المُنشأ
         """
+        try:
+            self.validate_post_data(post_data)
+        except ValueError as e:
+            return {'success': False, 'error': str(e)}
+        
         try:
             # 1. إنشاء المنشور
             post_id = self._create_page_post(page_id, post_data)
@@ -50,14 +65,54 @@ class FacebookBoostService:
             # 2. ترويج المنشور (Boost)
             boost_result = self._boost_post(post_id, post_data)
             
+            return self._boost_response(post_id, boost_result.get('id'), self._estimate_reach(post_data))
+            
+        except Exception as e:
+            logger.error(f"Facebook Boost Error: {e}")
             return {
-                'success': True,
-                'post_id': post_id,
-                'promotion_id': boost_result.get('id'),
-                'message': 'تم إنشاء الإعلان الممول بنجاح ✅',
-                'estimated_reach': self._estimate_reach(post_data),
-                'instructions': self._get_manual_instructions()
+                'success': False,
+                'error': str(e),
+                'alternative_methods': self._get_alternative_methods()
             }
+    
+    async def create_post_and_boost_async(self, page_id: str, post_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        نفس create_post_and_boost بدون حجب الـ event loop
+        
+        رفع الصورة والمنشور والترويج في طلب Graph Batch واحد (رحلة واحدة بدلاً من ثلاث)
+        """
+        try:
+            self.validate_post_data(post_data)
+        except ValueError as e:
+            return {'success': False, 'error': str(e)}
+        
+        try:
+            operations = []
+            post_params = self._post_params(post_data)
+            if post_data.get('image_url'):
+                operations.append(GraphClient.batch_op(
+                    'POST', f"{page_id}/photos", {'url': post_data['image_url'], 'published': False}, name='photo'
+                ))
+                post_params['object_attachment'] = '{result=photo:$.id}'
+            operations.append(GraphClient.batch_op('POST', f"{page_id}/feed", post_params, name='post'))
+            operations.append(GraphClient.batch_op('POST', '{result=post:$.id}/promotions', self._promotion_params(post_data)))
+            
+            results = await self.graph.batch(operations)
+            post_result, boost_result = results[-2], results[-1]
+            
+            if post_result['code'] != 200:
+                if post_data.get('image_url') and results[0]['code'] != 200:
+                    # مثل المسار المتزامن: فشل رفع الصورة لا يمنع نشر المنشور بدونها
+                    logger.warning(f"Photo upload failed, posting without image: {results[0]['body']}")
+                    return await self.create_post_and_boost_async(page_id, {**post_data, 'image_url': None})
+                return {'success': False, 'error': 'فشل إنشاء المنشور', 'details': post_result['body']}
+            
+            # المعايرة تقرأ sqlite - خارج الـ event loop
+            estimated_reach = await asyncio.to_thread(self._estimate_reach, post_data)
+            response = self._boost_response(post_result['body'].get('id'), boost_result['body'].get('id'), estimated_reach)
+            if boost_result['code'] != 200:
+                response['promotion_error'] = boost_result['body'].get('error')
+            return response
             
         except Exception as e:
             logger.error(f"Facebook Boost Error: {e}")
@@ -67,17 +122,53 @@ class FacebookBoostService:
                 'alternative_methods': self._get_alternative_methods()
             }
     
+    @staticmethod
+    def validate_post_data(data: Dict):
+        """الميزانية والمدة والدول تُفحص قبل أي طلب Graph - المنشور لا يُنشر ثم يُرفض"""
+        targeting = data.get('targeting') or {}
+        ReachSimulator._validate([data.get('budget', 10)], [data.get('duration_days', 7)],
+                                 [targeting.get('countries', ['EG'])], ['broad'])
+    
+    def _boost_response(self, post_id: str, promotion_id: Optional[str],
+                        estimated_reach: Optional[Dict]) -> Dict[str, Any]:
+        return {
+            'success': True,
+            'post_id': post_id,
+            'promotion_id': promotion_id,
+            'message': 'تم إنشاء الإعلان الممول بنجاح ✅',
+            'estimated_reach': estimated_reach,
+            'instructions': self._get_manual_instructions()
+        }
+    
+    def _post_params(self, data: Dict) -> Dict[str, Any]:
+        params = {'message': data.get('message', '')}
+        if data.get('link'):
+            params['link'] = data['link']
+        return params
+    
+    def _promotion_params(self, data: Dict) -> Dict[str, Any]:
+        targeting = data.get('targeting', {})
+        return {
+            'budget_rebalance_flag': True,
+            'daily_budget': int(data.get('budget', 10) * 100),  # بالسنت
+            'end_time': self._calculate_end_time(data.get('duration_days', 7)),
+            'targeting': {
+                'geo_locations': {
+                    'countries': targeting.get('countries', ['EG'])
+                },
+                'age_min': targeting.get('age_min', 18),
+                'age_max': targeting.get('age_max', 65),
+                'interests': [
+                    {'name': interest} for interest in targeting.get('interests', [])
+                ]
+            }
+        }
+    
     def _create_page_post(self, page_id: str, data: Dict) -> Optional[str]:
         """إنشاء منشور على الصفحة"""
         endpoint = f"{self.base_url}/{page_id}/feed"
         
-        params = {
-            'message': data.get('message', ''),
-            'access_token': self.access_token
-        }
-        
-        if data.get('link'):
-            params['link'] = data['link']
+        params = {**self._post_params(data), 'access_token': self.access_token}
         
         if data.get('image_url'):
             # رفع الصورة أولاً
@@ -85,7 +176,7 @@ class FacebookBoostService:
             if photo_id:
                 params['object_attachment'] = photo_id
         
-        response = requests.post(endpoint, params=params)
+        response = self.session.post(endpoint, params=params, timeout=REQUEST_TIMEOUT)
         
         if response.status_code == 200:
             return response.json().get('id')
@@ -96,26 +187,9 @@ class FacebookBoostService:
         """ترويج المنشور (Boost)"""
         endpoint = f"{self.base_url}/{post_id}/promotions"
         
-        targeting = data.get('targeting', {})
-        
-        params = {
-            'access_token': self.access_token,
-            'budget_rebalance_flag': True,
-            'daily_budget': int(data.get('budget', 10) * 100),  # بالسنت
-            'end_time': self._calculate_end_time(data.get('duration_days', 7)),
-            'targeting': {
-                'geo_locations': {
-                    'countries': targeting.get('countries', ['EG'])
-                },
-                'age_min': targeting.get('age_min', 18),
-                'age_max': targeting.get('age_max', 65),
-                'interests': [
-                    {'name': interest} for interest in targeting.get('interests', [])
-                ]
-            }
-        }
+        params = {**self._promotion_params(data), 'access_token': self.access_token}
         
-        response = requests.post(endpoint, json=params)
+        response = self.session.post(endpoint, json=params, timeout=REQUEST_TIMEOUT)
         return response.json()
     
     def _upload_photo(self, page_id: str, image_url: str) -> Optional[str]:
@@ -128,45 +202,71 @@ class FacebookBoostService:
             'published': False
         }
         
-        response = requests.post(endpoint, params=params)
+        response = self.session.post(endpoint, params=params, timeout=REQUEST_TIMEOUT)
         
         if response.status_code == 200:
             return response.json().get('id')
         
         return None
     
+    async def _create_page_post_async(self, page_id: str, data: Dict) -> Optional[str]:
+        """إنشاء منشور على الصفحة (غير متزامن)"""
+        params = self._post_params(data)
+        if data.get('image_url'):
+            photo_id = await self._upload_photo_async(page_id, data['image_url'])
+            if photo_id:
+                params['object_attachment'] = photo_id
+        try:
+            return (await self.graph.post(f"{page_id}/feed", params)).get('id')
+        except GraphAPIError as e:
+            logger.error(f"Create post error: {e}")
+            return None
+    
+    async def _boost_post_async(self, post_id: str, data: Dict) -> Dict:
+        """ترويج المنشور (غير متزامن)"""
+        try:
+            return await self.graph.post(f"{post_id}/promotions", self._promotion_params(data))
+        except GraphAPIError as e:
+            return {'error': e.error}
+    
+    async def _upload_photo_async(self, page_id: str, image_url: str) -> Optional[str]:
+        """رفع صورة للصفحة (غير متزامن)"""
+        try:
+            return (await self.graph.post(f"{page_id}/photos", {'url': image_url, 'published': False})).get('id')
+        except GraphAPIError as e:
+            logger.error(f"Photo upload error: {e}")
+            return None
+    
     def _calculate_end_time(self, days: int) -> int:
         """حساب وقت انتهاء الحملة"""
         import time
         return int(time.time()) + (days * 24 * 60 * 60)
     
-    def _estimate_reach(self, data: Dict) -> Dict:
-        """تقدير الوصول المتوقع"""
+    def _estimate_reach(self, data: Dict) -> Optional[Dict]:
+        """
+        تقدير الوصول المتوقع (نفس نموذج محاكي السيناريوهات وأسعاره المعايرة)
+        
+        معلومة إضافية فقط: المنشور نُشر والترويج بدأ، ففشل التقدير يعطي None ولا يُبلغ كفشل
+        """
         budget = data.get('budget', 10)
         days = data.get('duration_days', 7)
-        countries = data.get('targeting', {}).get('countries', ['EG'])
+        targeting = data.get('targeting') or {}
+        countries = targeting.get('countries', ['EG'])
+        audience = 'interests' if targeting.get('interests') else 'broad'
         
-        # متوسط CPM (التكلفة لكل 1000 ظهور) حسب الدولة
-        cpm_rates = {
-            'EG': 1.0,  # مصر
-            'SA': 4.0,  # السعودية
-            'AE': 5.0,  # الإمارات
-            'KW': 3.5,  # الكويت
-            'QA': 4.5,  # قطر
-        }
-        
-        avg_cpm = sum(cpm_rates.get(c, 2.0) for c in countries) / len(countries)
-        
-        total_budget = budget * days
-        estimated_impressions = (total_budget / avg_cpm) * 1000
-        estimated_clicks = estimated_impressions * 0.02  # CTR 2%
+        try:
+            estimate = reach_simulator.estimate(budget, days, countries, audience)
+        except Exception as e:
+            logger.warning(f"Reach estimate failed: {e}")
+            return None
         
         return {
-            'total_budget': f'${total_budget}',
-            'estimated_impressions': f'{int(estimated_impressions):,}',
-            'estimated_clicks': f'{int(estimated_clicks):,}',
-            'estimated_ctr': '2%',
-            'avg_cpm': f'${avg_cpm}'
+            'total_budget': f'${budget * days}',
+            'estimated_impressions': f"{int(estimate['impressions']):,}",
+            'estimated_reach': f"{int(estimate['reach']):,}",
+            'estimated_clicks': f"{int(estimate['clicks']):,}",
+            'estimated_ctr': f"{estimate['ctr'] * 100:.1f}%",
+            'avg_cpm': f"${estimate['cpm']:.2f}"
         }
     
     def _get_manual_instructions(self) -> Dict:
@@ -0,0 +1,176 @@
+"""
+Graph API Client - عميل Facebook Graph API غير متزامن 📘
+يستخدم العميل المشترك (اتصالات keep-alive) مع مهلات محددة، ويدمج الطلبات
+المتتابعة (رفع صورة -> منشور -> ترويج) في طلب Batch واحد بدلاً من عدة رحلات
+"""
+import os
+import json
+import logging
+from urllib.parse import urlencode
+from typing import Dict, Any, List, Optional
+
+try:
+    import httpx
+    HAS_HTTPX = True
+except ImportError:
+    HAS_HTTPX = False
+
+from app.services.http_client import http_client
+
+logger = logging.getLogger(__name__)
+
+GRAPH_API_BASE = os.getenv('FACEBOOK_GRAPH_BASE', 'https://graph.facebook.com/v18.0')
+GRAPH_BATCH_LIMIT = 50
+# مراجع {result=name:$.id} تبقى بدون ترميز حتى يحلّها Graph
+REFERENCE_SAFE = '{}=:$'
+
+
+class GraphAPIError(Exception):
+    """خطأ من Graph API مع كود الحالة وتفاصيل الخطأ"""
+
+    def __init__(self, status_code: int, error: Dict[str, Any]):
+        self.status_code = status_code
+        self.error = error
+        super().__init__(error.get('message') or f"Graph API error {status_code}")
+
+
+class GraphClient:
+    """طلبات Graph API عبر httpx المشترك"""
+
+    def __init__(self, access_token: Optional[str] = None, base_url: Optional[str] = None, client=None):
+        self.access_token = access_token
+        self.base_url = (base_url or GRAPH_API_BASE).rstrip('/')
+        self.client = client
+
+    async def request(self, method: str, path: str, params: Optional[Dict] = None) -> Dict[str, Any]:
+        client = self.client or http_client.get()
+        data = self._encode({**(params or {}), 'access_token': self.access_token})
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        try:
+            if method.upper() == 'GET':
+                response = await client.get(url, params=data)
+            else:
+                response = await client.request(method.upper(), url, data=data)
+        except httpx.HTTPError as e:
+            raise GraphAPIError(0, {'message': f"{type(e).__name__}: {e}"}) from e
+        payload = self._json(response.text)
+        if response.status_code >= 400 or 'error' in payload:
+            raise GraphAPIError(response.status_code, payload.get('error') or payload)
+        return payload
+
+    async def get(self, path: str, params: Optional[Dict] = None) -> Dict[str, Any]:
+        return await self.request('GET', path, params)
+
+    async def post(self, path: str, params: Optional[Dict] = None) -> Dict[str, Any]:
+        return await self.request('POST', path, params)
+
+    @staticmethod
+    def batch_op(method: str, relative_url: str, params: Optional[Dict] = None, name: Optional[str] = None) -> Dict[str, Any]:
+        """
+        عملية واحدة داخل طلب Batch
+
+        يمكن الإشارة لنتيجة عملية سابقة بـ {result=<name>:$.id} داخل relative_url أو القيم
+        """
+        op = {'method': method.upper(), 'relative_url': relative_url}
+        if params:
+            encoded = GraphClient._encode(params)
+            if op['method'] == 'GET':
+                op['relative_url'] += ('&' if '?' in relative_url else '?') + urlencode(encoded, safe=REFERENCE_SAFE)
+            else:
+                op['body'] = urlencode(encoded, safe=REFERENCE_SAFE)
+        if name:
+            op['name'] = name
+            # نتيجة العملية المسماة تبقى في الرد حتى لو استُخدمت كمرجع
+            op['omit_response_on_success'] = False
+        return op
+
+    async def batch(self, operations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """تنفيذ حتى 50 عملية في رحلة واحدة - يرجع {code, body} لكل عملية بنفس الترتيب"""
+        if len(operations) > GRAPH_BATCH_LIMIT:
+            raise ValueError(f"Graph batch is limited to {GRAPH_BATCH_LIMIT} operations")
+        client = self.client or http_client.get()
+        try:
+            response = await client.post(self.base_url, data={
+                'access_token': self.access_token,
+                'batch': json.dumps(operations),
+                'include_headers': 'false',
+            })
+        except httpx.HTTPError as e:
+            raise GraphAPIError(0, {'message': f"{type(e).__name__}: {e}"}) from e
+        payload = self._json(response.text)
+        if response.status_code >= 400 or not isinstance(payload, list):
+            raise GraphAPIError(response.status_code, payload.get('error') or payload)
+        # العملية التي لم تُنفذ (فشلت العملية التي تعتمد عليها) ترجع null
+        return [
+            {'code': item['code'], 'body': self._json(item.get('body'))} if item else
+            {'code': None, 'body': {'error': {'message': 'Operation skipped: a dependency failed'}}}
+            for item in payload
+        ]
+
+    @staticmethod
+    def _encode(params: Dict[str, Any]) -> Dict[str, str]:
+        # Graph يتوقع القيم المركبة (targeting وغيرها) كنص JSON
+        return {
+            key: json.dumps(value) if isinstance(value, (dict, list)) else
+            str(value).lower() if isinstance(value, bool) else str(value)
+            for key, value in params.items() if value is not None
+        }
+
+    @staticmethod
+    def _json(text: Optional[str]) -> Any:
+        if not text:
+            return {}
+        try:
+            return json.loads(text)
+        except ValueError:
+            return {'error': {'message': text[:200]}}
+
+
+if __name__ == '__main__':
+    # مقارنة ثلاث رحلات متتابعة بطلب Batch واحد أمام Graph محلي بزمن استجابة حقيقي تقريباً
+    import time
+    import asyncio
+    from app.core.graph_stub import GraphStubServer, FakeGraphAPI
+    from app.services.facebook_boost_service import FacebookBoostService
+
+    post_data = {'message': 'عرض خاص 🎁', 'image_url': 'https://example.com/a.jpg', 'budget': 20,
+                 'targeting': {'countries': ['EG'], 'interests': ['Marketing']}}
+
+    async def bench(latency_ms: float = 80, runs: int = 10):
+        fake = FakeGraphAPI()
+        async with GraphStubServer(fake, latency_ms=latency_ms) as stub:
+            service = FacebookBoostService('bench-token', GraphClient('bench-token', stub.base_url))
+
+            started = time.perf_counter()
+            for _ in range(runs):
+                post_id = await service._create_page_post_async('page1', post_data)
+                await service._boost_post_async(post_id, post_data)
+            sequential_ms = (time.perf_counter() - started) * 1000 / runs
+            sequential_requests = stub.requests
+
+            started = time.perf_counter()
+            for _ in range(runs):
+                result = await service.create_post_and_boost_async('page1', post_data)
+            batched_ms = (time.perf_counter() - started) * 1000 / runs
+            assert result['success'] and result['promotion_id'], result
+            assert fake.objects[result['post_id']]['object_attachment'] in fake.objects
+
+            # فشل رفع الصورة: المنشور يُنشر بدونها
+            fallback = await service.create_post_and_boost_async('page1', {**post_data, 'image_url': 'not-a-url'})
+            assert fallback['success'] and 'object_attachment' not in fake.objects[fallback['post_id']], fallback
+            await http_client.close()
+
+            batched_requests = (stub.requests - sequential_requests - 2) / runs
+            print(json.dumps({
+                'graph_latency_ms': latency_ms,
+                'sequential': {'ms_per_boost': round(sequential_ms, 1), 'requests_per_boost': sequential_requests / runs},
+                'batched': {'ms_per_boost': round(batched_ms, 1), 'requests_per_boost': batched_requests},
+                'connections': stub.connections,
+            }, indent=2))
+            # ثلاث رحلات (صورة، منشور، ترويج) تصبح رحلة واحدة
+            assert sequential_requests == 3 * runs, sequential_requests
+            assert batched_requests == 1, batched_requests
+            assert batched_ms < sequential_ms / 2, (batched_ms, sequential_ms)
+            assert stub.connections == 1, stub.connections
+
+    asyncio.run(bench())
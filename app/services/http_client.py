@@ -0,0 +1,63 @@
+"""
+Shared HTTP Client - عميل HTTP مشترك طوال عمر التطبيق 🌐
+اتصالات keep-alive مُعاد استخدامها بدلاً من TCP+TLS جديد لكل طلب
+"""
+import os
+import logging
+
+try:
+    import httpx
+    HAS_HTTPX = True
+except ImportError:
+    HAS_HTTPX = False
+
+try:
+    import h2  # noqa: F401 - مطلوب لدعم HTTP/2 في httpx
+    HAS_HTTP2 = True
+except ImportError:
+    HAS_HTTP2 = False
+
+logger = logging.getLogger(__name__)
+
+
+class SharedHTTPClient:
+    """يدير httpx.AsyncClient واحد يُنشأ عند بدء التطبيق ويُغلق عند إيقافه"""
+
+    def __init__(self):
+        self._client = None
+
+    def _build(self):
+        http2 = os.getenv('HTTP2_ENABLED', 'true').lower() == 'true' and HAS_HTTP2
+        client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=int(os.getenv('HTTP_MAX_CONNECTIONS', '100')),
+                max_keepalive_connections=int(os.getenv('HTTP_MAX_KEEPALIVE', '100')),
+                keepalive_expiry=float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '60')),
+            ),
+            timeout=httpx.Timeout(
+                float(os.getenv('HTTP_TIMEOUT', '30')),
+                connect=float(os.getenv('HTTP_CONNECT_TIMEOUT', '5')),
+                pool=float(os.getenv('HTTP_POOL_TIMEOUT', '10')),
+            ),
+        )
+        logger.info(f"✅ Shared HTTP client ready (http2={http2})")
+        return client
+
+    async def start(self):
+        if HAS_HTTPX and self._client is None:
+            self._client = self._build()
+
+    def get(self):
+        """العميل المشترك - يُنشأ عند أول استخدام إذا لم يبدأ التطبيق (سكربتات)"""
+        if self._client is None or self._client.is_closed:
+            self._client = self._build()
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+http_client = SharedHTTPClient()
@@ -0,0 +1,127 @@
+"""
+Idempotency Store - مفاتيح Idempotency-Key في SQLite 🔑
+الطلب الأول يحجز المفتاح (قيد فريد) ثم يحفظ رده، فالإعادة ترجع نفس الرد بدون تكرار
+حتى بعد إعادة التشغيل ومن أي عامل (worker). الطلب المتزامن بنفس المفتاح يُرفض أثناء التنفيذ
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+from typing import Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyStore:
+    """حجز المفاتيح وحفظ الردود"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.ttl_seconds = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', '86400'))
+        # حجز لم يكتمل خلال هذه المدة = عامل توقف أثناء التنفيذ، والمفتاح يُحجز من جديد
+        self.lease_seconds = int(os.getenv('IDEMPOTENCY_LEASE_SECONDS', '120'))
+        self._init_tables()
+
+    def _init_tables(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'pending',
+                response TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys (created_at);
+        ''')
+        conn.commit()
+        conn.close()
+
+    def claim(self, key: str) -> Tuple[str, Optional[Any]]:
+        """
+        حجز المفتاح: ('claimed', None) للطلب الأول، ('done', الرد) إذا اكتمل من قبل،
+        ('in_flight', None) إذا كان طلب آخر بنفس المفتاح يعمل الآن
+        """
+        now = time.time()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                conn.execute(
+                    "DELETE FROM idempotency_keys WHERE created_at < ? OR (status = 'pending' AND updated_at < ?)",
+                    (now - self.ttl_seconds, now - self.lease_seconds)
+                )
+                claimed = conn.execute(
+                    """INSERT INTO idempotency_keys (key, status, created_at, updated_at)
+                       VALUES (?, 'pending', ?, ?) ON CONFLICT(key) DO NOTHING""",
+                    (key, now, now)
+                ).rowcount
+                if claimed:
+                    return 'claimed', None
+                row = conn.execute("SELECT status, response FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+        if row and row[0] == 'done':
+            return 'done', json.loads(row[1])
+        return 'in_flight', None
+
+    def complete(self, key: str, response: Any):
+        """حفظ رد الطلب - الإعادات التالية ترجعه كما هو"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                conn.execute(
+                    "UPDATE idempotency_keys SET status = 'done', response = ?, updated_at = ? WHERE key = ?",
+                    (json.dumps(response, ensure_ascii=False, default=str), time.time(), key)
+                )
+        finally:
+            conn.close()
+
+    def release(self, key: str):
+        """فشل الطلب قبل أن يكتمل: المفتاح يتحرر لتنجح الإعادة"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                conn.execute("DELETE FROM idempotency_keys WHERE key = ? AND status = 'pending'", (key,))
+        finally:
+            conn.close()
+
+    def get_stats(self) -> Dict[str, int]:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM idempotency_keys GROUP BY status").fetchall())
+        finally:
+            conn.close()
+
+
+def _get_db_path() -> str:
+    from app.services.crm_database import db
+    return db.db_path
+
+
+idempotency_store = IdempotencyStore(_get_db_path())
+
+
+if __name__ == '__main__':
+    # عمليتان بنفس المفتاح: واحدة فقط تنفذ، والأخرى ترى in_flight ثم الرد المحفوظ
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'idempotency.db')
+    store = IdempotencyStore(db_path)
+    with ThreadPoolExecutor(8) as pool:
+        states = [state for state, _ in pool.map(store.claim, ['lead:k1'] * 8)]
+    assert states.count('claimed') == 1 and states.count('in_flight') == 7, states
+
+    store.complete('lead:k1', {'success': True, 'lead_id': 42})
+    # متجر جديد على نفس القاعدة = إعادة تشغيل أو عامل آخر
+    assert IdempotencyStore(db_path).claim('lead:k1') == ('done', {'success': True, 'lead_id': 42})
+
+    assert store.claim('lead:k2')[0] == 'claimed'
+    store.release('lead:k2')
+    assert store.claim('lead:k2')[0] == 'claimed'
+
+    store.lease_seconds = 0
+    time.sleep(0.01)
+    assert store.claim('lead:k2')[0] == 'claimed', 'stale in-flight claim was not recovered'
+    print(json.dumps(store.get_stats()))
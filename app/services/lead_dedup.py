@@ -0,0 +1,454 @@
+"""
+Lead Deduplication - دمج العملاء المكررين في قاعدة البيانات الحالية 🧹
+مفاتيح تجميع (نهاية الهاتف، البريد، هيكل الاسم) تحصر المقارنات داخل مجموعات صغيرة
+بدلاً من مقارنة كل عميل بكل عميل، ثم يُدمج كل عنقود في أقدم عميل على دفعات
+"""
+import re
+import json
+import time
+import sqlite3
+import logging
+from difflib import SequenceMatcher
+from typing import Dict, Any, List, Optional, Tuple, Iterable
+
+try:
+    from rapidfuzz.fuzz import ratio as _rapidfuzz_ratio
+    HAS_RAPIDFUZZ = True
+except ImportError:
+    HAS_RAPIDFUZZ = False
+
+from app.core.arabic import ARABIC_DIACRITICS
+
+logger = logging.getLogger(__name__)
+
+
+# ==================== توحيد الأسماء (عربي / لاتيني) ====================
+
+ARABIC_TO_LATIN = str.maketrans({
+    'ا': 'a', 'أ': 'a', 'إ': 'i', 'آ': 'a', 'ء': '', 'ئ': '', 'ؤ': '', 'ى': 'a', 'ة': 'a',
+    'ب': 'b', 'ت': 't', 'ث': 't', 'ج': 'g', 'ح': 'h', 'خ': 'k', 'د': 'd', 'ذ': 'z',
+    'ر': 'r', 'ز': 'z', 'س': 's', 'ش': 's', 'ص': 's', 'ض': 'd', 'ط': 't', 'ظ': 'z',
+    'ع': 'a', 'غ': 'g', 'ف': 'f', 'ق': 'k', 'ك': 'k', 'ل': 'l', 'م': 'm', 'ن': 'n',
+    'ه': 'h', 'و': 'w', 'ي': 'y',
+})
+# حروف لاتينية تُكتب بها نفس الأصوات العربية
+LATIN_DIGRAPHS = (('kh', 'k'), ('sh', 's'), ('th', 't'), ('dh', 'd'), ('gh', 'g'), ('ph', 'f'))
+LATIN_CLASSES = str.maketrans('jqcvp', 'gkkfb')
+VOWELS = re.compile('[aeiouwy]')
+REPEATS = re.compile(r'(.)\1+')
+ABD_PREFIX = re.compile(r'^(abd)(?:el|ul|al|oul|l)?(?=[a-z]{3})')
+NON_LETTERS = re.compile('[^a-z\u0600-\u06FF]+')
+STOP_TOKENS = {'al', 'el', 'ال'}
+
+
+def name_skeleton(name: Optional[str]) -> str:
+    """هيكل ساكن للاسم: "Mohamed El-Sayed" و "محمد السيد" -> "mhmd sd" (كلمات مرتبة)"""
+    if not name:
+        return ''
+    text = ARABIC_DIACRITICS.sub('', name.lower())
+    tokens = []
+    for token in NON_LETTERS.split(text):
+        if not token or token in STOP_TOKENS:
+            continue
+        if token.startswith('عبدال') and len(token) > 5:
+            tokens.extend(('عبد', token[5:]))
+            continue
+        if token.startswith('ال') and len(token) > 3:
+            token = token[2:]
+        elif token[:2] in ('el', 'al') and len(token) > 5:
+            token = token[2:]
+        tokens.extend(ABD_PREFIX.sub(r'\1 ', token.translate(ARABIC_TO_LATIN)).split())
+
+    skeletons = []
+    for token in tokens:
+        for digraph, letter in LATIN_DIGRAPHS:
+            token = token.replace(digraph, letter)
+        token = REPEATS.sub(r'\1', VOWELS.sub('', token.translate(LATIN_CLASSES)))
+        if token:
+            skeletons.append(token)
+    return ' '.join(sorted(skeletons))
+
+
+def canonical_email(email: Optional[str]) -> Optional[str]:
+    email = (email or '').strip().lower()
+    if '@' not in email:
+        return None
+    local, domain = email.rsplit('@', 1)
+    local = local.split('+', 1)[0]
+    if domain in ('gmail.com', 'googlemail.com'):
+        local, domain = local.replace('.', ''), 'gmail.com'
+    return f"{local}@{domain}" if local else None
+
+
+def phone_digits(phone: Optional[str]) -> str:
+    digits = ''.join(filter(str.isdigit, phone or ''))
+    # آخر 9 أرقام تتجاهل اختلاف كود الدولة والصفر المحلي
+    return digits[-9:] if len(digits) >= 8 else ''
+
+
+def similarity(a: str, b: str) -> float:
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    if HAS_RAPIDFUZZ:
+        return _rapidfuzz_ratio(a, b) / 100
+    return SequenceMatcher(None, a, b).ratio()
+
+
+class _UnionFind:
+    def __init__(self):
+        self.parent: Dict[int, int] = {}
+
+    def find(self, x: int) -> int:
+        parent = self.parent.setdefault(x, x)
+        if parent != x:
+            parent = self.parent[x] = self.find(parent)
+        return parent
+
+    def union(self, a: int, b: int):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            # الجذر دائماً أصغر id = أقدم عميل
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+
+# ==================== المحرك ====================
+
+# أعمدة تُملأ معاً من نفس العميل المكرر عند الدمج
+FILL_GROUPS = (('phone', 'phone_e164'), ('email', 'email_normalized'), ('company',), ('notes',))
+
+
+class LeadDeduplicator:
+    """البحث عن العملاء المكررين ودمجهم"""
+
+    JOB_NAME = 'lead_dedup'
+
+    # أوزان درجة التطابق - الاسم وحده لا يكفي للدمج
+    WEIGHTS = {'phone': 0.5, 'email': 0.5, 'name': 0.5, 'company': 0.1}
+
+    def __init__(self, db_path: str, threshold: float = 0.85, max_block_size: int = 50, batch_size: int = 500):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.max_block_size = max_block_size
+        self.batch_size = batch_size
+
+    def run(self, dry_run: bool = True, sample: int = 20) -> Dict[str, Any]:
+        """البحث عن المكررين ودمجهم (أو تقرير فقط عند dry_run)"""
+        started = time.perf_counter()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            report = self._find_clusters(conn)
+            clusters = report.pop('clusters')
+            report['sample'] = self._describe(conn, clusters[:sample])
+            if not dry_run:
+                report['merged_leads'] = self._merge_clusters(conn, clusters)
+        finally:
+            conn.close()
+        report.update({
+            'dry_run': dry_run,
+            'matcher': 'rapidfuzz' if HAS_RAPIDFUZZ else 'difflib',
+            'duration_s': round(time.perf_counter() - started, 2),
+        })
+        return report
+
+    # ==================== البحث ====================
+
+    def _find_clusters(self, conn) -> Dict[str, Any]:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS dedup_keys (block TEXT NOT NULL, lead_id INTEGER NOT NULL)")
+        conn.execute("DELETE FROM dedup_keys")
+
+        total = 0
+        cursor = conn.execute("SELECT id, name, email, phone FROM leads")
+        while rows := cursor.fetchmany(20000):
+            total += len(rows)
+            conn.executemany("INSERT INTO dedup_keys (block, lead_id) VALUES (?, ?)",
+                             ((key, row[0]) for row in rows for key in self._block_keys(*row[1:])))
+
+        # المجموعات التي تحتوي أكثر من عميل فقط هي المرشحة للمقارنة
+        pairs = set()
+        blocks = oversized = 0
+        for block, ids in conn.execute(
+            "SELECT block, group_concat(lead_id) FROM dedup_keys GROUP BY block HAVING COUNT(*) > 1"
+        ):
+            ids = sorted({int(x) for x in ids.split(',')})
+            if len(ids) > self.max_block_size:
+                oversized += 1
+                continue
+            blocks += 1
+            pairs.update((a, b) for i, a in enumerate(ids) for b in ids[i + 1:])
+        conn.execute("DELETE FROM dedup_keys")
+
+        features = self._load_features(conn, {lead_id for pair in pairs for lead_id in pair})
+        union = _UnionFind()
+        matched = 0
+        for a, b in pairs:
+            if self._score(features[a], features[b]) >= self.threshold:
+                union.union(a, b)
+                matched += 1
+
+        groups: Dict[int, List[int]] = {}
+        for lead_id in list(union.parent):
+            groups.setdefault(union.find(lead_id), []).append(lead_id)
+        clusters = sorted((sorted(ids) for ids in groups.values() if len(ids) > 1), key=lambda c: c[0])
+
+        return {
+            'leads_scanned': total,
+            'candidate_blocks': blocks,
+            'oversized_blocks_skipped': oversized,
+            'pairs_compared': len(pairs),
+            'pairs_matched': matched,
+            'clusters': clusters,
+            'duplicate_clusters': len(clusters),
+            'leads_to_remove': sum(len(c) - 1 for c in clusters),
+        }
+
+    @staticmethod
+    def _block_keys(name: Optional[str], email: Optional[str], phone: Optional[str]) -> Iterable[str]:
+        skeleton = name_skeleton(name)
+        tokens = skeleton.split()
+        digits = phone_digits(phone)
+        canonical = canonical_email(email)
+        if digits:
+            yield f"p:{digits}"
+        if canonical:
+            yield f"e:{canonical}"
+            if tokens:
+                yield f"d:{canonical.split('@')[1]}:{tokens[0]}"
+        if len(tokens) >= 2:
+            yield f"n:{skeleton}"
+
+    @staticmethod
+    def _load_features(conn, lead_ids: set) -> Dict[int, Tuple]:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS dedup_candidates (lead_id INTEGER PRIMARY KEY)")
+        conn.execute("DELETE FROM dedup_candidates")
+        conn.executemany("INSERT INTO dedup_candidates VALUES (?)", ((i,) for i in lead_ids))
+        features = {}
+        for lead_id, name, email, phone, company in conn.execute(
+            """SELECT l.id, l.name, l.email, l.phone, l.company
+               FROM dedup_candidates c JOIN leads l ON l.id = c.lead_id"""
+        ):
+            canonical = canonical_email(email)
+            features[lead_id] = (
+                name_skeleton(name),
+                phone_digits(phone),
+                canonical,
+                canonical.split('@')[0] if canonical else None,
+                (company or '').strip().lower(),
+            )
+        conn.execute("DELETE FROM dedup_candidates")
+        return features
+
+    def _score(self, a: Tuple, b: Tuple) -> float:
+        name_a, phone_a, email_a, local_a, company_a = a
+        name_b, phone_b, email_b, local_b, company_b = b
+
+        phone = 0.0
+        if phone_a and phone_b:
+            phone = 1.0 if phone_a == phone_b else 0.5 if phone_a[-7:] == phone_b[-7:] else 0.0
+        email = 0.0
+        if email_a and email_b:
+            email = 1.0 if email_a == email_b else 0.7 if local_a == local_b and len(local_a) >= 4 else 0.0
+        company = 1.0 if company_a and company_a == company_b else 0.0
+
+        w = self.WEIGHTS
+        score = w['phone'] * phone + w['email'] * email + w['name'] * similarity(name_a, name_b) + w['company'] * company
+        return min(score, 1.0)
+
+    @staticmethod
+    def _describe(conn, clusters: List[List[int]]) -> List[List[Dict]]:
+        described = []
+        for cluster in clusters:
+            rows = conn.execute(
+                f"SELECT id, name, phone, email FROM leads WHERE id IN ({','.join('?' * len(cluster))}) ORDER BY id",
+                cluster
+            ).fetchall()
+            described.append([{'id': r[0], 'name': r[1], 'phone': r[2], 'email': r[3]} for r in rows])
+        return described
+
+    # ==================== الدمج ====================
+
+    def _merge_clusters(self, conn, clusters: List[List[int]]) -> int:
+        """نقل التفاعلات والمهام للعميل الأقدم وحذف المكررين - كل دفعة في transaction"""
+        lead_tables = [
+            table for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'leads'")
+            if 'lead_id' in {col[1] for col in conn.execute(f"PRAGMA table_info({table})")}
+        ]
+        has_message_stats = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_stats'"
+        ).fetchone()
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS dedup_map (duplicate_id INTEGER PRIMARY KEY, survivor_id INTEGER NOT NULL)")
+
+        merged = 0
+        for start in range(0, len(clusters), self.batch_size):
+            batch = clusters[start:start + self.batch_size]
+            mapping = [(dup, cluster[0]) for cluster in batch for dup in cluster[1:]]
+            with conn:
+                conn.execute("DELETE FROM dedup_map")
+                conn.executemany("INSERT INTO dedup_map VALUES (?, ?)", mapping)
+                for table in lead_tables:
+                    conn.execute(f"""UPDATE {table} SET lead_id = m.survivor_id FROM dedup_map m
+                                     WHERE {table}.lead_id = m.duplicate_id""")
+                if has_message_stats:
+                    self._merge_message_stats(conn)
+                self._merge_lead_rows(conn, batch)
+            merged += len(mapping)
+        conn.execute("DROP TABLE IF EXISTS dedup_map")
+        logger.info(f"Dedup: merged {merged} duplicate leads into {len(clusters)} leads")
+        return merged
+
+    @staticmethod
+    def _merge_message_stats(conn):
+        conn.execute(
+            """INSERT INTO message_stats (scope, scope_id, sent, delivered, read, failed, read_latency_total_s, read_latency_count)
+               SELECT 'lead', m.survivor_id, SUM(s.sent), SUM(s.delivered), SUM(s.read), SUM(s.failed),
+                      SUM(s.read_latency_total_s), SUM(s.read_latency_count)
+               FROM message_stats s JOIN dedup_map m ON s.scope = 'lead' AND s.scope_id = m.duplicate_id
+               WHERE true GROUP BY m.survivor_id
+               ON CONFLICT(scope, scope_id) DO UPDATE SET
+                   sent = sent + excluded.sent, delivered = delivered + excluded.delivered,
+                   read = read + excluded.read, failed = failed + excluded.failed,
+                   read_latency_total_s = read_latency_total_s + excluded.read_latency_total_s,
+                   read_latency_count = read_latency_count + excluded.read_latency_count"""
+        )
+        conn.execute("DELETE FROM message_stats WHERE scope = 'lead' AND scope_id IN (SELECT duplicate_id FROM dedup_map)")
+
+    @staticmethod
+    def _merge_lead_rows(conn, batch: List[List[int]]):
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = {
+                row['id']: dict(row) for row in conn.execute(
+                    """SELECT l.* FROM leads l
+                       WHERE l.id IN (SELECT duplicate_id FROM dedup_map UNION SELECT survivor_id FROM dedup_map)"""
+                )
+            }
+        finally:
+            conn.row_factory = None
+
+        updates = []
+        for cluster in batch:
+            survivor = rows[cluster[0]]
+            duplicates = [rows[i] for i in cluster[1:] if i in rows]
+            # الحقول الفارغة عند الأقدم تُملأ من أقدم مكرر يملكها - الهاتف/البريد مع صيغتهما
+            # الموحدة زوج واحد من نفس المكرر، وإلا تشير phone_e164 لرقم غير phone
+            fill = {}
+            for group in FILL_GROUPS:
+                group = [c for c in group if c in survivor]
+                if not group or any(survivor[c] for c in group):
+                    continue
+                donor = next((d for d in duplicates if any(d.get(c) for c in group)), None)
+                if donor:
+                    fill.update({c: donor.get(c) for c in group})
+            best = max([survivor] + duplicates, key=lambda r: r.get('score') or 0)
+            fill.update({
+                'score': best.get('score'),
+                'score_adjustment': best.get('score_adjustment'),
+                'quality': best.get('quality'),
+                'merge_count': (survivor.get('merge_count') or 0)
+                               + sum((d.get('merge_count') or 0) + 1 for d in duplicates),
+            })
+            updates.append((survivor['id'], {k: v for k, v in fill.items() if k in survivor}))
+
+        # الحذف أولاً حتى لا تتعارض الفهارس الفريدة (الهاتف/البريد) عند نقلها للعميل الباقي
+        conn.execute("DELETE FROM leads WHERE id IN (SELECT duplicate_id FROM dedup_map)")
+        for lead_id, fields in updates:
+            conn.execute(
+                f"UPDATE leads SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                list(fields.values()) + [lead_id]
+            )
+
+
+def _benchmark(n_leads: int, db_path: str, duplicate_rate: float):
+    """قاعدة تجريبية بعملاء مكررين بصيغ مختلفة (عربي/لاتيني، مع/بدون كود الدولة)"""
+    import os
+    import random
+    from app.core.phone import to_e164
+    from app.services.crm_database import CRMDatabase
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    CRMDatabase(db_path)
+
+    first = [('Mohamed', 'محمد'), ('Ahmed', 'أحمد'), ('Mahmoud', 'محمود'), ('Mostafa', 'مصطفى'),
+             ('Khaled', 'خالد'), ('Omar', 'عمر'), ('Youssef', 'يوسف'), ('Fatma', 'فاطمة'),
+             ('Mariam', 'مريم'), ('Nour', 'نور'), ('Sara', 'سارة'), ('Hassan', 'حسن')]
+    last = [('El-Sayed', 'السيد'), ('Abdelrahman', 'عبد الرحمن'), ('Ibrahim', 'إبراهيم'), ('Hamdy', 'حمدي'),
+            ('Shaker', 'شاكر'), ('Gamal', 'جمال'), ('Tharwat', 'ثروت'), ('Ghoneim', 'غنيم')]
+    random.seed(7)
+    rows, planted = [], 0
+    for i in range(n_leads):
+        f, l = random.choice(first), random.choice(last)
+        phone = f"01{random.randint(0, 2)}{i:08d}"
+        email = f"user{i}@example.com" if i % 3 == 0 else None
+        if random.random() < duplicate_rate:
+            planted += 1
+            if email and random.random() < 0.2:
+                # الأقدم بدون هاتف والمكرر يحمله: الدمج ينقل phone و phone_e164 معاً
+                rows.append((f"{f[0]} {l[0]}", "", None, email))
+                rows.append((f"{f[1]} {l[1]}", phone, to_e164(phone), email.upper()))
+                continue
+            rows.append((f"{f[0]} {l[0]}", phone, to_e164(phone), email))
+            variant_phone = '+2' + phone if random.random() < 0.5 else phone[1:]
+            rows.append((f"{f[1]} {l[1]}", variant_phone, None, None))
+        else:
+            rows.append((f"{f[0]} {l[0]}", phone, to_e164(phone), email))
+
+    conn = sqlite3.connect(db_path)
+    t0 = time.perf_counter()
+    with conn:
+        conn.executemany(
+            "INSERT INTO leads (name, phone, phone_e164, email, source) VALUES (?, ?, ?, ?, 'other')", rows
+        )
+        conn.executemany(
+            "INSERT INTO interactions (lead_id, type, direction, description) VALUES (?, 'whatsapp', 'inbound', 'hi')",
+            ((random.randint(1, len(rows)),) for _ in range(len(rows) // 2))
+        )
+    conn.close()
+    print(f"Seeded {len(rows):,} leads ({planted:,} planted duplicates) in {time.perf_counter() - t0:.1f}s")
+
+    dedup = LeadDeduplicator(db_path)
+    report = dedup.run(dry_run=True, sample=3)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    report = dedup.run(dry_run=False, sample=0)
+    print(json.dumps({k: report[k] for k in ('merged_leads', 'duration_s')}, indent=2))
+
+    conn = sqlite3.connect(db_path)
+    try:
+        remaining = conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+        mismatched = [
+            (phone, e164) for phone, e164 in conn.execute("SELECT phone, phone_e164 FROM leads")
+            if (to_e164(phone) if phone else None) != e164
+        ]
+    finally:
+        conn.close()
+    assert report['merged_leads'] == planted, (report['merged_leads'], planted)
+    assert remaining == len(rows) - planted, (remaining, len(rows), planted)
+    assert not mismatched, mismatched[:5]
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Brilliox lead deduplication")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='البحث عن المكررين (تقرير فقط بدون --apply)')
+    run.add_argument('--db', default='brilliox_crm.db')
+    run.add_argument('--apply', action='store_true', help='تنفيذ الدمج فعلياً')
+    run.add_argument('--threshold', type=float, default=0.85)
+    run.add_argument('--max-block-size', type=int, default=50)
+    run.add_argument('--sample', type=int, default=20)
+
+    bench = sub.add_parser('bench', help='قياس الأداء على بيانات تجريبية')
+    bench.add_argument('--leads', type=int, default=1_000_000)
+    bench.add_argument('--duplicate-rate', type=float, default=0.1)
+    bench.add_argument('--db', default='/tmp/brilliox_dedup_bench.db')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'run':
+        dedup = LeadDeduplicator(args.db, args.threshold, args.max_block_size)
+        print(json.dumps(dedup.run(dry_run=not args.apply, sample=args.sample), ensure_ascii=False, indent=2))
+    else:
+        _benchmark(args.leads, args.db, args.duplicate_rate)
@@ -0,0 +1,391 @@
+"""
+Lead Scoring Engine - محرك تقييم العملاء الموحد ⚡
+جدول أوزان واحد يُطبق على أعمدة NumPy لإعادة تقييم كل العملاء دفعة واحدة
+"""
+import json
+import time
+import sqlite3
+import logging
+import calendar
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+from app.models.crm_models import HOT_SCORE_THRESHOLD, WARM_SCORE_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+
+# جدول الأوزان الافتراضي - يطابق التقييم الأولي الحالي للعملاء
+DEFAULT_WEIGHTS: Dict[str, Any] = {
+    'completeness': {
+        'name_phone': 1.0,
+        'email': 0.5,
+        'company': 0.3,
+    },
+    'sources': {
+        'facebook_ad': 2.0,
+        'google_ad': 2.0,
+        'linkedin_ad': 2.0,
+        'referral': 2.0,
+    },
+    'default_source': 1.0,
+    'interactions': {
+        'per_interaction': 0.2,
+        'max': 1.0,
+    },
+    'time_decay': {
+        'half_life_days': 90,  # None = بدون تناقص زمني
+    },
+    'max_score': 5.0,
+    # حد تعديلات المحاور الذكي المتراكمة (leads.score_adjustment) في الاتجاهين
+    'max_adjustment': 5.0,
+}
+
+
+class LeadScoringEngine:
+    """تقييم العملاء من جدول أوزان تصريحي - صف واحد أو أعمدة كاملة"""
+
+    def __init__(self, weights: Optional[Dict[str, Any]] = None):
+        self.weights = self._merge_weights(DEFAULT_WEIGHTS, weights or {})
+
+    # ==================== التقييم ====================
+
+    def score_one(self, lead: Dict, interaction_count: int = 0, age_days: float = 0.0) -> float:
+        """تقييم عميل واحد (نفس معادلة score_columns)"""
+        scores = self.score_columns(
+            has_name_phone=np.array([bool(lead.get('name') and lead.get('phone'))]),
+            has_email=np.array([bool(lead.get('email'))]),
+            has_company=np.array([bool(lead.get('company'))]),
+            sources=np.array([self._source_value(lead.get('source'))], dtype=object),
+            interaction_counts=np.array([interaction_count]),
+            age_days=np.array([age_days], dtype=np.float64),
+            adjustments=np.array([lead.get('score_adjustment') or 0.0], dtype=np.float64),
+        )
+        return float(scores[0])
+
+    def score_columns(
+        self,
+        has_name_phone: np.ndarray,
+        has_email: np.ndarray,
+        has_company: np.ndarray,
+        sources: np.ndarray,
+        interaction_counts: np.ndarray,
+        age_days: np.ndarray,
+        adjustments: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        تقييم أعمدة كاملة دفعة واحدة - كل المصفوفات بنفس الطول
+
+        adjustments: تعديلات المحاور الذكي المحفوظة لكل عميل، تتناقص مع باقي النقاط
+        """
+        w = self.weights
+        completeness = w['completeness']
+
+        score = (
+            has_name_phone.astype(np.float64) * completeness['name_phone']
+            + has_email.astype(np.float64) * completeness['email']
+            + has_company.astype(np.float64) * completeness['company']
+        )
+
+        source_weights, default_source = w['sources'], w['default_source']
+        score += np.fromiter(
+            (source_weights.get(s, default_source) for s in sources),
+            dtype=np.float64, count=len(sources)
+        )
+
+        interactions = w['interactions']
+        score += np.minimum(interaction_counts * interactions['per_interaction'], interactions['max'])
+        if adjustments is not None:
+            limit = w['max_adjustment']
+            score += np.clip(adjustments, -limit, limit)
+
+        half_life = w['time_decay'].get('half_life_days')
+        if half_life:
+            score *= np.exp2(-np.maximum(age_days, 0.0) / half_life)
+
+        return np.clip(np.round(score, 1), 0.0, w['max_score'])
+
+    @staticmethod
+    def quality_tiers(scores: np.ndarray) -> np.ndarray:
+        """تصنيف الجودة (hot/warm/cold) لمصفوفة نقاط - نفس حدود get_lead_quality"""
+        return np.where(
+            scores >= HOT_SCORE_THRESHOLD, 'hot',
+            np.where(scores >= WARM_SCORE_THRESHOLD, 'warm', 'cold')
+        )
+
+    # ==================== إعادة التقييم الشاملة ====================
+
+    def rescore_database(self, db_path: str, batch_size: int = 50000) -> Dict[str, Any]:
+        """
+        إعادة تقييم كل العملاء في قاعدة البيانات
+
+        يقرأ العملاء على دفعات (keyset على id)، يقيّم كل دفعة كأعمدة NumPy،
+        ثم يكتب فقط الصفوف التي تغيرت في معاملة واحدة لكل دفعة.
+        """
+        started = time.perf_counter()
+        timings = {'load': 0.0, 'score': 0.0, 'write': 0.0}
+        total, updated = 0, 0
+        now = self._epoch_now()
+        decayed_at = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now))
+        last_id = 0
+
+        conn = sqlite3.connect(db_path)
+        try:
+            while True:
+                t0 = time.perf_counter()
+                rows = conn.execute('''
+                    SELECT id,
+                           name IS NOT NULL AND name != '' AND phone IS NOT NULL AND phone != '',
+                           email IS NOT NULL AND email != '',
+                           company IS NOT NULL AND company != '',
+                           COALESCE(source, 'other'),
+                           COALESCE(CAST(strftime('%s', COALESCE(last_contact_at, created_at)) AS INTEGER), ?),
+                           COALESCE(score, 0.0),
+                           COALESCE(quality, ''),
+                           COALESCE(score_adjustment, 0.0)
+                    FROM leads WHERE id > ? ORDER BY id LIMIT ?
+                ''', (now, last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+
+                ids, name_phone, email, company, sources, touched_at, old_scores, old_quality, adjustments = zip(*rows)
+                ids = np.array(ids, dtype=np.int64)
+                counts = self._interaction_counts(conn, int(ids[0]), int(ids[-1]), ids)
+                timings['load'] += time.perf_counter() - t0
+
+                t0 = time.perf_counter()
+                scores = self.score_columns(
+                    has_name_phone=np.array(name_phone, dtype=bool),
+                    has_email=np.array(email, dtype=bool),
+                    has_company=np.array(company, dtype=bool),
+                    sources=np.array(sources, dtype=object),
+                    interaction_counts=counts,
+                    age_days=(now - np.array(touched_at, dtype=np.float64)) / 86400.0,
+                    adjustments=np.array(adjustments, dtype=np.float64),
+                )
+                qualities = self.quality_tiers(scores)
+                changed = np.flatnonzero(
+                    (np.abs(scores - np.array(old_scores, dtype=np.float64)) > 1e-9)
+                    | (qualities != np.array(old_quality, dtype=str))
+                )
+                timings['score'] += time.perf_counter() - t0
+
+                t0 = time.perf_counter()
+                if changed.size:
+                    # النقاط الجديدة تتضمن التناقص حتى الآن
+                    with conn:
+                        conn.executemany(
+                            "UPDATE leads SET score = ?, quality = ?, score_decayed_at = ? WHERE id = ?",
+                            zip(scores[changed].tolist(), qualities[changed].tolist(),
+                                [decayed_at] * int(changed.size), ids[changed].tolist())
+                        )
+                timings['write'] += time.perf_counter() - t0
+
+                total += len(ids)
+                updated += int(changed.size)
+                last_id = int(ids[-1])
+        finally:
+            conn.close()
+
+        result = {
+            'success': True,
+            'leads_scored': total,
+            'leads_updated': updated,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+            'timings_ms': {k: round(v * 1000, 1) for k, v in timings.items()},
+        }
+        logger.info(f"✅ Rescored {total} leads ({updated} updated) in {result['duration_ms']} ms")
+        return result
+
+    # ==================== التناقص الزمني ====================
+
+    def decay_batch(self, db_path: str, after_id: int = 0, batch_size: int = 2000, now: Optional[int] = None) -> Dict[str, Any]:
+        """
+        تطبيق تناقص زمني أُسّي على النقاط الحالية لدفعة واحدة من العملاء
+
+        التناقص يُحسب من آخر نقطة مرجعية (آخر تواصل أو آخر تناقص مُطبق)،
+        والصفوف التي لم تتغير نقاطها لا تُكتب حتى يتراكم التناقص عليها.
+        """
+        half_life = self.weights['time_decay'].get('half_life_days')
+        now = now or self._epoch_now()
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute('''
+                SELECT id, score, COALESCE(quality, ''),
+                       MAX(COALESCE(CAST(strftime('%s', last_contact_at) AS INTEGER), 0),
+                           COALESCE(CAST(strftime('%s', score_decayed_at) AS INTEGER), 0),
+                           COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0))
+                FROM leads WHERE id > ? AND score > 0 ORDER BY id LIMIT ?
+            ''', (after_id, batch_size)).fetchall()
+            if not rows or not half_life:
+                return {'last_id': rows[-1][0] if rows else None, 'scanned': len(rows), 'touched': 0}
+
+            ids, scores, old_quality, reference = (np.array(col) for col in zip(*rows))
+            scores = scores.astype(np.float64)
+            age_days = np.maximum(now - reference.astype(np.float64), 0.0) / 86400.0
+            decayed = np.round(scores * np.exp2(-age_days / half_life), 2)
+            changed = np.flatnonzero(decayed < scores)
+
+            qualities = self.quality_tiers(decayed[changed])
+            if changed.size:
+                # نفس تمثيل التواريخ المحلية بدون منطقة زمنية (انظر _epoch_now)
+                decayed_at = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now))
+                with conn:
+                    conn.executemany(
+                        "UPDATE leads SET score = ?, quality = ?, score_decayed_at = ? WHERE id = ?",
+                        ((s, q, decayed_at, i) for s, q, i in zip(
+                            decayed[changed].tolist(), qualities.tolist(), ids[changed].tolist()
+                        ))
+                    )
+            return {
+                'last_id': int(ids[-1]),
+                'scanned': len(ids),
+                'touched': int(changed.size),
+                'quality_changed': int((qualities != old_quality[changed]).sum()),
+            }
+        finally:
+            conn.close()
+
+    # ==================== أدوات مساعدة ====================
+
+    @staticmethod
+    def _interaction_counts(conn: sqlite3.Connection, first_id: int, last_id: int, ids: np.ndarray) -> np.ndarray:
+        """عدد التفاعلات لكل عميل في نطاق الدفعة"""
+        counts = np.zeros(len(ids), dtype=np.int64)
+        rows = conn.execute(
+            "SELECT lead_id, COUNT(*) FROM interactions WHERE lead_id BETWEEN ? AND ? GROUP BY lead_id",
+            (first_id, last_id)
+        ).fetchall()
+        if rows:
+            lead_ids, values = (np.array(col, dtype=np.int64) for col in zip(*rows))
+            positions = np.searchsorted(ids, lead_ids)
+            positions = np.minimum(positions, len(ids) - 1)
+            found = ids[positions] == lead_ids
+            counts[positions[found]] = values[found]
+        return counts
+
+    @staticmethod
+    def _source_value(source: Any) -> str:
+        return getattr(source, 'value', source) or 'other'
+
+    @staticmethod
+    def _epoch_now() -> int:
+        # التواريخ تُخزن بالتوقيت المحلي بدون منطقة زمنية - نعاملها بنفس الطريقة
+        return calendar.timegm(datetime.now().timetuple())
+
+    @classmethod
+    def _merge_weights(cls, base: Dict, overrides: Dict) -> Dict:
+        merged = dict(base)
+        for key, value in overrides.items():
+            if isinstance(value, dict) and isinstance(base.get(key), dict):
+                merged[key] = cls._merge_weights(base[key], value)
+            else:
+                merged[key] = value
+        return merged
+
+
+scoring_engine = LeadScoringEngine()
+
+
+def _benchmark(n_leads: int, db_path: str):
+    """قياس أداء إعادة التقييم على قاعدة بيانات تجريبية"""
+    import os
+    import random
+    from app.services.crm_database import CRMDatabase
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    CRMDatabase(db_path)
+
+    sources = ['facebook_ad', 'google_ad', 'website', 'whatsapp', 'referral', 'other']
+    conn = sqlite3.connect(db_path)
+    t0 = time.perf_counter()
+    with conn:
+        conn.executemany(
+            """INSERT INTO leads (name, email, phone, company, source, created_at, score_adjustment)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            ((f"lead {i}", f"lead{i}@example.com" if i % 2 else None, f"0100{i:07d}",
+              "ACME" if i % 5 == 0 else None, sources[i % len(sources)],
+              f"2026-{random.randint(1, 9):02d}-{random.randint(1, 28):02d}T10:00:00",
+              random.choice((0.0, 0.0, 0.5, 1.5, -1.0)))
+             for i in range(n_leads))
+        )
+        conn.executemany(
+            "INSERT INTO interactions (lead_id, type, direction, description) VALUES (?, 'whatsapp', 'inbound', 'hi')",
+            ((random.randint(1, n_leads),) for _ in range(n_leads // 2))
+        )
+    conn.close()
+    print(f"Seeded {n_leads:,} leads in {time.perf_counter() - t0:.1f}s")
+
+    result = scoring_engine.rescore_database(db_path)
+    print(json.dumps(result, indent=2))
+    assert result['leads_scored'] == n_leads
+
+    # عينة: score_columns (الدفعات) = score_one (صف واحد) صفاً بصف، والمخزن يتضمن تعديل المحاور
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    sample = [dict(row) for row in conn.execute(
+        "SELECT * FROM leads WHERE id IN (SELECT id FROM leads ORDER BY random() LIMIT 2000) ORDER BY id"
+    )]
+    ids = np.array([lead['id'] for lead in sample], dtype=np.int64)
+    counts = dict(conn.execute(
+        f"SELECT lead_id, COUNT(*) FROM interactions WHERE lead_id IN ({','.join(map(str, ids.tolist()))}) GROUP BY lead_id"
+    ).fetchall())
+    conn.close()
+    now = scoring_engine._epoch_now()
+    ages = np.array([(now - calendar.timegm(datetime.fromisoformat(lead['created_at']).timetuple())) / 86400.0
+                     for lead in sample])
+    batch = scoring_engine.score_columns(
+        has_name_phone=np.array([bool(lead['name'] and lead['phone']) for lead in sample]),
+        has_email=np.array([bool(lead['email']) for lead in sample]),
+        has_company=np.array([bool(lead['company']) for lead in sample]),
+        sources=np.array([lead['source'] for lead in sample], dtype=object),
+        interaction_counts=np.array([counts.get(i, 0) for i in ids.tolist()]),
+        age_days=ages,
+        adjustments=np.array([lead['score_adjustment'] for lead in sample], dtype=np.float64),
+    )
+    single = [scoring_engine.score_one(lead, counts.get(lead['id'], 0), age) for lead, age in zip(sample, ages)]
+    assert batch.tolist() == single, 'score_columns and score_one disagree'
+    # الساعة تقدمت منذ إعادة التقييم: فرق تقريب واحد على الأكثر
+    stored = np.array([lead['score'] for lead in sample])
+    assert np.all(np.abs(stored - batch) <= 0.1 + 1e-9), 'rescore dropped the AI score adjustments'
+
+    # التقييم في الذاكرة فقط (بدون قراءة/كتابة)
+    n = n_leads
+    t0 = time.perf_counter()
+    scoring_engine.score_columns(
+        has_name_phone=np.ones(n, dtype=bool),
+        has_email=np.arange(n) % 2 == 1,
+        has_company=np.arange(n) % 5 == 0,
+        sources=np.array(sources * (n // len(sources) + 1), dtype=object)[:n],
+        interaction_counts=np.random.poisson(0.5, n),
+        age_days=np.random.uniform(0, 365, n),
+    )
+    print(f"In-memory score_columns for {n:,} leads: {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Brilliox lead scoring engine")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    rescore = sub.add_parser('rescore', help='إعادة تقييم كل العملاء')
+    rescore.add_argument('--db', default='brilliox_crm.db')
+    rescore.add_argument('--weights', help='ملف JSON بأوزان بديلة')
+    rescore.add_argument('--batch-size', type=int, default=50000)
+
+    bench = sub.add_parser('bench', help='قياس الأداء على بيانات تجريبية')
+    bench.add_argument('--leads', type=int, default=1_000_000)
+    bench.add_argument('--db', default='/tmp/brilliox_scoring_bench.db')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'rescore':
+        weights = json.load(open(args.weights)) if args.weights else None
+        print(json.dumps(LeadScoringEngine(weights).rescore_database(args.db, args.batch_size), indent=2))
+    else:
+        _benchmark(args.leads, args.db)
@@ -0,0 +1,242 @@
+"""
+Message Status Tracker - إيصالات التسليم والقراءة 📬
+حالة كل رسالة صادرة محفوظة بمعرّف WhatsApp، والإحصائيات (معدل التسليم وزمن القراءة)
+عدادات تراكمية لكل حملة ولكل عميل تُحدَّث مع كل دفعة بدلاً من إعادة حسابها
+"""
+import time
+import sqlite3
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Iterable, Tuple
+
+# أعمدة الحالة في message_status -> عدادها في message_stats
+STATUS_COLUMNS = {
+    'sent': 'sent_ts',
+    'delivered': 'delivered_ts',
+    'read': 'read_ts',
+    'failed': 'failed_ts',
+}
+COUNTERS = ('sent', 'delivered', 'read', 'failed')
+
+
+class MessageStatusTracker:
+    """تسجيل الرسائل الصادرة وتطبيق إيصالات الحالة على دفعات"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._init_tables()
+
+    def _init_tables(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS message_status (
+                wa_message_id TEXT PRIMARY KEY,
+                lead_id INTEGER,
+                campaign_id INTEGER,
+                sent_ts INTEGER,
+                delivered_ts INTEGER,
+                read_ts INTEGER,
+                failed_ts INTEGER,
+                error TEXT,
+                updated_at TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS message_stats (
+                scope TEXT NOT NULL,
+                scope_id INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                delivered INTEGER NOT NULL DEFAULT 0,
+                read INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                read_latency_total_s INTEGER NOT NULL DEFAULT 0,
+                read_latency_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (scope, scope_id)
+            );
+        ''')
+        conn.commit()
+        conn.close()
+
+    # ==================== التسجيل والإيصالات ====================
+
+    def register_sent(self, messages: Iterable[Tuple[str, Optional[int], Optional[int]]], sent_ts: Optional[int] = None):
+        """تسجيل رسائل أُرسلت بنجاح: (wa_message_id, lead_id, campaign_id)"""
+        sent_ts = sent_ts or int(time.time())
+        events = {}
+        for wa_id, lead_id, campaign_id in messages:
+            if wa_id:
+                events.setdefault(wa_id, []).append({'status': 'sent', 'ts': sent_ts, 'lead_id': lead_id, 'campaign_id': campaign_id})
+        self._apply(events)
+
+    def apply_statuses(self, statuses: List[Dict[str, Any]]) -> int:
+        """تطبيق دفعة من كائنات statuses كما تصل في webhook من WhatsApp"""
+        events: Dict[str, List[Dict]] = {}
+        pending = []
+        for status in statuses:
+            wa_id, kind = status.get('id'), status.get('status')
+            if not wa_id or kind not in STATUS_COLUMNS:
+                continue
+            errors = status.get('errors') or [{}]
+            pending.append((wa_id, {
+                'status': kind,
+                'ts': int(status.get('timestamp') or time.time()),
+                'error': errors[0].get('title') if kind == 'failed' else None,
+            }))
+        # نفس الرسالة قد تظهر بأكثر من حالة في الدفعة الواحدة
+        for wa_id, event in pending:
+            events.setdefault(wa_id, []).append(event)
+        self._apply(events)
+        return len(pending)
+
+    def _apply(self, events: Dict[str, List[Dict]]):
+        if not events:
+            return
+        now = datetime.now().isoformat()
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            # BEGIN IMMEDIATE: القراءة ثم الكتابة تحت قفل واحد حتى لا تُحسب الحالة مرتين
+            conn.execute('BEGIN IMMEDIATE')
+            existing = self._load(conn, list(events))
+            deltas: Dict[Tuple[str, int], Dict[str, int]] = {}
+            rows = []
+            for wa_id, incoming in events.items():
+                before = existing.get(wa_id) or {
+                    'lead_id': None, 'campaign_id': None, 'error': None,
+                    **{column: None for column in STATUS_COLUMNS.values()}
+                }
+                after = dict(before)
+                for event in incoming:
+                    self._merge(after, event)
+                self._accumulate(deltas, before, after)
+                rows.append((wa_id, after['lead_id'], after['campaign_id'], after['sent_ts'], after['delivered_ts'],
+                             after['read_ts'], after['failed_ts'], after['error'], now))
+
+            conn.executemany(
+                """INSERT INTO message_status
+                   (wa_message_id, lead_id, campaign_id, sent_ts, delivered_ts, read_ts, failed_ts, error, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(wa_message_id) DO UPDATE SET
+                       lead_id = excluded.lead_id, campaign_id = excluded.campaign_id,
+                       sent_ts = excluded.sent_ts, delivered_ts = excluded.delivered_ts,
+                       read_ts = excluded.read_ts, failed_ts = excluded.failed_ts,
+                       error = excluded.error, updated_at = excluded.updated_at""",
+                rows
+            )
+            conn.executemany(
+                """INSERT INTO message_stats
+                   (scope, scope_id, sent, delivered, read, failed, read_latency_total_s, read_latency_count)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(scope, scope_id) DO UPDATE SET
+                       sent = sent + excluded.sent, delivered = delivered + excluded.delivered,
+                       read = read + excluded.read, failed = failed + excluded.failed,
+                       read_latency_total_s = read_latency_total_s + excluded.read_latency_total_s,
+                       read_latency_count = read_latency_count + excluded.read_latency_count""",
+                [
+                    (scope, scope_id, *(d[c] for c in COUNTERS), d['latency_s'], d['latency_n'])
+                    for (scope, scope_id), d in deltas.items() if any(d.values())
+                ]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _load(conn, wa_ids: List[str]) -> Dict[str, Dict]:
+        found = {}
+        for start in range(0, len(wa_ids), 500):
+            chunk = wa_ids[start:start + 500]
+            cursor = conn.execute(
+                f"""SELECT wa_message_id, lead_id, campaign_id, sent_ts, delivered_ts, read_ts, failed_ts, error
+                    FROM message_status WHERE wa_message_id IN ({','.join('?' * len(chunk))})""",
+                chunk
+            )
+            columns = [c[0] for c in cursor.description]
+            for row in cursor.fetchall():
+                found[row[0]] = dict(zip(columns[1:], row[1:]))
+        return found
+
+    @staticmethod
+    def _merge(state: Dict, event: Dict):
+        """الحالة تتقدم فقط: read يعني delivered و sent، ويُحتفظ بأقدم طابع زمني لكل حالة"""
+        if event.get('lead_id') is not None:
+            state['lead_id'] = event['lead_id']
+        if event.get('campaign_id') is not None:
+            state['campaign_id'] = event['campaign_id']
+        implied = {
+            'sent': ('sent',),
+            'delivered': ('sent', 'delivered'),
+            'read': ('sent', 'delivered', 'read'),
+            'failed': ('failed',),
+        }[event['status']]
+        for status in implied:
+            column = STATUS_COLUMNS[status]
+            if state[column] is None or event['ts'] < state[column]:
+                state[column] = event['ts']
+        if event.get('error'):
+            state['error'] = event['error']
+
+    @staticmethod
+    def _accumulate(deltas: Dict, before: Dict, after: Dict):
+        def flags(state):
+            return {status: int(state[column] is not None) for status, column in STATUS_COLUMNS.items()}
+
+        old, new = flags(before), flags(after)
+        latency_old = MessageStatusTracker._read_latency(before)
+        latency_new = MessageStatusTracker._read_latency(after)
+
+        scopes = [('all', 0, old, latency_old)]
+        # رسالة سُجّلت حالتها قبل ربطها بعميل/حملة: تُضاف عداداتها السابقة للنطاق الجديد
+        for scope, key in (('lead', 'lead_id'), ('campaign', 'campaign_id')):
+            if after[key] is not None:
+                known = before[key] == after[key]
+                scopes.append((scope, after[key], old if known else dict.fromkeys(COUNTERS, 0),
+                               latency_old if known else None))
+
+        for scope, scope_id, baseline, baseline_latency in scopes:
+            delta = deltas.setdefault((scope, scope_id), {**dict.fromkeys(COUNTERS, 0), 'latency_s': 0, 'latency_n': 0})
+            for status in COUNTERS:
+                delta[status] += new[status] - baseline[status]
+            if latency_new is not None and baseline_latency is None:
+                delta['latency_s'] += latency_new
+                delta['latency_n'] += 1
+
+    @staticmethod
+    def _read_latency(state: Dict) -> Optional[int]:
+        if state['read_ts'] is None or state['sent_ts'] is None:
+            return None
+        return max(0, state['read_ts'] - state['sent_ts'])
+
+    # ==================== الإحصائيات ====================
+
+    def get_stats(self, scope: str = 'all', scope_id: int = 0) -> Dict[str, Any]:
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute(
+            """SELECT sent, delivered, read, failed, read_latency_total_s, read_latency_count
+               FROM message_stats WHERE scope = ? AND scope_id = ?""",
+            (scope, scope_id)
+        ).fetchone()
+        conn.close()
+        return self._format(row)
+
+    def get_top_campaigns(self, limit: int = 5) -> List[Dict[str, Any]]:
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            """SELECT scope_id, sent, delivered, read, failed, read_latency_total_s, read_latency_count
+               FROM message_stats WHERE scope = 'campaign' ORDER BY scope_id DESC LIMIT ?""",
+            (limit,)
+        ).fetchall()
+        conn.close()
+        return [{'campaign_id': row[0], **self._format(row[1:])} for row in rows]
+
+    @staticmethod
+    def _format(row) -> Dict[str, Any]:
+        sent, delivered, read, failed, latency_total, latency_count = row or (0, 0, 0, 0, 0, 0)
+        return {
+            'sent': sent,
+            'delivered': delivered,
+            'read': read,
+            'failed': failed,
+            'delivery_rate': round(delivered / sent, 4) if sent else 0.0,
+            'read_rate': round(read / sent, 4) if sent else 0.0,
+            'avg_read_latency_s': round(latency_total / latency_count, 1) if latency_count else None,
+        }
@@ -0,0 +1,99 @@
+"""
+Outbox Dispatcher - إرسال الرسائل الصادرة في الخلفية 📤
+الطلبات تحفظ الرسالة في جدول outbox وتعود فوراً، والمُرسل يفرغ الجدول
+بحد أقصى للتوازي وإعادة محاولة بتأخير أُسّي
+"""
+import os
+import random
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any
+
+from app.services.background_jobs import scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxDispatcher:
+    """يفرغ جدول outbox عبر WhatsAppService"""
+
+    JOB_NAME = 'outbox'
+
+    def __init__(self, db, whatsapp, receipts=None):
+        self.db = db
+        self.whatsapp = whatsapp
+        self.receipts = receipts
+        self.concurrency = int(os.getenv('OUTBOX_CONCURRENCY', '10'))
+        self.batch_size = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+        self.max_attempts = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '6'))
+        self.base_delay = float(os.getenv('OUTBOX_RETRY_BASE_SECONDS', '5'))
+        self.max_delay = float(os.getenv('OUTBOX_RETRY_MAX_SECONDS', '3600'))
+        self.lease_seconds = int(os.getenv('OUTBOX_LEASE_SECONDS', '120'))
+
+    def wake(self):
+        """إيقاظ المُرسل فوراً بعد إضافة رسالة جديدة"""
+        scheduler.trigger(self.JOB_NAME)
+
+    async def dispatch(self) -> Dict[str, Any]:
+        """تفريغ كل الرسائل المستحقة (مهمة دورية)"""
+        totals = {'sent': 0, 'retried': 0, 'failed': 0, 'skipped': 0}
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(message: Dict):
+            async with semaphore:
+                outcome = await self._deliver(message)
+                totals[outcome] += 1
+
+        while True:
+            batch = await asyncio.to_thread(self.db.claim_outbox, self.batch_size, self.lease_seconds)
+            if not batch:
+                break
+            await asyncio.gather(*[deliver(message) for message in batch])
+            if len(batch) < self.batch_size:
+                break
+
+        if any(totals.values()):
+            logger.info(f"Outbox: {totals}")
+        return totals
+
+    async def _deliver(self, message: Dict) -> str:
+        # الانتظار على الـ semaphore قد يتجاوز مهلة الحجز: لا إرسال إذا أخذ الرسالة مُرسل آخر
+        if not await asyncio.to_thread(self.db.start_outbox_send, message['id'], message['locked_until']):
+            return 'skipped'
+        if message['channel'] == 'whatsapp':
+            result = await self.whatsapp.send_message(message['recipient'], message['body'])
+        else:
+            result = {'success': False, 'error': f"Unsupported channel: {message['channel']}", 'status_code': 400}
+
+        if result.get('success'):
+            provider_id = ((result.get('data') or {}).get('messages') or [{}])[0].get('id')
+            await asyncio.to_thread(self.db.complete_outbox, message['id'], 'sent', provider_message_id=provider_id)
+            if self.receipts and provider_id:
+                await asyncio.to_thread(self.receipts.register_sent, [(provider_id, message['lead_id'], None)])
+            return 'sent'
+
+        error = str(result.get('error') or result.get('data'))[:500]
+        if self._is_permanent(result) or message['attempts'] >= self.max_attempts:
+            logger.warning(f"Outbox message {message['idempotency_key']} failed: {error}")
+            await asyncio.to_thread(self.db.complete_outbox, message['id'], 'failed', error=error)
+            return 'failed'
+
+        await asyncio.to_thread(
+            self.db.complete_outbox, message['id'], 'pending',
+            error=error, next_attempt_at=self._next_attempt_at(message['attempts'])
+        )
+        return 'retried'
+
+    @staticmethod
+    def _is_permanent(result: Dict) -> bool:
+        # 4xx (عدا 429) أو خدمة غير مُعدة = لا فائدة من إعادة المحاولة
+        status = result.get('status_code')
+        if status is None:
+            return result.get('error') == 'WhatsApp not configured'
+        return 400 <= status < 500 and status != 429
+
+    def _next_attempt_at(self, attempts: int) -> str:
+        delay = min(self.base_delay * (2 ** (attempts - 1)), self.max_delay)
+        delay *= random.uniform(0.8, 1.2)
+        return (datetime.now() + timedelta(seconds=delay)).isoformat()
@@ -0,0 +1,333 @@
+"""
+Pattern Store - مخزن الردود الناجحة مع بحث التشابه (MinHash + LSH) 🧠
+كل رسالة عميل تتحول لبصمة MinHash من مقاطع حروفها بعد توحيد النص العربي، والبصمات
+مقسمة لشرائح (LSH) في جداول hash: البحث يقارن الرسالة الجديدة بالمرشحين فقط لا بكل
+الأنماط. الأنماط شبه المتطابقة تُدمج، والعدد محدود بحد أقصى مع إزالة الأقل قيمة
+"""
+import os
+import zlib
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.arabic import normalize_arabic
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 64
+BANDS = 16               # 16 شريحة × 4 صفوف: احتمال الترشيح ~64% عند تشابه 0.5 و ~99% عند 0.8
+SHINGLE_SIZE = 3
+# نمط جديد مطابق تقريباً لنمط موجود (الرسالة والرد) يُدمج فيه بدلاً من إضافته
+DEDUP_MESSAGE_SIMILARITY = 0.9
+DEDUP_RESPONSE_SIMILARITY = 0.8
+MAX_PATTERNS = int(os.getenv('PATTERN_STORE_MAX', '20000'))
+EVICT_FRACTION = 0.05
+
+_rng = np.random.default_rng(20240601)
+# hash عالمي (multiply-shift): ((a·x + b) mod 2^64) >> 32 مع a فردي
+_HASH_A = _rng.integers(1, 2 ** 63, size=NUM_PERM, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_HASH_B = _rng.integers(0, 2 ** 63, size=NUM_PERM, dtype=np.uint64)
+
+
+def shingles(text: str) -> set:
+    """مقاطع حروف متداخلة من النص الموحد (تتحمل اختلاف الإملاء أكثر من الكلمات)"""
+    if len(text) <= SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text: str) -> Optional[np.ndarray]:
+    """بصمة MinHash (NUM_PERM قيمة uint32) - None للنص الفارغ"""
+    grams = shingles(normalize_arabic(text))
+    if not grams:
+        return None
+    x = np.fromiter((zlib.crc32(g.encode()) for g in grams), dtype=np.uint64, count=len(grams))
+    with np.errstate(over='ignore'):
+        hashed = (_HASH_A[:, None] * x[None, :] + _HASH_B[:, None]) >> np.uint64(32)
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+def jaccard(a: str, b: str) -> float:
+    """تشابه Jaccard الفعلي بين مقاطع نصين"""
+    sa, sb = shingles(normalize_arabic(a)), shingles(normalize_arabic(b))
+    if not sa or not sb:
+        return 0.0
+    return len(sa & sb) / len(sa | sb)
+
+
+class PatternStore:
+    """أنماط محفوظة في SQLite وفهرس LSH في الذاكرة يُحدَّث مع كل إضافة أو إزالة"""
+
+    def __init__(self, db_path: str, max_patterns: int = MAX_PATTERNS):
+        self.db_path = db_path
+        self.max_patterns = max_patterns
+        self.rows_per_band = NUM_PERM // BANDS
+        self._lock = threading.Lock()
+        self._reader_lock = threading.Lock()
+        self._reader: Optional[sqlite3.Connection] = None
+        self._signatures = np.zeros((0, NUM_PERM), dtype=np.uint32)
+        self._slot_ids = np.zeros(0, dtype=np.int64)
+        self._slots: Dict[int, int] = {}
+        self._free: List[int] = []
+        self._buckets: List[Dict[bytes, set]] = [{} for _ in range(BANDS)]
+        self.stats = {'added': 0, 'merged': 0, 'evicted': 0}
+        self._init_tables()
+        self._load()
+
+    def _init_tables(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS learned_patterns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_message TEXT NOT NULL,
+                ai_response TEXT NOT NULL,
+                rating INTEGER,
+                uses INTEGER DEFAULT 1,
+                signature BLOB NOT NULL,
+                created_at TIMESTAMP,
+                last_seen_at TIMESTAMP
+            );
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _load(self):
+        """بناء الفهرس من البصمات المحفوظة (بدون إعادة حسابها)"""
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT id, signature FROM learned_patterns").fetchall()
+        conn.close()
+        for pattern_id, blob in rows:
+            self._index(pattern_id, np.frombuffer(blob, dtype=np.uint32))
+
+    # ==================== الإضافة ====================
+
+    def add(self, user_message: str, ai_response: str, rating: int) -> Optional[Tuple[int, bool]]:
+        """إضافة نمط ناجح - يرجع (id, True) لنمط جديد أو (id, False) عند دمجه في نمط مطابق"""
+        signature = minhash(user_message)
+        if signature is None:
+            return None
+        now = datetime.now().isoformat()
+        # القفل للفهرس في الذاكرة فقط - قراءة وكتابة SQLite خارجه حتى لا ينتظرها البحث
+        with self._lock:
+            ids, similarity = self._score(signature)
+        duplicate = self._find_duplicate(ids[similarity >= DEDUP_MESSAGE_SIMILARITY], ai_response)
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                if duplicate and conn.execute(
+                    # الرد الأعلى تقييماً هو الذي يبقى
+                    """UPDATE learned_patterns SET uses = uses + 1, last_seen_at = ?,
+                           ai_response = CASE WHEN ? > rating THEN ? ELSE ai_response END,
+                           rating = MAX(rating, ?)
+                       WHERE id = ?""",
+                    (now, rating, ai_response, rating, duplicate)
+                ).rowcount:
+                    self.stats['merged'] += 1
+                    return duplicate, False
+                # لا مطابق (أو أُزيل المطابق للتو): نمط جديد
+                pattern_id = conn.execute(
+                    """INSERT INTO learned_patterns
+                       (user_message, ai_response, rating, uses, signature, created_at, last_seen_at)
+                       VALUES (?, ?, ?, 1, ?, ?, ?)""",
+                    (user_message, ai_response, rating, signature.tobytes(), now, now)
+                ).lastrowid
+        finally:
+            conn.close()
+        with self._lock:
+            self._index(pattern_id, signature)
+            self.stats['added'] += 1
+            overflow = len(self._slots) > self.max_patterns
+        if overflow:
+            self._evict()
+        return pattern_id, True
+
+    def _find_duplicate(self, close: np.ndarray, ai_response: str) -> Optional[int]:
+        if not len(close):
+            return None
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            f"SELECT id, ai_response FROM learned_patterns WHERE id IN ({','.join('?' * len(close))})",
+            [int(i) for i in close]
+        ).fetchall()
+        conn.close()
+        for pattern_id, response in rows:
+            if jaccard(response, ai_response) >= DEDUP_RESPONSE_SIMILARITY:
+                return pattern_id
+        return None
+
+    def _evict(self):
+        """إزالة دفعة من الأنماط الأقل قيمة (استخدام × تقييم، ثم الأقدم ظهوراً)"""
+        count = max(1, int(self.max_patterns * EVICT_FRACTION))
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                victims = [row[0] for row in conn.execute(
+                    "SELECT id FROM learned_patterns ORDER BY uses * rating ASC, last_seen_at ASC LIMIT ?", (count,)
+                )]
+                conn.executemany("DELETE FROM learned_patterns WHERE id = ?", [(v,) for v in victims])
+        finally:
+            conn.close()
+        with self._lock:
+            for pattern_id in victims:
+                self._unindex(pattern_id)
+            self.stats['evicted'] += len(victims)
+
+    # ==================== البحث ====================
+
+    def search(self, message: str, k: int = 5, min_similarity: float = 0.3) -> List[Dict[str, Any]]:
+        """أقرب k أنماط ناجحة لرسالة جديدة (التشابه تقدير Jaccard من البصمات)"""
+        signature = minhash(message)
+        if signature is None:
+            return []
+        with self._lock:
+            ids, similarity = self._score(signature)
+        keep = similarity >= min_similarity
+        ids, similarity = ids[keep], similarity[keep]
+        if not len(ids):
+            return []
+        top = np.argpartition(-similarity, k - 1)[:k] if len(ids) > k else np.arange(len(ids))
+        scores = {int(ids[i]): float(similarity[i]) for i in top}
+        # اتصال قراءة دائم: فتح اتصال جديد لكل بحث يضاعف زمنه تقريباً. له قفل خاص لا تنتظره الإضافة
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = sqlite3.connect(self.db_path, check_same_thread=False)
+                self._reader.row_factory = sqlite3.Row
+            rows = self._reader.execute(
+                f"""SELECT id, user_message, ai_response, rating, uses FROM learned_patterns
+                    WHERE id IN ({','.join('?' * len(scores))})""",
+                list(scores)
+            ).fetchall()
+        results = [{**dict(row), 'similarity': round(scores[row['id']], 3)} for row in rows]
+        return sorted(results, key=lambda r: (r['similarity'], r['rating'] or 0, r['uses']), reverse=True)
+
+    def count(self) -> int:
+        return len(self._slots)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'patterns': self.count(),
+            'max_patterns': self.max_patterns,
+            'index_bytes': int(self._signatures.nbytes + self._slot_ids.nbytes),
+        }
+
+    # ==================== الفهرس ====================
+
+    def _score(self, signature: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # الجداول تحمل أرقام الصفوف في مصفوفة البصمات مباشرة
+        candidates = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self._buckets[band].get(key, ()))
+        if not candidates:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        slots = np.array(list(candidates), dtype=np.int64)
+        similarity = (self._signatures[slots] == signature).mean(axis=1)
+        return self._slot_ids[slots], similarity
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        r = self.rows_per_band
+        return [signature[b * r:(b + 1) * r].tobytes() for b in range(BANDS)]
+
+    def _index(self, pattern_id: int, signature: np.ndarray):
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._slots)
+            if slot >= len(self._signatures):
+                # مضاعفة السعة حتى الحد الأقصى فقط
+                capacity = max(min(max(1024, 2 * len(self._signatures)), self.max_patterns + 1), slot + 1)
+                self._signatures = np.resize(self._signatures, (capacity, NUM_PERM))
+                self._slot_ids = np.resize(self._slot_ids, capacity)
+        self._signatures[slot] = signature
+        self._slot_ids[slot] = pattern_id
+        self._slots[pattern_id] = slot
+        for band, key in enumerate(self._band_keys(signature)):
+            self._buckets[band].setdefault(key, set()).add(slot)
+
+    def _unindex(self, pattern_id: int):
+        slot = self._slots.pop(pattern_id, None)
+        if slot is None:
+            return
+        for band, key in enumerate(self._band_keys(self._signatures[slot])):
+            bucket = self._buckets[band].get(key)
+            if bucket:
+                bucket.discard(slot)
+                if not bucket:
+                    del self._buckets[band][key]
+        self._slot_ids[slot] = -1
+        self._free.append(slot)
+
+
+def _get_db_path() -> str:
+    from app.services.crm_database import db
+    return db.db_path
+
+
+pattern_store = PatternStore(_get_db_path())
+
+
+if __name__ == '__main__':
+    # 30,000 رسالة من قوالب مع اختلافات إملائية: سرعة الإضافة والبحث، والدمج، وثبات الذاكرة
+    import json
+    import random
+
+    db_path = '/tmp/brilliox_patterns_bench.db'
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    store = PatternStore(db_path, max_patterns=20000)
+    rng = random.Random(1)
+    templates = ['كم سعر {p} عندكم', 'هل {p} متوفر الان', 'عايز اعرف مواصفات {p}', 'ممكن تفاصيل التوصيل لـ {p}',
+                 'فيه خصم على {p}', 'ازاي اطلب {p}', 'What is the price of {p}', 'مش عاجبني {p} عايز ارجعه']
+    products = [f"{name} {n}" for name in ('لابتوب', 'موبايل', 'ساعة', 'سماعة', 'كاميرا', 'شاشة') for n in range(1000)]
+
+    def variant(text: str) -> str:
+        # أشكال حروف وتشكيل وتطويل مختلفة لنفس الرسالة
+        swaps = [('ا', 'أ'), ('ه', 'ة'), ('ي', 'ى'), ('ع', 'عـ')]
+        for a, b in rng.sample(swaps, 2):
+            text = text.replace(a, b, 1)
+        return text + rng.choice(['', '؟', '??', ' 🙏', '!!'])
+
+    started = time.perf_counter()
+    for i in range(30000):
+        product, template = rng.choice(products), rng.choice(templates)
+        store.add(variant(template.format(p=product)), f"رد عن {product} ({templates.index(template)})", rng.randint(4, 5))
+    add_ms = (time.perf_counter() - started) * 1000 / 30000
+
+    timings = []
+    for _ in range(500):
+        query = variant(rng.choice(templates).format(p=rng.choice(products)))
+        started = time.perf_counter()
+        results = store.search(query, k=5)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+
+    # المقارنة بمسح كل البصمات (بدون LSH)
+    signature = minhash(query)
+    started = time.perf_counter()
+    for _ in range(100):
+        (store._signatures[:len(store._slots)] == signature).mean(axis=1).argsort()
+    scan_ms = (time.perf_counter() - started) * 1000 / 100
+
+    # الرسائل شبه المتطابقة تُدمج، والنمط المزروع هو الأقرب لصيغة أخرى منه
+    assert store.stats['merged'] > 0 and store.count() <= store.max_patterns, store.get_stats()
+    planted = 'عايز احجز موعد صيانة للتكييف بكرة الصبح'
+    planted_id, created = store.add(planted, 'رد مزروع عن الصيانة', 5)
+    assert created
+    assert store.add('عايز أحجز موعد صيانة للتكييف بكره الصبح!!', 'رد مزروع عن الصيانة', 4) == (planted_id, False)
+    top = store.search('عايز احجز موعد صيانه التكييف بكرة الصبح؟', k=5)
+    assert top and top[0]['id'] == planted_id, top[:2]
+
+    print(json.dumps({
+        **store.get_stats(),
+        'add_ms': round(add_ms, 3),
+        'search_p50_ms': round(timings[len(timings) // 2], 3),
+        'search_p99_ms': round(timings[int(len(timings) * 0.99)], 3),
+        'full_scan_ms': round(scan_ms, 3),
+        'example_query': query,
+        'example_top': results[0]['user_message'] if results else None,
+    }, ensure_ascii=False, indent=2))
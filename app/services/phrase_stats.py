@@ -0,0 +1,339 @@
+"""
+Phrase Stats - إحصائيات العبارات في الردود عالية ومنخفضة التقييم 📈
+كل رد مقيَّم تُحسب عباراته (1-3 كلمات) في Count-Min Sketch لكل فئة بوزن يتناقص مع الزمن،
+مع قائمة محدودة لأكثر العبارات تكراراً كمرشحين. الترتيب (log-odds z-score) يُحسب عند الطلب
+من الجداول مباشرة دون إعادة قراءة المحادثات، والذاكرة ثابتة مهما زاد عدد المحادثات
+"""
+import io
+import os
+import math
+import zlib
+import time
+import heapq
+import sqlite3
+import asyncio
+import logging
+import threading
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+
+from app.core.arabic import tokenize
+
+logger = logging.getLogger(__name__)
+
+CLASSES = ('high', 'low')
+MAX_NGRAM = 3
+HALF_LIFE_DAYS = float(os.getenv('PHRASE_STATS_HALF_LIFE_DAYS', '30'))
+# أقل تكرار (بعد التناقص) حتى تظهر العبارة في التوصيات
+MIN_SUPPORT = 3.0
+# عبارة أطول تحل محل عبارتها الفرعية إذا غطّت هذه النسبة من ظهورها (والعكس)
+SUBSUME_RATIO = 0.9
+SAVE_INTERVAL_SECONDS = int(os.getenv('PHRASE_STATS_SAVE_SECONDS', '60'))
+
+_rng = np.random.default_rng(20240602)
+_HASH_A = _rng.integers(1, 2 ** 63, size=8, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_HASH_B = _rng.integers(0, 2 ** 63, size=8, dtype=np.uint64)
+
+
+def ngrams(text: str, max_n: int = MAX_NGRAM) -> set:
+    """عبارات من 1 إلى max_n كلمات (كل عبارة مرة واحدة لكل رد)"""
+    return _token_ngrams(tokenize(text), max_n)
+
+
+def _token_ngrams(tokens: List[str], max_n: int) -> set:
+    grams = set()
+    for n in range(1, max_n + 1):
+        for i in range(len(tokens) - n + 1):
+            gram = tokens[i:i + n]
+            # الكلمة المفردة القصيرة (و، في، من) لا تصلح توصية
+            if n == 1 and len(gram[0]) < 3:
+                continue
+            grams.add(' '.join(gram))
+    return grams
+
+
+def sub_ngrams(gram: str) -> set:
+    """العبارات الأقصر المتصلة داخل العبارة"""
+    tokens = gram.split(' ')
+    return _token_ngrams(tokens, len(tokens) - 1)
+
+
+class PhraseStats:
+    """Count-Min Sketch لكل فئة + مرشحون محدودون + تناقص أسّي (forward decay)"""
+
+    def __init__(self, db_path: Optional[str] = None, width: int = 2 ** 16, depth: int = 4,
+                 max_candidates: int = 2000, half_life_days: float = HALF_LIFE_DAYS):
+        if width & (width - 1):
+            raise ValueError("width must be a power of two")
+        self.db_path = db_path
+        self.width, self.depth = width, depth
+        self.shift = np.uint64(64 - int(math.log2(width)))
+        self._row_offsets = (np.arange(depth) * width)[:, None]
+        self.max_candidates = max_candidates
+        self.tau = half_life_days * 86400 / math.log(2)
+        self._lock = threading.Lock()
+        self._pending_saves = 0
+        self._reset()
+        if db_path:
+            self._init_tables()
+            self._load()
+
+    def _reset(self):
+        # كل الأوزان مخزنة مضروبة في exp((t - t0) / tau): الإضافة لا تلمس القيم القديمة
+        self.t0 = time.time()
+        self.sketch = np.zeros((len(CLASSES), self.depth, self.width), dtype=np.float64)
+        self.docs = np.zeros(len(CLASSES), dtype=np.float64)
+        self.candidates: List[Dict[str, float]] = [{} for _ in CLASSES]
+
+    # ==================== التحديث ====================
+
+    def update(self, response: str, label: str, now: Optional[float] = None) -> int:
+        """إضافة رد لفئته ('high' أو 'low') - يرجع عدد العبارات"""
+        grams = list(ngrams(response))
+        if not grams:
+            return 0
+        c = CLASSES.index(label)
+        now = now or time.time()
+        with self._lock:
+            weight = self._weight(now)
+            if weight > 1e100:
+                self._rescale(now)
+                weight = 1.0
+            columns = self._columns(grams)
+            # العبارات المختلفة قد تقع في نفس الخانة: add.at يجمعها كلها
+            np.add.at(self.sketch[c].reshape(-1), (columns + self._row_offsets).ravel(), weight)
+            self.docs[c] += weight
+            estimates = self.sketch[c, np.arange(self.depth)[:, None], columns].min(axis=0)
+            candidates = self.candidates[c]
+            for gram, estimate in zip(grams, estimates.tolist()):
+                candidates[gram] = estimate
+            if len(candidates) > self.max_candidates * 1.25:
+                kept = heapq.nlargest(self.max_candidates, candidates.items(), key=lambda item: item[1])
+                self.candidates[c] = dict(kept)
+            self._pending_saves += 1
+        return len(grams)
+
+    def _weight(self, now: float) -> float:
+        return math.exp((now - self.t0) / self.tau)
+
+    def _rescale(self, now: float):
+        """إعادة الأساس الزمني قبل أن تتجاوز الأوزان حدود float"""
+        factor = 1.0 / self._weight(now)
+        self.sketch *= factor
+        self.docs *= factor
+        for candidates in self.candidates:
+            for gram in candidates:
+                candidates[gram] *= factor
+        self.t0 = now
+
+    def _columns(self, grams: List[str]) -> np.ndarray:
+        x = np.fromiter((zlib.crc32(g.encode()) for g in grams), dtype=np.uint64, count=len(grams))
+        with np.errstate(over='ignore'):
+            return ((_HASH_A[:self.depth, None] * x[None, :] + _HASH_B[:self.depth, None]) >> self.shift).astype(np.int64)
+
+    # ==================== الاستعلام ====================
+
+    def estimate(self, grams: List[str], now: Optional[float] = None) -> np.ndarray:
+        """التكرار الحالي (بعد التناقص) لكل عبارة في كل فئة - مصفوفة (فئات × عبارات)"""
+        if not grams:
+            return np.zeros((len(CLASSES), 0))
+        columns = self._columns(grams)
+        rows = np.arange(self.depth)[:, None]
+        counts = np.stack([self.sketch[c, rows, columns].min(axis=0) for c in range(len(CLASSES))])
+        return counts / self._weight(now or time.time())
+
+    def lift_scores(self, limit: int = 10, min_support: float = MIN_SUPPORT,
+                    now: Optional[float] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """العبارات الأكثر ارتباطاً بالردود الناجحة ('use') والضعيفة ('avoid')
+
+        الترتيب حسب z-score لـ log-odds (عبارة نادرة لا تتقدم بـ lift كبير من عدد صغير)،
+        والعبارة التي تفسرها عبارة أقصر أو أطول منها تُحذف حتى لا تظهر نفس المعلومة مرتين"""
+        with self._lock:
+            grams = list(set(self.candidates[0]) | set(self.candidates[1]))
+            if not grams or not self.docs.all():
+                return {'use': [], 'avoid': []}
+            counts = self.estimate(grams, now)
+            docs = self.docs / self._weight(now or time.time())
+
+        high, low = counts
+        # تنعيم: عبارة نادرة في الفئتين لا تحصل على lift كبير
+        rate_high = (high + 0.5) / (docs[0] + 1)
+        rate_low = (low + 0.5) / (docs[1] + 1)
+        lift = rate_high / rate_low
+        z = self._log_odds_z(high, low, docs)
+        keep = self._non_redundant(grams, high + low, z)
+
+        def top(mask: np.ndarray, order: np.ndarray) -> List[Dict[str, Any]]:
+            picked = [i for i in order if mask[i]][:limit]
+            return [
+                {'phrase': grams[i], 'lift': round(float(lift[i]), 2), 'z': round(float(z[i]), 2),
+                 'high_count': round(float(high[i]), 1), 'low_count': round(float(low[i]), 1)}
+                for i in picked
+            ]
+
+        return {
+            'use': top(keep & (high >= min_support) & (z > 0), np.argsort(-z)),
+            'avoid': top(keep & (low >= min_support) & (z < 0), np.argsort(z)),
+        }
+
+    @staticmethod
+    def _log_odds_z(high: np.ndarray, low: np.ndarray, docs: np.ndarray, prior: float = 0.5) -> np.ndarray:
+        """log-odds ratio لظهور العبارة في الفئتين مقسوماً على خطئه المعياري"""
+        high_without = np.maximum(docs[0] - high, 0) + prior
+        low_without = np.maximum(docs[1] - low, 0) + prior
+        high, low = high + prior, low + prior
+        delta = np.log(high / high_without) - np.log(low / low_without)
+        return delta / np.sqrt(1 / high + 1 / high_without + 1 / low + 1 / low_without)
+
+    @staticmethod
+    def _non_redundant(grams: List[str], support: np.ndarray, z: np.ndarray) -> np.ndarray:
+        """
+        - عبارة تمتد عبر عبارتين (مثل آخر كلمة من عبارة + أول كلمة من التالية) تُحذف إذا
+          كانت عبارة فرعية منها بنفس الاتجاه وقوة أكبر وتظهر أكثر منها بكثير
+        - العبارة الفرعية تُحذف إذا كانت عبارة أطول تغطي معظم ظهورها (تبقى العبارة الكاملة)
+        """
+        index = {gram: i for i, gram in enumerate(grams)}
+        keep = np.ones(len(grams), dtype=bool)
+        for i, gram in enumerate(grams):
+            for sub in sub_ngrams(gram):
+                j = index.get(sub)
+                if j is None or np.sign(z[j]) != np.sign(z[i]):
+                    continue
+                if support[i] >= SUBSUME_RATIO * support[j]:
+                    keep[j] = False
+                elif abs(z[j]) >= abs(z[i]):
+                    keep[i] = False
+        return keep
+
+    def get_stats(self) -> Dict[str, Any]:
+        weight = self._weight(time.time())
+        return {
+            'documents': {label: round(float(self.docs[c] / weight), 1) for c, label in enumerate(CLASSES)},
+            'candidates': {label: len(self.candidates[c]) for c, label in enumerate(CLASSES)},
+            'sketch_bytes': int(self.sketch.nbytes),
+        }
+
+    # ==================== الحفظ ====================
+
+    def _init_tables(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS phrase_stats_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                t0 REAL,
+                state BLOB,
+                updated_at TIMESTAMP
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    async def persist(self) -> Dict[str, Any]:
+        """حفظ دوري في thread منفصل (الضغط ~30ms) - لا شيء إذا لم تتغير الإحصائيات"""
+        if not self.db_path or not self._pending_saves:
+            return {'saved': False}
+        await asyncio.to_thread(self.save)
+        return {'saved': True}
+
+    def save(self):
+        """حفظ الجداول والمرشحين (حجم ثابت) لاستعادتها بعد إعادة التشغيل"""
+        with self._lock:
+            # نسخة سريعة تحت القفل - الضغط بعده حتى لا تنتظر التحديثات
+            sketch, docs, t0 = self.sketch.copy(), self.docs.copy(), self.t0
+            candidates = [dict(c) for c in self.candidates]
+            self._pending_saves = 0
+        buffer = io.BytesIO()
+        arrays = {}
+        # نصوص وأرقام في مصفوفات عادية: التحميل بدون pickle
+        for c, label in enumerate(CLASSES):
+            arrays[f"phrases_{label}"] = np.array(list(candidates[c]), dtype=str)
+            arrays[f"weights_{label}"] = np.fromiter(candidates[c].values(), dtype=np.float64, count=len(candidates[c]))
+        np.savez_compressed(buffer, sketch=sketch, docs=docs, **arrays)
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.execute(
+                """INSERT INTO phrase_stats_state (id, t0, state, updated_at) VALUES (1, ?, ?, datetime('now'))
+                   ON CONFLICT(id) DO UPDATE SET t0 = excluded.t0, state = excluded.state, updated_at = excluded.updated_at""",
+                (t0, buffer.getvalue())
+            )
+        conn.close()
+
+    def _load(self):
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute("SELECT t0, state FROM phrase_stats_state WHERE id = 1").fetchone()
+        conn.close()
+        if not row:
+            return
+        state = np.load(io.BytesIO(row[1]), allow_pickle=False)
+        if state['sketch'].shape != self.sketch.shape:
+            logger.warning("Phrase stats sketch size changed; starting from empty statistics")
+            return
+        if any(f"phrases_{label}" not in state.files for label in CLASSES):
+            logger.warning("Phrase stats saved in an old format; starting from empty statistics")
+            return
+        self.t0, self.sketch, self.docs = row[0], state['sketch'], state['docs']
+        self.candidates = [
+            dict(zip(state[f"phrases_{label}"].tolist(), state[f"weights_{label}"].tolist())) for label in CLASSES
+        ]
+
+
+def _get_db_path() -> str:
+    from app.services.crm_database import db
+    return db.db_path
+
+
+phrase_stats = PhraseStats(_get_db_path())
+
+
+if __name__ == '__main__':
+    # 200,000 رد: عبارات معينة ترفع التقييم وأخرى تخفضه وسط ضجيج كبير من الكلمات
+    import json
+    import random
+
+    rng = random.Random(3)
+    good = ['يسعدني مساعدتك', 'التوصيل مجاني', 'ضمان سنتين', 'خصم خاص لك']
+    bad = ['غير متوفر حاليا', 'راجع الموقع', 'لا اعرف']
+    filler = [f"كلمه{i}" for i in range(5000)]
+    stats = PhraseStats()
+
+    sizes = []
+    started = time.perf_counter()
+    for i in range(200000):
+        words = rng.sample(filler, 12)
+        score = 0
+        for phrase in good + bad:
+            if rng.random() < 0.15:
+                words.insert(rng.randrange(len(words)), phrase)
+                score += 1 if phrase in good else -1
+        high = rng.random() < 0.5 + 0.2 * score
+        stats.update(' '.join(words), 'high' if high else 'low', now=stats.t0 + i)
+        if i % 50000 == 0:
+            sizes.append(stats.sketch.nbytes + sum(len(c) for c in stats.candidates))
+    update_us = (time.perf_counter() - started) * 1e6 / 200000
+
+    started = time.perf_counter()
+    result = stats.lift_scores(limit=5, now=stats.t0 + 200000)
+    lift_ms = (time.perf_counter() - started) * 1000
+    print(json.dumps({
+        'update_us': round(update_us, 1),
+        'lift_ms': round(lift_ms, 2),
+        'memory_samples': sizes,
+        'use': [(p['phrase'], p['lift'], p['z']) for p in result['use']],
+        'avoid': [(p['phrase'], p['lift'], p['z']) for p in result['avoid']],
+    }, ensure_ascii=False, indent=2))
+    # العبارات المزروعة فقط، كاملة، بدون أجزائها أو عبارات تمتد بين عبارتين
+    assert {p['phrase'] for p in result['use'][:len(good)]} == set(good)
+    assert {p['phrase'] for p in result['avoid'][:len(bad)]} == set(bad)
+
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'phrases.db')
+        stats.db_path = path
+        stats._init_tables()
+        started = time.perf_counter()
+        stats.save()
+        save_ms = (time.perf_counter() - started) * 1000
+        restored = PhraseStats(path)
+        assert restored.candidates == stats.candidates and np.array_equal(restored.sketch, stats.sketch)
+        print(json.dumps({'save_ms': round(save_ms, 1)}))
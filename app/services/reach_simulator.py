@@ -0,0 +1,313 @@
+"""
+Reach Simulator - محاكاة سيناريوهات الميزانية والوصول 🎯
+كل أبعاد الشبكة (ميزانية × مدة × دول × جمهور) أعمدة NumPy تُحسب دفعة واحدة،
+والأسعار (CPM/CTR) قيم مبدئية تُعاير من أداء حملاتنا الفعلي في ad_insights
+"""
+import os
+import math
+import time
+import sqlite3
+import logging
+from datetime import date, timedelta
+from typing import Dict, Any, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# القيم المبدئية: CPM بالدولار، وحجم الجمهور = مستخدمو Facebook النشطون تقريباً
+DEFAULT_PRIORS: Dict[str, Any] = {
+    'countries': {
+        'EG': {'cpm': 1.0, 'audience': 45_000_000},
+        'SA': {'cpm': 4.0, 'audience': 25_000_000},
+        'AE': {'cpm': 5.0, 'audience': 9_000_000},
+        'KW': {'cpm': 3.5, 'audience': 3_500_000},
+        'QA': {'cpm': 4.5, 'audience': 2_500_000},
+        'BH': {'cpm': 3.0, 'audience': 1_200_000},
+        'OM': {'cpm': 3.0, 'audience': 3_000_000},
+        'JO': {'cpm': 1.8, 'audience': 5_500_000},
+        'MA': {'cpm': 1.2, 'audience': 20_000_000},
+    },
+    'default_country': {'cpm': 2.0, 'audience': 5_000_000},
+    'ctr': 0.02,
+    # نسبة الجمهور من الدولة ومضاعف السعر ومضاعف التفاعل لكل نوع استهداف
+    'audiences': {
+        'broad': {'share': 1.0, 'cpm': 1.0, 'ctr': 1.0},
+        'interests': {'share': 0.15, 'cpm': 1.2, 'ctr': 1.25},
+        'lookalike': {'share': 0.05, 'cpm': 1.3, 'ctr': 1.4},
+        'retargeting': {'share': 0.005, 'cpm': 1.8, 'ctr': 2.5},
+    },
+    # ارتفاع CPM مع ضغط الإنفاق اليومي على جمهور صغير، وتراجع CTR مع تكرار الظهور
+    'cpm_elasticity': 0.5,
+    'ctr_fatigue': 0.1,
+    # معامل المعايرة من البيانات الفعلية (1.0 = بدون معايرة)
+    'cpm_scale': 1.0,
+    'ctr_scale': 1.0,
+}
+
+MAX_SCENARIOS = 200_000
+HOME_COUNTRY = os.getenv('ADS_HOME_COUNTRY', 'EG')
+# كم ظهوراً فعلياً يلزم حتى تتساوى البيانات الفعلية مع القيم المبدئية
+PRIOR_STRENGTH_IMPRESSIONS = 100_000
+CALIBRATION_TTL_SECONDS = 3600
+
+
+class ReachSimulator:
+    """تقييم شبكات السيناريوهات بمصفوفات NumPy"""
+
+    def __init__(self, db_path: Optional[str] = None, priors: Optional[Dict[str, Any]] = None):
+        self.db_path = db_path
+        self.priors = {**DEFAULT_PRIORS, **(priors or {})}
+        self.calibration: Dict[str, Any] = {}
+        self._calibrated_at = 0.0
+
+    # ==================== المعايرة ====================
+
+    def calibrate(self, days: int = 90) -> Dict[str, Any]:
+        """
+        معايرة CPM و CTR من أداء الحملات الفعلي
+
+        الإحصائيات لا تحمل الدولة، فتُقارن بالقيمة المبدئية لدولتنا الأساسية ويُطبق
+        نفس المعامل على كل الدول، مع تقليصه نحو 1.0 حين تكون الظهورات قليلة
+        """
+        self._calibrated_at = time.time()
+        if not self.db_path:
+            return self.calibration
+        since = (date.today() - timedelta(days=days)).isoformat()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            spend, impressions, clicks = conn.execute(
+                """SELECT COALESCE(SUM(spend), 0), COALESCE(SUM(impressions), 0), COALESCE(SUM(clicks), 0)
+                   FROM ad_insights WHERE level = 'campaign' AND day >= ?""",
+                (since,)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            spend = impressions = clicks = 0  # لم تُنشأ جداول الإحصائيات بعد
+        finally:
+            conn.close()
+
+        if not impressions:
+            self.priors.update(cpm_scale=1.0, ctr_scale=1.0)
+            self.calibration = {'impressions': 0, 'cpm_scale': 1.0, 'ctr_scale': 1.0}
+            return self.calibration
+
+        home = self.priors['countries'].get(HOME_COUNTRY, self.priors['default_country'])
+        weight = impressions / (impressions + PRIOR_STRENGTH_IMPRESSIONS)
+        observed_cpm = spend / impressions * 1000
+        observed_ctr = clicks / impressions
+        cpm_scale = 1.0 + weight * (observed_cpm / home['cpm'] - 1.0)
+        ctr_scale = 1.0 + weight * (observed_ctr / self.priors['ctr'] - 1.0)
+        self.priors.update(cpm_scale=cpm_scale, ctr_scale=ctr_scale)
+        self.calibration = {
+            'impressions': int(impressions),
+            'observed_cpm': round(observed_cpm, 3),
+            'observed_ctr': round(observed_ctr, 4),
+            'weight': round(weight, 3),
+            'cpm_scale': round(cpm_scale, 3),
+            'ctr_scale': round(ctr_scale, 3),
+        }
+        return self.calibration
+
+    def _ensure_calibrated(self):
+        if time.time() - self._calibrated_at > CALIBRATION_TTL_SECONDS:
+            self.calibrate()
+
+    # ==================== المحاكاة ====================
+
+    def simulate(self, budgets: Sequence[float], durations: Sequence[int],
+                 countries: Sequence[Any], audiences: Sequence[str]) -> Dict[str, np.ndarray]:
+        """
+        تقييم كل التركيبات - كل ناتج مصفوفة بالشكل (ميزانيات، مدد، دول، جماهير)
+
+        كل عنصر في countries دولة ('EG') أو مجموعة دول ('EG,SA' أو ['EG', 'SA'])
+        """
+        self._validate(budgets, durations, countries, audiences)
+        p = self.priors
+        budget = np.asarray(budgets, dtype=float)[:, None, None, None]
+        days = np.asarray(durations, dtype=float)[None, :, None, None]
+
+        groups = [self._country_group(c) for c in countries]
+        group_cpm = np.array([g['cpm'] for g in groups])[None, None, :, None]
+        group_size = np.array([g['audience'] for g in groups])[None, None, :, None]
+
+        unknown = [a for a in audiences if a not in p['audiences']]
+        if unknown:
+            raise ValueError(f"Unknown audiences: {unknown} (expected one of {list(p['audiences'])})")
+        audience = [p['audiences'][a] for a in audiences]
+        share = np.array([a['share'] for a in audience])[None, None, None, :]
+        audience_cpm = np.array([a['cpm'] for a in audience])[None, None, None, :]
+        audience_ctr = np.array([a['ctr'] for a in audience])[None, None, None, :]
+
+        audience_size = group_size * share
+        base_cpm = group_cpm * audience_cpm * p['cpm_scale']
+        # ضغط الإنفاق: نسبة الظهورات اليومية إلى حجم الجمهور
+        pressure = budget / base_cpm * 1000 / audience_size
+        cpm = base_cpm * (1 + p['cpm_elasticity'] * pressure)
+
+        spend = budget * days
+        impressions = spend / cpm * 1000
+        # الوصول الفريد: تشبّع Poisson - كل ظهور يصل لشخص عشوائي من الجمهور
+        reach = audience_size * -np.expm1(-impressions / audience_size)
+        frequency = impressions / reach
+        ctr = p['ctr'] * p['ctr_scale'] * audience_ctr / (1 + p['ctr_fatigue'] * (frequency - 1))
+        clicks = impressions * ctr
+
+        shape = np.broadcast_shapes(budget.shape, days.shape, group_cpm.shape, share.shape)
+        return {
+            'spend': np.broadcast_to(spend, shape),
+            'cpm': np.broadcast_to(cpm, shape),
+            'impressions': impressions,
+            'reach': reach,
+            'frequency': frequency,
+            'ctr': ctr,
+            'clicks': clicks,
+            'reach_per_dollar': reach / spend,
+            'audience_size': np.broadcast_to(audience_size, shape),
+        }
+
+    def frontier(self, budgets: Sequence[float], durations: Sequence[int], countries: Sequence[Any],
+                 audiences: Sequence[str], limit: int = 20) -> Dict[str, Any]:
+        """أفضل السيناريوهات حسب الوصول لكل دولار + حد باريتو (أكبر وصول لكل مستوى إنفاق)"""
+        self._validate(budgets, durations, countries, audiences)
+        n = len(budgets) * len(durations) * len(countries) * len(audiences)
+        if n > MAX_SCENARIOS:
+            raise ValueError(f"Grid has {n} scenarios; the limit is {MAX_SCENARIOS}")
+        self._ensure_calibrated()
+        started = time.perf_counter()
+        result = {k: v.ravel() for k, v in self.simulate(budgets, durations, countries, audiences).items()}
+
+        by_efficiency = np.argsort(-result['reach_per_dollar'], kind='stable')[:limit]
+        # باريتو: بالترتيب حسب الإنفاق، يبقى السيناريو الذي يتجاوز وصول كل ما قبله
+        order = np.lexsort((-result['reach'], result['spend']))
+        best_before = np.maximum.accumulate(np.concatenate(([-1.0], result['reach'][order][:-1])))
+        pareto = order[result['reach'][order] > best_before]
+        # الحد قد يضم آلاف النقاط: عينة متباعدة بالتساوي على محور الإنفاق
+        pareto = pareto[np.unique(np.linspace(0, len(pareto) - 1, min(limit, len(pareto))).round().astype(int))]
+
+        labels = (budgets, durations, [self._country_label(c) for c in countries], audiences)
+        shape = (len(budgets), len(durations), len(countries), len(audiences))
+        return {
+            'scenarios': n,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 2),
+            'calibration': self.calibration,
+            'top_reach_per_dollar': [self._scenario(result, i, labels, shape) for i in by_efficiency],
+            'pareto_frontier': [self._scenario(result, i, labels, shape) for i in pareto],
+        }
+
+    def estimate(self, budget: float, days: int, countries: Sequence[str], audience: str = 'broad') -> Dict[str, float]:
+        """سيناريو واحد (تقدير الوصول عند ترويج منشور)"""
+        self._ensure_calibrated()
+        result = self.simulate([budget], [days], [list(countries)], [audience])
+        return {key: float(value.ravel()[0]) for key, value in result.items()}
+
+    # ==================== مساعدات ====================
+
+    @staticmethod
+    def _validate(budgets: Sequence[float], durations: Sequence[int], countries: Sequence[Any],
+                  audiences: Sequence[str]):
+        """ميزانية أو مدة صفرية تعطي NaN في الحساب - رفضها مع رسالة واضحة قبل بناء الشبكة"""
+        for name, values in (('budgets', budgets), ('durations', durations),
+                             ('countries', countries), ('audiences', audiences)):
+            if not values:
+                raise ValueError(f"{name} must contain at least one value")
+        for name, values in (('budgets', budgets), ('durations', durations)):
+            try:
+                numbers = [float(v) for v in values]
+            except (TypeError, ValueError):
+                raise ValueError(f"{name} must be numbers, got {list(values)}")
+            invalid = [v for v, x in zip(values, numbers) if not math.isfinite(x) or x <= 0]
+            if invalid:
+                raise ValueError(f"{name} must be positive numbers, got {invalid}")
+        for group in countries:
+            codes = group.split(',') if isinstance(group, str) else list(group)
+            if not codes or not all(isinstance(c, str) and c.strip() for c in codes):
+                raise ValueError(f"Invalid country group: {group!r}")
+
+    def _country_group(self, countries: Any) -> Dict[str, float]:
+        codes = countries.split(',') if isinstance(countries, str) else list(countries)
+        priors = [self.priors['countries'].get(c.strip().upper(), self.priors['default_country']) for c in codes]
+        if not priors:
+            raise ValueError("Empty country group")
+        # المزاد يوزع الإنفاق على الجمهور كله: CPM مرجح بحجم كل دولة
+        size = sum(p['audience'] for p in priors)
+        return {'cpm': sum(p['cpm'] * p['audience'] for p in priors) / size, 'audience': size}
+
+    @staticmethod
+    def _country_label(countries: Any) -> str:
+        codes = countries.split(',') if isinstance(countries, str) else countries
+        return ','.join(c.strip().upper() for c in codes)
+
+    @staticmethod
+    def _scenario(result: Dict[str, np.ndarray], flat_index: int, labels, shape) -> Dict[str, Any]:
+        b, d, c, a = np.unravel_index(flat_index, shape)
+        return {
+            'daily_budget': labels[0][b],
+            'duration_days': labels[1][d],
+            'countries': labels[2][c],
+            'audience': labels[3][a],
+            'spend': round(float(result['spend'][flat_index]), 2),
+            'impressions': int(result['impressions'][flat_index]),
+            'reach': int(result['reach'][flat_index]),
+            'frequency': round(float(result['frequency'][flat_index]), 2),
+            'clicks': int(result['clicks'][flat_index]),
+            'cpm': round(float(result['cpm'][flat_index]), 2),
+            'ctr': round(float(result['ctr'][flat_index]), 4),
+            'reach_per_dollar': round(float(result['reach_per_dollar'][flat_index]), 1),
+        }
+
+
+def _get_db_path() -> str:
+    from app.services.crm_database import db
+    return db.db_path
+
+
+reach_simulator = ReachSimulator(_get_db_path())
+
+
+if __name__ == '__main__':
+    # شبكة 10,000 سيناريو مقابل تقدير كل سيناريو على حدة بحلقة Python
+    import json
+    import itertools
+
+    simulator = ReachSimulator()
+    budgets = list(range(5, 505, 5))                         # 100
+    durations = [1, 3, 5, 7, 10, 14, 21, 30, 45, 60]         # 10
+    countries = ['EG', 'SA', 'AE', 'KW', 'EG,SA']            # 5
+    audiences = ['broad', 'interests']                       # 2
+
+    started = time.perf_counter()
+    grid = simulator.frontier(budgets, durations, countries, audiences, limit=5)
+    grid_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    one_by_one = {}
+    for b, d, c, a in itertools.product(budgets, durations, countries, audiences):
+        one_by_one[(b, d, c, a)] = simulator.estimate(b, d, c.split(','), a)
+    loop_ms = (time.perf_counter() - started) * 1000
+
+    # الشبكة والتقدير المفرد نفس النموذج: أفضل سيناريو يطابق حسابه منفرداً
+    assert grid['scenarios'] == len(one_by_one) == 10_000
+    best = grid['top_reach_per_dollar'][0]
+    single = one_by_one[(best['daily_budget'], best['duration_days'], best['countries'], best['audience'])]
+    assert best['reach'] == int(single['reach']) and best['impressions'] == int(single['impressions'])
+    assert all(best['reach_per_dollar'] >= s['reach_per_dollar'] for s in grid['top_reach_per_dollar'])
+    assert all(math.isfinite(v) for e in one_by_one.values() for v in e.values())
+    # حد باريتو: كل زيادة في الإنفاق تعطي وصولاً أكبر
+    frontier = grid['pareto_frontier']
+    assert all(x['spend'] <= y['spend'] and x['reach'] < y['reach'] for x, y in zip(frontier, frontier[1:]))
+    assert grid_ms < loop_ms, (grid_ms, loop_ms)
+    for bad in ([0], [-5], [float('nan')], []):
+        try:
+            simulator.frontier(bad, durations, countries, audiences)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"budgets={bad} accepted")
+
+    print(json.dumps({
+        'scenarios': grid['scenarios'],
+        'grid_ms': round(grid_ms, 1),
+        'one_by_one_ms': round(loop_ms, 1),
+        'best': best,
+        'pareto_points': len(grid['pareto_frontier']),
+    }, indent=2))
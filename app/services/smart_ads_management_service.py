@@ -1,8 +1,14 @@
 import os
+import uuid
+import asyncio
 import logging
 from enum import Enum
 from typing import List, Dict, Any
 
+from app.services.ad_insights import ad_insights
+from app.services.budget_allocator import budget_allocator
+from app.services.campaign_builder import campaign_builder
+
 logger = logging.getLogger("SmartAdsService")
 
 class AdPlatform(str, Enum):
@@ -46,26 +52,72 @@ class SmartAdsManagementService:
         }
 
     async def create_ad_campaign(self, campaign_name: str, objective: AdObjective, strategies: List[UnicornStrategy], products: List[Dict[str, str]], total_budget: int) -> Dict[str, Any]:
-        """إنشاء حملة إعلانية كاملة"""
+        """إنشاء حملة إعلانية كاملة وتوزيع ميزانيتها اليومية على الاستراتيجيات"""
         logger.info(f"Creating campaign: {campaign_name} with {len(strategies)} strategies.")
         
-        # هنا يتم إضافة منطق إنشاء الحملة
-        # ...
+        account_id = os.getenv("FACEBOOK_AD_ACCOUNT_ID")
+        if campaign_builder.enabled and account_id:
+            # مجموعة إعلانية لكل استراتيجية وإعلان لكل منتج، تُنشأ بالتوازي
+            build = await campaign_builder.build(
+                account_id, campaign_name, AdObjective(objective).value, float(total_budget),
+                [strategy.name for strategy in strategies], products
+            )
+            if "status" not in build:
+                return {"success": False, "build": build, "error": build.get("error") or build.get("skipped")}
+            if build["status"] == "failed":
+                return {"success": False, "build": build, "error": "تعذر إنشاء الحملة على Facebook."}
+            campaign_id = build["campaign_id"]
+            arms = [{"arm_id": adset_id, "strategy": strategy} for strategy, adset_id in build["adsets"].items()]
+        else:
+            build = None
+            campaign_id = f"campaign_{uuid.uuid4().hex[:12]}"
+            arms = [{"arm_id": f"{campaign_id}:{strategy.name}", "strategy": strategy.name} for strategy in strategies]
+        
+        # كل استراتيجية ذراع مستقل؛ المجموعات الإعلانية الأخرى تنضم تلقائياً عند ظهورها في الإحصائيات
+        # sqlite وسحوبات Thompson خارج الـ event loop
+        await asyncio.to_thread(
+            budget_allocator.register_campaign,
+            campaign_id, campaign_name, AdObjective(objective).value, float(total_budget), arms
+        )
+        allocation = await asyncio.to_thread(budget_allocator.allocate, campaign_id, "create")
         
         return {
             "success": True,
-            "campaign_id": "campaign_demo_456",
-            "message": f"تم إنشاء حملة {campaign_name} التجريبية بنجاح."
-        }
-
-    def get_campaign_performance(self, campaign_id: str) -> Dict[str, Any]:
-        """الحصول على أداء الحملة"""
-        return {
             "campaign_id": campaign_id,
-            "spend": 500,
-            "conversions": 50,
-            "cpa": 10,
-            "recommendation": "زيادة الميزانية على استراتيجية الخطافات الفيروسية."
+            "allocations": allocation["allocations"],
+            "build": build,
+            "message": f"تم إنشاء حملة {campaign_name} بنجاح." if build else f"تم إنشاء حملة {campaign_name} التجريبية بنجاح."
         }
 
+    async def refresh_insights(self) -> Dict[str, Any]:
+        """مزامنة الإحصائيات ثم إعادة توزيع ميزانيات الحملات (مهمة دورية)"""
+        result = await ad_insights.sync()
+        if "skipped" in result:
+            return result
+        result["allocation"] = await asyncio.to_thread(budget_allocator.allocate_all, "insights")
+        return result
+
+    def get_campaign_performance(self, campaign_id: str, days: int = 30) -> Dict[str, Any]:
+        """الحصول على أداء الحملة من الإحصائيات المخزنة محلياً (تُحدَّث بالمزامنة الدورية)"""
+        performance = ad_insights.get_campaign_performance(campaign_id, days)
+        performance["recommendation"] = self._recommend(performance)
+        history = budget_allocator.get_history(campaign_id, limit=1)
+        performance["allocation"] = history[0] if history else None
+        return performance
+
+    @staticmethod
+    def _recommend(performance: Dict[str, Any]) -> str:
+        """توصية من أرقام المجموعات الإعلانية: نقل الميزانية من الأعلى تكلفة للعميل إلى الأقل"""
+        if not performance["daily"]:
+            return "لا توجد بيانات أداء بعد - انتظر أول مزامنة للإحصائيات."
+        adsets = [a for a in performance["adsets"] if a["cpl"] is not None]
+        if len(adsets) < 2:
+            return "اجمع بيانات أكثر قبل تعديل الميزانية."
+        best = min(adsets, key=lambda a: a["cpl"])
+        worst = max(adsets, key=lambda a: a["cpl"])
+        if worst["cpl"] < best["cpl"] * 1.3:
+            return "أداء المجموعات متقارب - حافظ على توزيع الميزانية الحالي."
+        return (f"انقل جزءاً من ميزانية '{worst['name']}' (تكلفة العميل {worst['cpl']}) "
+                f"إلى '{best['name']}' (تكلفة العميل {best['cpl']}).")
+
 smart_ads_service = SmartAdsManagementService()
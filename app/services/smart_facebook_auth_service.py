@@ -2,6 +2,8 @@ import os
 import logging
 from typing import Dict, Any, Tuple
 
+from app.services.campaign_builder import campaign_builder
+
 logger = logging.getLogger("FacebookAuthService")
 
 class SmartFacebookAuthService:
@@ -32,9 +34,15 @@ class SmartFacebookAuthService:
         """إنشاء حملة إعلانية"""
         logger.info(f"Creating ad campaign: {campaign_name}")
         
-        # هنا يتم إضافة منطق إنشاء الحملة
-        # ...
+        if not campaign_builder.enabled:
+            return True, "camp_demo_789", "تم إنشاء الحملة الإعلانية بنجاح (وضع تجريبي)."
         
-        return True, "camp_demo_789", "تم إنشاء الحملة الإعلانية بنجاح (وضع تجريبي)."
+        result = await campaign_builder.build(ad_account_id, campaign_name, campaign_objective, budget)
+        if 'status' not in result:
+            # بناء آخر بنفس المفتاح يعمل الآن (lease) أو خطأ قبل البدء
+            return False, "", result.get('error') or result.get('skipped')
+        if result['status'] != 'completed':
+            return False, "", f"فشل إنشاء الحملة: {result['failed'][0]['error'] if result['failed'] else result['status']}"
+        return True, result['campaign_id'], "تم إنشاء الحملة الإعلانية بنجاح."
 
 smart_facebook_auth_service = SmartFacebookAuthService()
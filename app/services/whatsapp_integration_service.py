@@ -1,5 +1,6 @@
 import os
 import logging
+from datetime import datetime
 from typing import List, Dict, Any
 
 logger = logging.getLogger("WhatsAppService")
@@ -26,10 +27,9 @@ class WhatsAppIntegrationService:
             logger.warning(f"Demo Mode: Would send {len(messages)} bulk messages.")
             return {"success": True, "status": "demo_bulk_sent"}
         
-        # هنا يتم إضافة منطق الإرسال الفعلي
-        # ...
-        
-        return {"success": True, "status": "bulk_sent"}
+        from app.services.bulk_sender import bulk_sender
+        progress = await bulk_sender.send_all(f"bulk-{datetime.now():%Y%m%d-%H%M%S}", messages)
+        return {"success": progress.get("success", False), "status": "bulk_sent", **progress}
 
     async def get_status(self) -> Dict[str, Any]:
         """الحصول على حالة الاتصال"""
@@ -7,28 +7,75 @@ try:
 except:
     HAS_HTTPX = False
 
+from app.core.metrics import LatencyStats
+from app.core.phone import normalize_phone
+from app.services.http_client import http_client
+
 logger = logging.getLogger(__name__)
 
 class WhatsAppService:
-    def __init__(self):
+    def __init__(self, client=None):
         self.api_key = os.getenv('WHATSAPP_API_KEY')
         self.phone_number_id = os.getenv('WHATSAPP_PHONE_NUMBER_ID')
-        self.api_base = f"https://graph.facebook.com/v18.0/{self.phone_number_id}"
-    
+        graph_base = os.getenv('WHATSAPP_API_BASE', 'https://graph.facebook.com/v18.0')
+        self.api_base = f"{graph_base}/{self.phone_number_id}"
+        # عميل مخصص (اختياري) - الافتراضي هو العميل المشترك للتطبيق
+        self.client = client
+        self.send_latency = LatencyStats()
+
     async def send_message(self, to_phone: str, message: str):
         if not self.api_key or not HAS_HTTPX:
             return {'success': False, 'error': 'WhatsApp not configured'}
-        phone = ''.join(filter(str.isdigit, to_phone))
-        if len(phone) == 10:
-            phone = '20' + phone
+        phone = normalize_phone(to_phone)
+        if not phone:
+            return {'success': False, 'error': f'Invalid phone number: {to_phone}', 'status_code': 400}
+        client = self.client or http_client.get()
         try:
-            async with httpx.AsyncClient() as client:
+            with self.send_latency.measure():
                 response = await client.post(
                     f"{self.api_base}/messages",
                     headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
-                    json={"messaging_product": "whatsapp", "to": phone, "type": "text", "text": {"body": message}},
-                    timeout=30.0
+                    json={"messaging_product": "whatsapp", "to": phone, "type": "text", "text": {"body": message}}
                 )
-                return {'success': response.status_code == 200, 'data': response.json()}
+            return {'success': response.status_code == 200, 'status_code': response.status_code, 'data': response.json()}
         except Exception as e:
             return {'success': False, 'error': str(e)}
+
+    def get_stats(self):
+        return {'send_latency': self.send_latency.snapshot()}
+
+
+if __name__ == '__main__':
+    # قياس الفرق بين عميل جديد لكل رسالة والعميل المشترك على خادم محلي
+    import json
+    import asyncio
+    from app.core.graph_stub import GraphStubServer
+
+    async def bench(n: int = 300):
+        async with GraphStubServer(latency_ms=2) as stub:
+            os.environ.update({'WHATSAPP_API_KEY': 'bench', 'WHATSAPP_API_BASE': stub.base_url})
+
+            per_request = LatencyStats()
+            for _ in range(n):
+                async with httpx.AsyncClient() as client:
+                    with per_request.measure():
+                        await WhatsAppService(client=client).send_message('01000000000', 'hi')
+            fresh_connections = stub.connections
+
+            service = WhatsAppService()
+            for _ in range(n):
+                await service.send_message('01000000000', 'hi')
+            await http_client.close()
+
+            shared_connections = stub.connections - fresh_connections
+            print(json.dumps({
+                'new_client_per_message': {**per_request.snapshot(), 'connections': fresh_connections},
+                'shared_client': {**service.send_latency.snapshot(), 'connections': shared_connections},
+            }, indent=2))
+            # رسائل متتابعة على العميل المشترك = اتصال واحد يُعاد استخدامه
+            assert stub.requests == 2 * n, stub.requests
+            assert fresh_connections == n, fresh_connections
+            assert shared_connections == 1, shared_connections
+            assert service.send_latency.snapshot()['p50_ms'] < per_request.snapshot()['p50_ms']
+
+    asyncio.run(bench())
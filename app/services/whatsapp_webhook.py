@@ -0,0 +1,169 @@
+"""
+WhatsApp Webhook Ingestion - استقبال سريع ومعالجة في الخلفية 📥
+الـ endpoint يحفظ الـ payload كما هو ويرد فوراً (Meta تعيد الإرسال عند التأخير)،
+والمعالج يربط الرسائل بالعملاء ويمنع التكرار ويمررها للمحاور الذكي،
+ويطبق إيصالات التسليم والقراءة على دفعات
+"""
+import os
+import hmac
+import json
+import asyncio
+import hashlib
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from app.core.metrics import LatencyStats
+from app.services.background_jobs import scheduler
+from app.models.crm_models import LeadCreate, LeadSource
+
+logger = logging.getLogger(__name__)
+
+
+class WhatsAppWebhookIngestor:
+    """معالج Webhooks الواردة من WhatsApp Cloud API"""
+
+    JOB_NAME = 'whatsapp_webhook'
+
+    def __init__(self, crm):
+        self.crm = crm
+        self.db = crm.db
+        self.receipts = crm.receipts
+        self.app_secret = os.getenv('WHATSAPP_APP_SECRET')
+        self.batch_size = int(os.getenv('WEBHOOK_BATCH_SIZE', '100'))
+        self.ack_latency = LatencyStats()
+        self.ingest_to_reply = LatencyStats()
+        self.stats = {'webhooks': 0, 'messages': 0, 'duplicates': 0, 'leads_created': 0,
+                      'statuses': 0, 'failed': 0}
+
+    # ==================== الاستقبال ====================
+
+    def verify_signature(self, body: bytes, signature: Optional[str]) -> bool:
+        """التحقق من X-Hub-Signature-256 (فقط إذا تم ضبط WHATSAPP_APP_SECRET)"""
+        if not self.app_secret:
+            return True
+        expected = 'sha256=' + hmac.new(self.app_secret.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or '')
+
+    async def ingest(self, body: bytes) -> int:
+        """حفظ الـ payload الخام وإيقاظ المعالج"""
+        with self.ack_latency.measure():
+            inbox_id = await asyncio.to_thread(self.db.enqueue_webhook, body.decode('utf-8'))
+        self.stats['webhooks'] += 1
+        scheduler.trigger(self.JOB_NAME)
+        return inbox_id
+
+    # ==================== المعالجة ====================
+
+    async def process_pending(self) -> Dict[str, Any]:
+        """معالجة كل الـ webhooks المعلقة (مهمة دورية)"""
+        processed = 0
+        while True:
+            batch = await asyncio.to_thread(self.db.claim_webhooks, self.batch_size)
+            if not batch:
+                break
+            # إيصالات الحالة أكثر بكثير من الرسائل - تُجمع من الدفعة كلها وتُكتب مرة واحدة
+            statuses, done = [], []
+            for row in batch:
+                try:
+                    payload = json.loads(row['payload'])
+                    await self._process_payload(payload, row['received_at'])
+                    statuses.extend(self._extract_statuses(payload))
+                    done.append(row)
+                except Exception as e:
+                    await self._fail(row, e)
+                processed += 1
+
+            try:
+                if statuses:
+                    self.stats['statuses'] += await asyncio.to_thread(self.receipts.apply_statuses, statuses)
+                for row in done:
+                    await asyncio.to_thread(self.db.complete_webhook, row['id'])
+            except Exception as e:
+                # الإيصالات لا تُحتسب مرتين عند إعادة المحاولة، والرسائل محمية بـ inbound_messages
+                for row in done:
+                    await self._fail(row, e)
+
+            if len(batch) < self.batch_size:
+                break
+        return {'webhooks_processed': processed}
+
+    async def _fail(self, row: Dict, error: Exception):
+        self.stats['failed'] += 1
+        logger.error(f"Webhook {row['id']} processing error: {error}")
+        status = 'failed' if row['attempts'] >= 5 else 'pending'
+        await asyncio.to_thread(self.db.complete_webhook, row['id'], status, str(error)[:500])
+
+    async def _process_payload(self, payload: Dict, received_at: str):
+        for value in self._iter_values(payload):
+            names = {c.get('wa_id'): (c.get('profile') or {}).get('name') for c in value.get('contacts', [])}
+            for message in value.get('messages', []):
+                await self._process_message(message, names.get(message.get('from')), received_at)
+
+    async def _process_message(self, message: Dict, profile_name: Optional[str], received_at: str):
+        wa_id = message.get('id')
+        text = self._extract_text(message)
+        if not wa_id or not text:
+            return
+
+        if not await asyncio.to_thread(self.db.begin_inbound_message, wa_id, received_at):
+            self.stats['duplicates'] += 1
+            return
+
+        sender = message.get('from', '')
+        lead = await asyncio.to_thread(self.db.get_lead_by_phone, sender)
+        if lead:
+            lead_id = lead['id']
+        else:
+            created = await self.crm.create_lead(
+                LeadCreate(name=profile_name or sender, phone=sender, source=LeadSource.WHATSAPP),
+                send_welcome=False
+            )
+            if not created.get('success'):
+                raise RuntimeError(created.get('error'))
+            lead_id = created['lead_id']
+            if created['action'] == 'created':
+                self.stats['leads_created'] += 1
+
+        # الرد في الـ Outbox وعلامة انتهاء الرسالة الواردة يُحفظان في معاملة واحدة
+        result = await self.crm.handle_incoming_message(lead_id, text, 'whatsapp', inbound_message_id=wa_id)
+        if not result.get('success'):
+            raise RuntimeError(result.get('error'))
+
+        self.stats['messages'] += 1
+        self.ingest_to_reply.record(
+            (datetime.now() - datetime.fromisoformat(received_at)).total_seconds() * 1000
+        )
+
+    @staticmethod
+    def _iter_values(payload: Dict) -> List[Dict]:
+        return [
+            change.get('value', {})
+            for entry in payload.get('entry', [])
+            for change in entry.get('changes', [])
+            if change.get('field', 'messages') == 'messages'
+        ]
+
+    @classmethod
+    def _extract_statuses(cls, payload: Dict) -> List[Dict]:
+        return [status for value in cls._iter_values(payload) for status in value.get('statuses', [])]
+
+    @staticmethod
+    def _extract_text(message: Dict) -> Optional[str]:
+        kind = message.get('type')
+        if kind == 'text':
+            return (message.get('text') or {}).get('body')
+        if kind == 'button':
+            return (message.get('button') or {}).get('text')
+        if kind == 'interactive':
+            interactive = message.get('interactive') or {}
+            reply = interactive.get('button_reply') or interactive.get('list_reply') or {}
+            return reply.get('title')
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'ack_latency': self.ack_latency.snapshot(),
+            'ingest_to_reply': self.ingest_to_reply.snapshot(),
+        }
@@ -1,19 +1,24 @@
 import uvicorn
 import os
+import json
+import base64
 from datetime import datetime, timedelta
 from typing import Optional
-from fastapi import FastAPI, Request, Form, Depends, HTTPException
+from fastapi import FastAPI, Request, Form, Depends, HTTPException, UploadFile, File, Query
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, Text, select, func
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index, select, insert, func, tuple_
+from jose import jwt
 from dotenv import load_dotenv
 import logging
 
+from app.core.csv_stream import iter_csv_records, map_header
+from app.core.database import create_engine_from_url
+from app.core.rendering import TemplateRenderer, FragmentCache, conditional_response, make_etag
+from app.core.security import password_hasher, PasswordHasherBusy, TokenVerifier
+
 # تهيئة logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("Brilliox")
@@ -24,12 +29,27 @@ load_dotenv()
 # =============================================================================
 # DATABASE & AUTH SETUP
 # =============================================================================
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./brilliox.db")
 SECRET_KEY = os.getenv("SECRET_KEY", "CHANGE_ME")
 ALGORITHM = "HS256"
 JWT_EXPIRATION_DAYS = int(os.getenv("JWT_EXPIRATION_DAYS", "7"))
+CONTACTS_IMPORT_BATCH_SIZE = int(os.getenv("CONTACTS_IMPORT_BATCH_SIZE", "1000"))
+CONTACTS_IMPORT_MAX_ROWS = int(os.getenv("CONTACTS_IMPORT_MAX_ROWS", "200000"))
+CONTACTS_PAGE_MAX = 200
+# مدة cache أجزاء لوحة التحكم (تُلغى فوراً عند إضافة عملاء)
+DASHBOARD_CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", "15"))
+
+# أسماء الأعمدة المقبولة في ملف الاستيراد
+CONTACT_CSV_COLUMNS = {
+    "name": ("name", "full_name", "الاسم"),
+    "phone": ("phone", "mobile", "الهاتف", "رقم الهاتف"),
+    "email": ("email", "البريد", "البريد الإلكتروني"),
+    "status": ("status", "الحالة"),
+}
+
+token_verifier = TokenVerifier(SECRET_KEY, ALGORITHM)
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+# WAL + pragmas لـ SQLite، أو asyncpg إذا كان DATABASE_URL يشير إلى PostgreSQL
+engine = create_engine_from_url()
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
@@ -50,7 +70,8 @@ class Contact(Base):
     ai_notes = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    # ترتيب الأحدث أولاً + التصفح بالـ keyset (created_at, id) بدون OFFSET
+    __table_args__ = (Index("ix_contacts_created_at_id", "created_at", "id"),)
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
@@ -66,11 +87,7 @@ async def get_current_user(request: Request) -> Optional[str]:
     token = request.cookies.get("access_token")
     if not token:
         return None
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload.get("sub")
-    except JWTError:
-        return None
+    return token_verifier.verify(token)
 
 # =============================================================================
 # FASTAPI APP
@@ -82,19 +99,26 @@ app = FastAPI(
 )
 
 app.mount("/static", StaticFiles(directory="ai.markitng-repo/static"), name="static")
-templates = Jinja2Templates(directory="ai.markitng-repo/templates")
+renderer = TemplateRenderer("ai.markitng-repo/templates")
+templates = renderer.templates
+fragments = FragmentCache()
 
 @app.on_event("startup")
 async def startup_event():
     logger.info("🚀 Starting Brilliox Ultimate...")
+    logger.info(f"🧩 {renderer.precompile()} templates compiled")
     
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all لا يضيف الفهارس الجديدة لجداول موجودة مسبقاً
+        await conn.run_sync(lambda sync_conn: [
+            index.create(sync_conn, checkfirst=True) for index in Contact.__table__.indexes
+        ])
     
     async with AsyncSessionLocal() as db:
         result = await db.execute(select(User).where(User.username == "admin"))
         if not result.scalar():
-            hashed_pw = pwd_context.hash("admin123")
+            hashed_pw = await password_hasher.hash("admin123")
             admin = User(username="admin", hashed_password=hashed_pw)
             db.add(admin)
             await db.commit()
@@ -102,9 +126,14 @@ async def startup_event():
     
     logger.info("✅ System ready!")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await engine.dispose()
+    password_hasher.shutdown()
+
 @app.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+    return renderer.page(request, "login.html")
 
 @app.post("/login")
 async def login(
@@ -115,12 +144,22 @@ async def login(
     result = await db.execute(select(User).where(User.username == username))
     user = result.scalar()
     
-    if not user or not pwd_context.verify(password, user.hashed_password):
+    try:
+        valid, new_hash = await password_hasher.verify(password, user.hashed_password) if user else (False, None)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="الخادم مشغول، حاول مرة أخرى", headers={"Retry-After": "2"})
+    
+    if not valid:
         return templates.TemplateResponse(
             "login.html",
             {"request": {}, "error": "بيانات دخول خاطئة"}
         )
     
+    # ترقية الـ hash القديم بإعدادات الـ bcrypt الحالية
+    if new_hash:
+        user.hashed_password = new_hash
+        await db.commit()
+    
     token = create_access_token({"sub": user.username})
     response = RedirectResponse("/", status_code=302)
     response.set_cookie(
@@ -131,8 +170,24 @@ async def login(
     )
     return response
 
+@app.get("/api/auth/stats")
+async def auth_stats(user: str = Depends(get_current_user)):
+    if not user:
+        raise HTTPException(status_code=401)
+    return JSONResponse({**password_hasher.get_stats(), "tokens": token_verifier.get_stats()})
+
+@app.get("/api/render/stats")
+async def render_stats(user: str = Depends(get_current_user)):
+    if not user:
+        raise HTTPException(status_code=401)
+    return JSONResponse({"templates": renderer.get_stats(), "fragments": fragments.get_stats()})
+
 @app.get("/logout")
-def logout():
+async def logout(request: Request):
+    # async: TokenVerifier غير محمي بقفل، فكل تعديلاته على خيط الـ event loop (مثل get_current_user)
+    token = request.cookies.get("access_token")
+    if token:
+        token_verifier.revoke(token)
     response = RedirectResponse("/login", status_code=302)
     response.delete_cookie("access_token")
     return response
@@ -146,17 +201,29 @@ async def dashboard(
     if not user:
         return RedirectResponse("/login")
     
-    total_contacts = await db.scalar(select(func.count(Contact.id)))
-    recent_contacts = await db.execute(
-        select(Contact).order_by(Contact.created_at.desc()).limit(5)
-    )
+    async def contacts_fragment():
+        total_contacts = await db.scalar(select(func.count(Contact.id)))
+        recent_contacts = await db.execute(
+            select(Contact).order_by(Contact.created_at.desc(), Contact.id.desc()).limit(5)
+        )
+        return total_contacts or 0, recent_contacts.scalars().all()
     
-    return templates.TemplateResponse("dashboard.html", {
-        "request": request,
-        "user": user,
-        "total_contacts": total_contacts or 0,
-        "recent_contacts": recent_contacts.scalars().all()
-    })
+    async def render_page():
+        total_contacts, recent_contacts = await fragments.get_or_set(
+            "dashboard:contacts", DASHBOARD_CACHE_TTL, contacts_fragment, tags=("contacts",)
+        )
+        body = renderer.render("dashboard.html", {
+            "request": request,
+            "user": user,
+            "total_contacts": total_contacts,
+            "recent_contacts": recent_contacts
+        }).encode()
+        return body, make_etag(body)
+    
+    body, etag = await fragments.get_or_set(
+        f"dashboard:page:{user}", DASHBOARD_CACHE_TTL, render_page, tags=("contacts",)
+    )
+    return conditional_response(request, body, etag)
 
 @app.post("/api/ask_brain")
 async def ask_brain(
@@ -186,8 +253,93 @@ async def add_contact(
     contact = Contact(name=name, phone=phone, email=email)
     db.add(contact)
     await db.commit()
+    fragments.invalidate("contacts")
     return JSONResponse({"success": True})
 
+def encode_cursor(contact: Contact) -> str:
+    raw = json.dumps([contact.created_at.isoformat(), contact.id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, contact_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(created_at), int(contact_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="cursor غير صالح")
+
+@app.get("/api/contacts")
+async def list_contacts(
+    limit: int = Query(50, ge=1, le=CONTACTS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    user: str = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """الأحدث أولاً - cursor من الصفحة السابقة يكمل بعد آخر عميل فيها"""
+    if not user:
+        raise HTTPException(status_code=401)
+    
+    query = select(Contact).order_by(Contact.created_at.desc(), Contact.id.desc()).limit(limit + 1)
+    if cursor:
+        query = query.where(tuple_(Contact.created_at, Contact.id) < tuple_(*decode_cursor(cursor)))
+    contacts = (await db.execute(query)).scalars().all()
+    
+    has_more = len(contacts) > limit
+    contacts = contacts[:limit]
+    return JSONResponse({
+        "contacts": [
+            {"id": c.id, "name": c.name, "phone": c.phone, "email": c.email,
+             "status": c.status, "created_at": c.created_at.isoformat()}
+            for c in contacts
+        ],
+        "next_cursor": encode_cursor(contacts[-1]) if has_more else None,
+    })
+
+@app.post("/api/contacts/import")
+async def import_contacts(
+    file: UploadFile = File(...),
+    user: str = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """استيراد CSV على دفعات في معاملة واحدة - أي خطأ يلغي الاستيراد كله"""
+    if not user:
+        raise HTTPException(status_code=401)
+    
+    records = iter_csv_records(file.read)
+    header = await anext(records, None)
+    columns = map_header(header[1], CONTACT_CSV_COLUMNS) if header else {}
+    if "name" not in columns:
+        raise HTTPException(status_code=400, detail="الملف يجب أن يحتوي على عمود name")
+    
+    inserted, skipped, errors, batch = 0, 0, [], []
+    async for line, fields in records:
+        row = {field: fields[i].strip() if i < len(fields) else "" for field, i in columns.items()}
+        if not row["name"]:
+            skipped += 1
+            if len(errors) < 20:
+                errors.append({"line": line, "error": "name is required"})
+            continue
+        if inserted + len(batch) >= CONTACTS_IMPORT_MAX_ROWS:
+            raise HTTPException(status_code=413, detail=f"الحد الأقصى {CONTACTS_IMPORT_MAX_ROWS} عميل في الملف الواحد")
+        
+        batch.append({
+            "name": row["name"],
+            "phone": row.get("phone") or None,
+            "email": row.get("email") or None,
+            "status": row.get("status") or "جديد",
+        })
+        if len(batch) >= CONTACTS_IMPORT_BATCH_SIZE:
+            await db.execute(insert(Contact), batch)
+            inserted, batch = inserted + len(batch), []
+    
+    if batch:
+        await db.execute(insert(Contact), batch)
+        inserted += len(batch)
+    await db.commit()
+    fragments.invalidate("contacts")
+    
+    logger.info(f"📥 Imported {inserted} contacts ({skipped} skipped)")
+    return JSONResponse({"success": True, "inserted": inserted, "skipped": skipped, "errors": errors})
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
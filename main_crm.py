@@ -3,15 +3,28 @@ Brilliox Marketing AI + CRM المتقدم - النسخة النهائية 🚀
 نظام تسويق رقمي احترافي مع CRM خطير + المحاور الذكي + WhatsApp
 """
 import os
+import json
+import asyncio
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.templating import Jinja2Templates
+from fastapi.encoders import jsonable_encoder
 
 # استيراد خدمات CRM
 from app.services.crm_service import crm_service
+from app.services.background_jobs import scheduler
+from app.services.http_client import http_client
+from app.services.whatsapp_webhook import WhatsAppWebhookIngestor
+from app.services.ad_insights import ad_insights
+from app.services.reach_simulator import reach_simulator
+from app.services.budget_allocator import budget_allocator
+from app.services.campaign_builder import campaign_builder
+from app.services.lead_dedup import LeadDeduplicator
+from app.services.smart_ads_management_service import smart_ads_service
+from app.services.idempotency_store import idempotency_store
 from app.models.crm_models import LeadCreate, LeadUpdate
+from app.core.rendering import TemplateRenderer, BufferedGZipMiddleware
+from app.core.assets import PrecompressedStaticFiles, built_template, service_worker_response
 
 # تهيئة التطبيق
 app = FastAPI(
@@ -28,29 +41,60 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# للصفحات و JSON فقط - الاستجابات المتدفقة والملفات المضغوطة مسبقاً تمر كما هي
+app.add_middleware(BufferedGZipMiddleware, minimum_size=1024)
+
+webhook_ingestor = WhatsAppWebhookIngestor(crm_service)
+
+# ردود الطلبات ذات Idempotency-Key (طابور الـ Service Worker): الإعادة ترجع نفس الرد بدون تكرار
+async def _idempotent(request: Request, produce):
+    key = request.headers.get("Idempotency-Key")
+    if not key:
+        return await produce()
+    key = f"{request.url.path}:{key}"
+    state, response = await asyncio.to_thread(idempotency_store.claim, key)
+    if state == 'done':
+        return response
+    if state == 'in_flight':
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+    try:
+        response = await produce()
+    except BaseException:
+        await asyncio.to_thread(idempotency_store.release, key)
+        raise
+    await asyncio.to_thread(idempotency_store.complete, key, jsonable_encoder(response))
+    return response
 
 # Static files & Templates
 try:
-    app.mount("/static", StaticFiles(directory="static"), name="static")
-    templates = Jinja2Templates(directory="templates")
+    app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
+    renderer = TemplateRenderer("templates")
 except:
-    templates = None
+    renderer = None
 
 
 # ==================== الصفحات الرئيسية ====================
 
 @app.get("/", response_class=HTMLResponse)
+@app.get("/mobile", response_class=HTMLResponse)
 async def root(request: Request):
-    """الصفحة الرئيسية"""
-    if templates:
-        return templates.TemplateResponse("mobile_app.html", {"request": request})
+    """الصفحة الرئيسية (و start_url لتطبيق الـ PWA)"""
+    if renderer:
+        # النسخة المبنية بـ python -m app.core.assets (CSS/JS خارجي مضغوط) إن وُجدت
+        return renderer.page(request, built_template("mobile_app.html"))
     return HTMLResponse("<h1>Brilliox CRM API is running! 🚀</h1><p>Visit <a href='/docs'>/docs</a> for API documentation</p>")
 
 
+@app.get("/sw.js")
+async def service_worker(request: Request):
+    """Service Worker للتطبيق (يعمل بدون اتصال)"""
+    return service_worker_response(request)
+
+
 @app.get("/crm", response_class=HTMLResponse)
 async def crm_dashboard(request: Request):
     """لوحة تحكم CRM"""
-    return templates.TemplateResponse("crm_dashboard.html", {"request": request})
+    return renderer.page(request, "crm_dashboard.html")
 
 
 
@@ -64,9 +108,15 @@ async def get_crm_dashboard():
 
 
 @app.post("/api/crm/leads")
-async def create_lead(lead: LeadCreate):
+async def create_lead(lead: LeadCreate, request: Request):
     """إنشاء عميل محتمل جديد"""
-    return await crm_service.create_lead(lead)
+    return await _idempotent(request, lambda: crm_service.create_lead(lead))
+
+
+@app.get("/api/crm/leads/by-phone/{phone}")
+async def get_lead_by_phone(phone: str):
+    """البحث عن عميل برقم الهاتف"""
+    return await crm_service.get_lead_by_phone(phone)
 
 
 @app.get("/api/crm/leads/{lead_id}")
@@ -101,6 +151,21 @@ async def search_leads(
     return await crm_service.search_leads(filters, limit, offset)
 
 
+@app.post("/api/crm/leads/rescore")
+async def rescore_leads():
+    """إعادة تقييم كل العملاء بجدول الأوزان الحالي"""
+    return await crm_service.rescore_leads()
+
+
+@app.post("/api/crm/leads/dedup")
+async def dedup_leads(dry_run: bool = True):
+    """تقرير العملاء المكررين - dry_run=false يبدأ الدمج في الخلفية (الحالة في /api/crm/jobs)"""
+    if dry_run:
+        return await crm_service.dedup_leads(dry_run)
+    scheduler.trigger(LeadDeduplicator.JOB_NAME)
+    return {'success': True, 'job': LeadDeduplicator.JOB_NAME, 'status': 'started', 'status_url': '/api/crm/jobs'}
+
+
 @app.post("/api/crm/leads/{lead_id}/message")
 async def handle_lead_message(lead_id: int, request: Request):
     """معالجة رسالة واردة من عميل (المحاور الذكي)"""
@@ -124,7 +189,7 @@ async def send_message_to_lead(lead_id: int, request: Request):
     if not message:
         raise HTTPException(status_code=400, detail="Message is required")
     
-    return await crm_service.send_message_to_lead(lead_id, message, channel)
+    return await _idempotent(request, lambda: crm_service.send_message_to_lead(lead_id, message, channel))
 
 
 @app.get("/api/crm/tasks")
@@ -133,6 +198,12 @@ async def get_tasks(user_id: int = None):
     return await crm_service.get_my_tasks(user_id)
 
 
+@app.get("/api/crm/jobs")
+async def get_background_jobs():
+    """حالة المهام الدورية (مدة آخر تشغيل وعدد الصفوف المعدلة)"""
+    return scheduler.get_stats()
+
+
 # ==================== WhatsApp Webhook ====================
 
 @app.get("/api/whatsapp/webhook")
@@ -150,15 +221,72 @@ async def whatsapp_webhook_verify(request: Request):
 
 @app.post("/api/whatsapp/webhook")
 async def whatsapp_webhook(request: Request):
-    """استقبال رسائل WhatsApp الواردة"""
+    """استقبال رسائل WhatsApp الواردة - حفظ سريع والمعالجة في الخلفية"""
+    body = await request.body()
+    if not webhook_ingestor.verify_signature(body, request.headers.get("X-Hub-Signature-256")):
+        raise HTTPException(status_code=401, detail="Invalid signature")
+    
     try:
-        data = await request.json()
-        # معالجة الرسالة الواردة هنا
-        # يمكن ربطها مع CRM لاحقاً
-        return {"status": "ok"}
-    except Exception as e:
-        logger.error(f"WhatsApp webhook error: {e}")
-        return {"status": "error"}
+        json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    
+    await webhook_ingestor.ingest(body)
+    return {"status": "ok"}
+
+
+@app.get("/api/whatsapp/webhook/stats")
+async def whatsapp_webhook_stats():
+    """إحصائيات استقبال الرسائل (زمن الاستلام وزمن الرد)"""
+    return webhook_ingestor.get_stats()
+
+
+@app.post("/api/whatsapp/bulk")
+async def create_bulk_campaign(request: Request):
+    """إنشاء حملة رسائل جماعية (تعمل في الخلفية) وبث التقدم (NDJSON)"""
+    from app.services.bulk_sender import bulk_sender
+    
+    data = await request.json()
+    messages = data.get('messages') or []
+    if not messages or not all(m.get('phone') and m.get('message') for m in messages):
+        raise HTTPException(status_code=400, detail="messages must be a list of {phone, message}")
+    
+    campaign_id = bulk_sender.create_campaign(data.get('name', 'bulk'), messages)
+    bulk_sender.start(campaign_id)
+    return _stream_bulk_progress(bulk_sender.watch(campaign_id))
+
+
+@app.get("/api/whatsapp/bulk/{campaign_id}")
+async def get_bulk_campaign(campaign_id: int):
+    """حالة حملة رسائل جماعية"""
+    from app.services.bulk_sender import bulk_sender
+    return bulk_sender.get_progress(campaign_id)
+
+
+@app.post("/api/whatsapp/bulk/{campaign_id}/resume")
+async def resume_bulk_campaign(campaign_id: int, retry_unknown: bool = False):
+    """استئناف حملة متوقفة بدون إعادة إرسال ما تم إرساله"""
+    from app.services.bulk_sender import bulk_sender
+    
+    if not bulk_sender.get_progress(campaign_id).get('success'):
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    if not bulk_sender.start(campaign_id, retry_unknown):
+        raise HTTPException(status_code=409, detail="Campaign is already running")
+    return _stream_bulk_progress(bulk_sender.watch(campaign_id))
+
+
+def _stream_bulk_progress(progress):
+    # قراءة فقط: إغلاق الاتصال ينهي البث والحملة تكمل في الخلفية
+    async def lines():
+        async for update in progress:
+            yield json.dumps(update, ensure_ascii=False) + "\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/api/whatsapp/stats")
+async def whatsapp_stats():
+    """زمن إرسال رسائل WhatsApp"""
+    return crm_service.whatsapp.get_stats()
 
 
 # ==================== API الأصلي (التسويق) ====================
@@ -183,6 +311,43 @@ async def chat(request: Request):
         }, status_code=500)
 
 
+@app.post("/api/chat/feedback")
+async def chat_feedback(request: Request):
+    """تقييم رد المحاور: الردود الناجحة تُحفظ كأنماط يُستفاد منها لاحقاً"""
+    data = await request.json()
+    if not data.get('user_message') or not data.get('ai_response'):
+        raise HTTPException(status_code=400, detail="user_message and ai_response are required")
+    
+    from app.services.advanced_learning_service import advanced_learning_service
+    learned = await advanced_learning_service.learn_from_conversation(
+        data['user_message'], data['ai_response'], bool(data.get('success', True)), int(data.get('rating', 0))
+    )
+    return {'success': True, 'learned': learned}
+
+
+@app.get("/api/chat/recommendations")
+async def chat_recommendations(message: str = None):
+    """توصيات الردود: أنجح الردود على رسائل مشابهة للرسالة الحالية"""
+    from app.services.advanced_learning_service import advanced_learning_service
+    # البحث في الأنماط يقرأ SQLite - خارج الـ event loop
+    recommendations = await asyncio.to_thread(advanced_learning_service.get_pattern_recommendations, message)
+    return {'recommendations': recommendations}
+
+
+@app.post("/api/ad-copy")
+async def generate_ad_copy(request: Request):
+    """إنشاء نسخ إعلانية منظمة (AIDA / PAS / الفائدة أولاً) لكل منصة"""
+    product_info = await request.json()
+
+    if not product_info.get('product_name'):
+        raise HTTPException(status_code=400, detail="product_name is required")
+
+    from app.services.ai_service_clean import ai_marketing_service
+    result = await ai_marketing_service.generate_ad_copy(product_info)
+
+    return JSONResponse(result, status_code=200 if result.get('success') else 502)
+
+
 @app.get("/api/facebook-ads/guide")
 async def facebook_ads_guide():
     """دليل إنشاء إعلانات Facebook"""
@@ -194,6 +359,106 @@ async def facebook_ads_guide():
     return JSONResponse(guide)
 
 
+@app.post("/api/facebook-ads/boost")
+async def facebook_boost_post(request: Request):
+    """نشر منشور على الصفحة وترويجه (طلب Graph واحد)"""
+    from app.services.facebook_boost_service import FacebookBoostService
+    
+    data = await request.json()
+    page_id = data.pop("page_id", None)
+    access_token = data.pop("access_token", None) or os.getenv("FACEBOOK_PAGE_ACCESS_TOKEN")
+    if not page_id or not access_token:
+        raise HTTPException(status_code=400, detail="page_id and access_token are required")
+    try:
+        FacebookBoostService.validate_post_data(data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    result = await FacebookBoostService(access_token).create_post_and_boost_async(page_id, data)
+    return JSONResponse(result, status_code=200 if result.get('success') else 502)
+
+
+@app.post("/api/facebook-ads/scenarios")
+async def facebook_ads_scenarios(request: Request):
+    """مقارنة شبكة سيناريوهات (ميزانية × مدة × دول × جمهور) وترتيبها حسب الوصول لكل دولار"""
+    data = await request.json()
+    try:
+        return reach_simulator.frontier(
+            budgets=data.get("budgets", [5, 10, 20, 50]),
+            durations=data.get("durations", [3, 7, 14]),
+            countries=data.get("countries", ["EG"]),
+            audiences=data.get("audiences", ["broad", "interests"]),
+            limit=int(data.get("limit", 20))
+        )
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/ads/campaigns/{campaign_id}/performance")
+async def ads_campaign_performance(campaign_id: str, days: int = 30):
+    """أداء حملة إعلانية من الإحصائيات المخزنة محلياً"""
+    return smart_ads_service.get_campaign_performance(campaign_id, days)
+
+
+@app.post("/api/ads/campaigns/{campaign_id}/allocate")
+async def ads_campaign_allocate(campaign_id: str):
+    """إعادة توزيع الميزانية اليومية للحملة الآن"""
+    result = await asyncio.to_thread(budget_allocator.allocate, campaign_id, "manual")
+    if not result.get('success'):
+        raise HTTPException(status_code=404, detail=result.get('error'))
+    return result
+
+
+@app.get("/api/ads/campaigns/{campaign_id}/allocations")
+async def ads_campaign_allocations(campaign_id: str, limit: int = 20):
+    """سجل قرارات توزيع الميزانية للمراجعة"""
+    return {'campaign_id': campaign_id, 'history': budget_allocator.get_history(campaign_id, limit)}
+
+
+@app.get("/api/ads/builds/{build_id}")
+async def ads_build_status(build_id: int):
+    """حالة بناء الحملة وكل عناصرها (مجموعات وإعلانات)"""
+    build = campaign_builder.get_build(build_id)
+    if not build:
+        raise HTTPException(status_code=404, detail="Build not found")
+    return build
+
+
+@app.post("/api/ads/builds/{build_id}/retry")
+async def ads_build_retry(build_id: int):
+    """إعادة العناصر الفاشلة فقط في بناء الحملة"""
+    if not campaign_builder.enabled:
+        raise HTTPException(status_code=503, detail="FACEBOOK_ACCESS_TOKEN not configured")
+    result = await campaign_builder.retry_failed(build_id)
+    if result.get('error'):
+        raise HTTPException(status_code=404, detail=result['error'])
+    if result.get('skipped'):
+        raise HTTPException(status_code=409, detail=result['skipped'])
+    return result
+
+
+@app.get("/api/ads/insights/rollup")
+async def ads_insights_rollup(period: str = "week", days: int = 90, campaign_id: str = None):
+    """تجميع أداء الإعلانات حسب اليوم/الأسبوع/الشهر"""
+    try:
+        return {'period': period, 'rows': ad_insights.get_rollup(period, days, campaign_id)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/api/ads/insights/sync")
+async def ads_insights_sync():
+    """تشغيل مزامنة الإحصائيات الآن بدلاً من انتظار موعدها"""
+    scheduler.trigger(ad_insights.JOB_NAME)
+    return {'success': True, 'message': 'Sync triggered'}
+
+
+@app.get("/api/render/stats")
+async def render_stats():
+    """زمن رسم كل قالب"""
+    return renderer.get_stats() if renderer else {}
+
+
 @app.get("/api/health")
 async def health_check():
     """فحص صحة التطبيق"""
@@ -217,6 +482,60 @@ async def health_check():
 @app.on_event("startup")
 async def startup_event():
     """عند بدء التشغيل"""
+    await http_client.start()
+    if renderer:
+        renderer.precompile()
+    scheduler.register(
+        'score_decay',
+        crm_service.decay_scores,
+        interval_seconds=int(os.getenv("SCORE_DECAY_INTERVAL_MINUTES", "60")) * 60
+    )
+    # الدمج الدوري اختياري (LEAD_DEDUP_INTERVAL_HOURS) - بدونه يعمل فقط من زر الدمج
+    dedup_hours = os.getenv("LEAD_DEDUP_INTERVAL_HOURS")
+    scheduler.register(
+        LeadDeduplicator.JOB_NAME,
+        crm_service.merge_duplicates,
+        interval_seconds=float(dedup_hours) * 3600 if dedup_hours else None
+    )
+    scheduler.register(
+        crm_service.outbox.JOB_NAME,
+        crm_service.outbox.dispatch,
+        interval_seconds=int(os.getenv("OUTBOX_POLL_SECONDS", "5")),
+        run_on_start=True
+    )
+    scheduler.register(
+        WhatsAppWebhookIngestor.JOB_NAME,
+        webhook_ingestor.process_pending,
+        interval_seconds=int(os.getenv("WEBHOOK_POLL_SECONDS", "10")),
+        run_on_start=True
+    )
+    scheduler.register(
+        ad_insights.JOB_NAME,
+        smart_ads_service.refresh_insights,
+        interval_seconds=int(os.getenv("INSIGHTS_SYNC_MINUTES", "60")) * 60,
+        run_on_start=True
+    )
+    from app.services.bulk_sender import bulk_sender
+    from app.services.phrase_stats import phrase_stats, SAVE_INTERVAL_SECONDS
+    scheduler.register(
+        'phrase_stats_save',
+        phrase_stats.persist,
+        interval_seconds=SAVE_INTERVAL_SECONDS
+    )
+    scheduler.register(
+        bulk_sender.JOB_NAME,
+        bulk_sender.process_queue,
+        interval_seconds=int(os.getenv("BULK_CAMPAIGN_POLL_SECONDS", "60")),
+        run_on_start=True
+    )
+    scheduler.register(
+        campaign_builder.JOB_NAME,
+        campaign_builder.resume_incomplete,
+        interval_seconds=int(os.getenv("CAMPAIGN_BUILD_RESUME_SECONDS", "300")),
+        run_on_start=True
+    )
+    await scheduler.start()
+    
     print("=" * 70)
     print("🚀 Brilliox Marketing AI + CRM - Starting...")
     print("=" * 70)
@@ -234,6 +553,15 @@ async def startup_event():
     print("=" * 70)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """عند إيقاف التشغيل"""
+    await scheduler.stop()
+    await http_client.close()
+    from app.services.phrase_stats import phrase_stats
+    await phrase_stats.persist()
+
+
 # ==================== Run ====================
 
 if __name__ == "__main__":
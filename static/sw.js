@@ -0,0 +1,223 @@
+/*
+ * Brilliox Service Worker - التطبيق يعمل بدون اتصال 📴
+ * - app shell محفوظ مسبقاً: فتح التطبيق لا ينتظر الخادم (ولا تشغيل جهاز fly.io المتوقف)
+ * - stale-while-revalidate للوحة التحكم وقوائم العملاء
+ * - إضافة العملاء وإرسال الرسائل بدون اتصال تُحفظ في IndexedDB وتُرسل عند عودة الاتصال
+ *   (مع Idempotency-Key لكل طلب حتى لا يتكرر إذا ضاع الرد بعد وصوله للخادم)
+ * يُقدَّم من /sw.js مع رقم الإصدار الحالي: كل نشر جديد = caches جديدة وحذف القديمة
+ */
+const VERSION = '__BUILD_VERSION__';
+const PRECACHE_URLS = __PRECACHE_URLS__;
+
+const SHELL_CACHE = `brilliox-shell-${VERSION}`;
+const API_CACHE = `brilliox-api-${VERSION}`;
+const SHELL_PATHS = ['/', '/mobile'];
+const SHELL_KEY = '/mobile';
+
+const SWR_API = [/^\/api\/crm\/dashboard$/, /^\/api\/crm\/leads$/, /^\/api\/crm\/tasks$/];
+const QUEUED_POSTS = [/^\/api\/crm\/leads$/, /^\/api\/crm\/leads\/\d+\/send$/];
+
+const DB_NAME = 'brilliox-offline';
+const OUTBOX = 'outbox';
+const SYNC_TAG = 'brilliox-outbox';
+
+// إعادة إرسال واحدة فقط في نفس الوقت: activate و sync و message قد تأتي معاً
+let replayInFlight = null;
+
+// ==================== التثبيت والتفعيل ====================
+
+self.addEventListener('install', (event) => {
+    event.waitUntil(
+        caches.open(SHELL_CACHE)
+            .then((cache) => cache.addAll(PRECACHE_URLS))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil((async () => {
+        const keep = new Set([SHELL_CACHE, API_CACHE]);
+        const names = await caches.keys();
+        await Promise.all(
+            names.filter((name) => name.startsWith('brilliox-') && !keep.has(name))
+                .map((name) => caches.delete(name))
+        );
+        await self.clients.claim();
+        await replayOutbox().catch(() => {});
+    })());
+});
+
+// ==================== الطلبات ====================
+
+self.addEventListener('fetch', (event) => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+
+    if (request.method === 'POST' && QUEUED_POSTS.some((re) => re.test(url.pathname))) {
+        event.respondWith(sendOrQueue(request));
+        return;
+    }
+    if (request.method !== 'GET') return;
+
+    if (request.mode === 'navigate') {
+        event.respondWith(
+            SHELL_PATHS.includes(url.pathname)
+                ? staleWhileRevalidate(event, SHELL_CACHE, request, SHELL_KEY)
+                : fetch(request).catch(() => caches.match(SHELL_KEY))
+        );
+        return;
+    }
+    if (url.pathname.startsWith('/static/dist/')) {
+        // ملفات ذات بصمة: المحتوى لا يتغير أبداً لنفس الاسم
+        event.respondWith(cacheFirst(SHELL_CACHE, request));
+        return;
+    }
+    if (SWR_API.some((re) => re.test(url.pathname))) {
+        event.respondWith(staleWhileRevalidate(event, API_CACHE, request));
+    }
+});
+
+async function staleWhileRevalidate(event, cacheName, request, cacheKey) {
+    const cache = await caches.open(cacheName);
+    const key = cacheKey || request;
+    const cached = await cache.match(key);
+    const network = fetch(request).then((response) => {
+        if (response.ok) cache.put(key, response.clone());
+        return response;
+    });
+    if (cached) {
+        event.waitUntil(network.catch(() => {}));
+        return cached;
+    }
+    return network.catch(() => offlineResponse());
+}
+
+async function cacheFirst(cacheName, request) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(request);
+    if (cached) return cached;
+    const response = await fetch(request);
+    if (response.ok) cache.put(request, response.clone());
+    return response;
+}
+
+function offlineResponse() {
+    return jsonResponse({ success: false, offline: true, message: 'لا يوجد اتصال بالإنترنت' }, 503);
+}
+
+function jsonResponse(data, status) {
+    return new Response(JSON.stringify(data), {
+        status,
+        headers: { 'Content-Type': 'application/json; charset=utf-8' },
+    });
+}
+
+// ==================== طابور الطلبات بدون اتصال ====================
+
+async function sendOrQueue(request) {
+    const body = await request.clone().text();
+    // نفس المفتاح للمحاولة الأولى وللطابور: إذا وصل الطلب وضاع الرد، الإعادة لا تكرره
+    const idempotencyKey = request.headers.get('Idempotency-Key') || crypto.randomUUID();
+    const headers = new Headers(request.headers);
+    headers.set('Idempotency-Key', idempotencyKey);
+    try {
+        return await fetch(new Request(request, { headers }));
+    } catch (err) {
+        await enqueue({
+            url: request.url,
+            method: request.method,
+            contentType: request.headers.get('Content-Type') || 'application/json',
+            body,
+            idempotencyKey,
+            queuedAt: Date.now(),
+        });
+        if (self.registration.sync) {
+            await self.registration.sync.register(SYNC_TAG).catch(() => {});
+        }
+        return jsonResponse({ success: true, queued: true, message: 'تم الحفظ وسيُرسل عند عودة الاتصال' }, 202);
+    }
+}
+
+self.addEventListener('sync', (event) => {
+    if (event.tag === SYNC_TAG) event.waitUntil(replayOutbox());
+});
+
+// المتصفحات بدون Background Sync (Safari): الصفحة ترسل replay-outbox عند حدث online
+self.addEventListener('message', (event) => {
+    if (event.data && event.data.type === 'replay-outbox') {
+        event.waitUntil(replayOutbox().catch(() => {}));
+    }
+});
+
+function replayOutbox() {
+    if (!replayInFlight) {
+        replayInFlight = drainOutbox().finally(() => { replayInFlight = null; });
+    }
+    return replayInFlight;
+}
+
+async function drainOutbox() {
+    const entries = await outboxEntries();
+    let sent = 0;
+    for (const entry of entries) {
+        // بدون اتصال: fetch يرمي خطأ و sync يعيد المحاولة لاحقاً بنفس الترتيب
+        const response = await fetch(entry.url, {
+            method: entry.method,
+            // مدخلات أُضيفت قبل وجود المفتاح: id + وقت الإضافة ثابتان لكل مدخل
+            headers: {
+                'Content-Type': entry.contentType,
+                'Idempotency-Key': entry.idempotencyKey || `outbox-${entry.id}-${entry.queuedAt}`,
+            },
+            body: entry.body,
+        });
+        // خطأ في الخادم أو ضغط أو نفس المفتاح ما زال قيد التنفيذ (409): إعادة المحاولة لاحقاً.
+        // أخطاء البيانات (4xx) لن تنجح بالتكرار
+        if (response.status >= 500 || [408, 409, 429].includes(response.status)) {
+            throw new Error(`Outbox replay failed with ${response.status}`);
+        }
+        await deleteEntry(entry.id);
+        sent += 1;
+    }
+    if (sent) {
+        const clients = await self.clients.matchAll();
+        clients.forEach((client) => client.postMessage({ type: 'outbox-replayed', sent }));
+        const cache = await caches.open(API_CACHE);
+        await Promise.all((await cache.keys()).map((key) => cache.delete(key)));
+    }
+    return sent;
+}
+
+// ==================== IndexedDB ====================
+
+function openDb() {
+    return new Promise((resolve, reject) => {
+        const open = indexedDB.open(DB_NAME, 1);
+        open.onupgradeneeded = () => open.result.createObjectStore(OUTBOX, { keyPath: 'id', autoIncrement: true });
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+async function withStore(mode, fn) {
+    const db = await openDb();
+    return new Promise((resolve, reject) => {
+        const tx = db.transaction(OUTBOX, mode);
+        const result = fn(tx.objectStore(OUTBOX));
+        tx.oncomplete = () => { db.close(); resolve(result.result); };
+        tx.onerror = () => { db.close(); reject(tx.error); };
+    });
+}
+
+function enqueue(entry) {
+    return withStore('readwrite', (store) => store.add(entry));
+}
+
+function outboxEntries() {
+    // المفتاح autoIncrement: getAll يرجعها بترتيب الإضافة
+    return withStore('readonly', (store) => store.getAll());
+}
+
+function deleteEntry(id) {
+    return withStore('readwrite', (store) => store.delete(id));
+}